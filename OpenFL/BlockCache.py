@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+BlockCache.py
+
+A host-side mirror of the blocks stored on printers, so that blocks
+we have already seen are read from disk rather than over USB.
+
+Entries are keyed by printer serial number, block number and the
+(size, crc) pair the printer reports from CMD_BLOCK_INFORMATION.
+The firmware always reports a crc of 0, so a hit only means the size
+matches: a block rewritten with the same size by another host or
+program is indistinguishable. The cache is therefore only valid while
+this host is the only writer; Printer keeps its own writes and deletes
+in sync.
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import glob
+import os
+import re
+
+from OpenFL import FLP
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.openfl', 'blocks')
+
+
+class BlockCache(object):
+    """
+    Stores block contents under directory/<serial>/<block>-<size>-<crc>.blk
+    """
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def _printerDirectory(self, serial):
+        # Serial numbers come from the printer; keep them filename-safe.
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', serial))
+
+    def _path(self, serial, block, size, crc):
+        return os.path.join(self._printerDirectory(serial),
+                            '{}-{}-{:08x}.blk'.format(block, size, crc))
+
+    def _entries(self, serial, pattern='*.blk'):
+        """Generate (block, path) for cached files matching pattern."""
+        directory = self._printerDirectory(serial)
+        for path in glob.glob(os.path.join(directory, pattern)):
+            yield int(os.path.basename(path).split('-')[0]), path
+
+    def get(self, serial, block, size, crc):
+        """Return the cached data, or None if this version isn't cached."""
+        try:
+            with open(self._path(serial, block, size, crc), 'rb') as fh:
+                data = bytearray(fh.read())
+        except IOError:
+            self.misses += 1
+            return None
+        if len(data) != size: # e.g. a partial write
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, serial, block, data, crc):
+        """Cache data as the current contents of block."""
+        self.invalidate(serial, block)
+        directory = self._printerDirectory(serial)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = self._path(serial, block, len(data), crc)
+        # Write then rename, so readers never see a partial entry.
+        with open(path + '.tmp', 'wb') as fh:
+            fh.write(bytes(data))
+        os.rename(path + '.tmp', path)
+
+    def invalidate(self, serial, block, end=None):
+        """Forget blocks block through end (inclusive)."""
+        if end is None:
+            end = block
+        # A single block is the common case (every put); don't list the
+        # whole printer directory for it.
+        pattern = '{}-*.blk'.format(block) if end == block else '*.blk'
+        for b, path in self._entries(serial, pattern):
+            if block <= b <= end:
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Capture.py
+
+Record the raw USB traffic of a Printer session and replay it later.
+
+Recording is opt-in:
+    >>> p = Printer.Printer()
+    >>> p.start_recording('session.oflcap')
+    >>> ... # use p as usual
+    >>> p.stop_recording()
+
+and a capture can be fed back into a Printer, byte for byte:
+    >>> p = Printer.Printer(dev=Capture.ReplayDevice('session.oflcap'))
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import errno
+import struct
+import time
+
+import usb.core
+
+from OpenFL import FLP
+
+try: # Since python3 doesn't have basestring:
+    basestring
+except NameError:
+    basestring = str
+
+# A capture file is MAGIC followed by records. Each record is a
+# RECORD header (seconds since the capture started, direction, length)
+# followed by the bytes transferred.
+MAGIC = b'OFLCAP\x00\x01'
+RECORD = struct.Struct('<dBI')
+WRITE = 0 # Computer -> printer
+READ = 1  # Printer -> computer
+TIMEOUT = 2 # A read that timed out; no data
+
+
+class CaptureError(RuntimeError):
+    pass
+
+
+class CaptureWriter(object):
+    """
+    Appends timestamped transfers to a capture file.
+    fileHandle is a file name or a binary file opened for writing.
+    """
+    def __init__(self, fileHandle):
+        self._ownsHandle = isinstance(fileHandle, basestring)
+        if self._ownsHandle:
+            fileHandle = open(fileHandle, 'wb')
+        self.fileHandle = fileHandle
+        self.fileHandle.write(MAGIC)
+        self.start = time.time()
+
+    def record(self, direction, data):
+        data = bytes(data)
+        self.fileHandle.write(RECORD.pack(time.time() - self.start,
+                                          direction, len(data)))
+        self.fileHandle.write(data)
+
+    def close(self):
+        if self._ownsHandle:
+            self.fileHandle.close()
+        else:
+            self.fileHandle.flush()
+
+
+def readCapture(fileHandle):
+    """
+    Generate (t_s, direction, data) for each transfer in a capture.
+    fileHandle is a file name or a binary file opened for reading.
+    """
+    if isinstance(fileHandle, basestring):
+        with open(fileHandle, 'rb') as fh:
+            for record in readCapture(fh):
+                yield record
+        return
+    if fileHandle.read(len(MAGIC)) != MAGIC:
+        raise CaptureError('Not an OpenFL capture file.')
+    while True:
+        header = fileHandle.read(RECORD.size)
+        if not header:
+            return
+        if len(header) != RECORD.size:
+            raise CaptureError('Truncated capture record.')
+        t_s, direction, length = RECORD.unpack(header)
+        data = fileHandle.read(length)
+        if len(data) != length:
+            raise CaptureError('Truncated capture record.')
+        yield t_s, direction, bytearray(data)
+
+
+class ReplayDevice(object):
+    """
+    Stands in for a usb.core.Device by playing back a capture.
+
+    A read returns the next recorded read once every write recorded
+    before it has been made, so responses never overtake the commands
+    that caused them. With realtime=True, reads are also held back
+    until their recorded time (measured from the first transfer);
+    otherwise the capture plays back as fast as the host asks.
+
+    With strict=True, writes must match the recorded bytes,
+    and a CaptureError is raised if they don't.
+    Reads that timed out while recording raise a timeout USBError at the
+    same point in the replay, as does a read when there's nothing to read.
+    """
+    def __init__(self, capture, realtime=False, strict=True):
+        self.records = list(readCapture(capture))
+        self.realtime = realtime
+        self.strict = strict
+        self.default_timeout = None
+        self._index = 0 # The next record to play
+        self._start = None
+
+    def set_configuration(self):
+        pass
+
+    @property
+    def done(self):
+        """True once every recorded transfer has been played."""
+        return self._index >= len(self.records)
+
+    def _elapsed_s(self):
+        if self._start is None:
+            self._start = time.time()
+        return time.time() - self._start
+
+    def write(self, endpoint, data, timeout=None):
+        self._elapsed_s()
+        data = bytearray(data)
+        if self.done or self.records[self._index][1] != WRITE:
+            if self.strict:
+                raise CaptureError('Unexpected write of {} bytes at record {}.'.format(len(data), self._index))
+            return len(data)
+        expected = self.records[self._index][2]
+        if self.strict and data != expected:
+            raise CaptureError('Write at record {} does not match the capture.'.format(self._index))
+        self._index += 1
+        return len(data)
+
+    def read(self, endpoint, size, timeout=None):
+        elapsed_s = self._elapsed_s()
+        if self.done or self.records[self._index][1] == WRITE:
+            raise usb.core.USBError('Operation timed out', errno=errno.ETIMEDOUT)
+        t_s, direction, data = self.records[self._index]
+        if self.realtime and t_s > elapsed_s:
+            wait_s = t_s - elapsed_s
+            if timeout is not None and wait_s > timeout / 1000.0:
+                time.sleep(timeout / 1000.0)
+                raise usb.core.USBError('Operation timed out', errno=errno.ETIMEDOUT)
+            time.sleep(wait_s)
+        self._index += 1
+        if direction == TIMEOUT:
+            raise usb.core.USBError('Operation timed out', errno=errno.ETIMEDOUT)
+        return data
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+Daemon.py
+
+Share one USB connection to a printer between many processes.
+
+Only one process at a time can claim the printer over USB. A
+PrinterDaemon owns the Printer and serves its block, state and
+calibration commands over a Unix socket, and streams status events
+(STATUS_LAYER_DONE, etc.) to subscribers. PrinterClient has the same
+interface as Printer, so scripts can use it instead and start
+instantly, sharing the daemon's connection and cached calibration:
+
+    $ python -m OpenFL.Daemon &
+    >>> from OpenFL import Daemon
+    >>> p = Daemon.PrinterClient()
+    >>> p.list_blocks()
+
+The protocol is one JSON object per line. Requests look like
+{"id": 1, "method": "list_blocks", "args": [], "kwargs": {}} and
+responses like {"id": 1, "result": [0, 1], "error": null}. Bytes are
+sent as {"__bytes__": base64} and enums as {"__enum__": "State",
+"name": "MACHINE_READY_TO_PRINT"}. After a "subscribe" request, the
+connection carries only {"event": [command, payload]} lines.
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import base64
+import json
+import os
+import socket
+import tempfile
+import threading
+
+try:
+    import socketserver
+    import queue
+except ImportError: # Python 2
+    import SocketServer as socketserver
+    import Queue as queue
+
+import numpy as np
+
+from OpenFL import FLP, Printer
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'openfl-printer.sock')
+
+# Printer methods the daemon serves.
+REMOTE_METHODS = ('initialize', 'shutdown', 'list_blocks', 'delete_block',
+                  'read_block_raw', 'block_information', 'block_size',
+                  'get_machine_information', 'serial_number', 'state',
+                  'start_printing', 'stop_printing', 'pause_printing',
+                  'unpause_printing', 'move_z', 'set_laser_uint16',
+                  'read_laser_table', 'read_grid_table', 'read_zsensor_height',
+                  'write_block')
+# Calibration doesn't change while the printer is connected,
+# so the daemon reads it once.
+CACHED_METHODS = ('read_laser_table', 'read_grid_table', 'read_zsensor_height',
+                  'get_machine_information', 'serial_number')
+ENUMS = dict((cls.__name__, cls) for cls in (Printer.Command, Printer.Response, Printer.State))
+ERRORS = dict((cls.__name__, cls) for cls in (Printer.BadResponse, Printer.DecodeError,
+                                              Printer.LaserPowerError, TypeError, ValueError))
+
+
+def _default(value):
+    """json.dumps hook for the types Printer methods take and return."""
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(bytes(value)).decode('ascii')}
+    if isinstance(value, tuple(ENUMS.values())):
+        return {'__enum__': type(value).__name__, 'name': value.name}
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError('Cannot send {} to or from the printer daemon.'.format(type(value)))
+
+def _hook(obj):
+    """json.loads hook undoing _default."""
+    if '__bytes__' in obj:
+        return bytearray(base64.b64decode(obj['__bytes__']))
+    if '__enum__' in obj:
+        return ENUMS[obj['__enum__']][obj['name']]
+    return obj
+
+def _error(e):
+    """A response dict for the exception e."""
+    return {'result': None, 'error': {'type': type(e).__name__, 'message': str(e)}}
+
+def _check_arguments(method, args, kwargs):
+    """
+    Printer.write_block opens data that isn't a bytearray as a file,
+    which would let any client read the daemon's files; clients send
+    the block itself instead (as PrinterClient.write_block does).
+    """
+    if method == 'write_block':
+        data = args[1] if len(args) > 1 else kwargs.get('data')
+        if not isinstance(data, bytearray):
+            raise TypeError('write_block takes block data as bytes over the socket; '
+                            'read files on the client side.')
+
+def _dumps(obj):
+    return (json.dumps(obj, default=_default) + '\n').encode('utf-8')
+
+def _loads(line):
+    return json.loads(line.decode('utf-8'), object_hook=_hook)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.printer_daemon
+        for line in iter(self.rfile.readline, b''):
+            request = None
+            try:
+                request = _loads(line)
+                method = request['method']
+            except (ValueError, KeyError, TypeError) as e:
+                # Malformed requests get an error, not a dropped connection.
+                response = _error(e)
+            else:
+                if method == 'subscribe':
+                    self._stream_events(request)
+                    return
+                response = daemon.call(method,
+                                       request.get('args', []),
+                                       request.get('kwargs', {}))
+            response['id'] = request.get('id') if isinstance(request, dict) else None
+            self.wfile.write(_dumps(response))
+            self.wfile.flush()
+
+    def _stream_events(self, request):
+        daemon = self.server.printer_daemon
+        events = daemon.subscribe()
+        try:
+            self.wfile.write(_dumps({'id': request.get('id'), 'result': True, 'error': None}))
+            self.wfile.flush()
+            while daemon.running:
+                try:
+                    event = events.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                self.wfile.write(_dumps({'event': list(event)}))
+                self.wfile.flush()
+        except socket.error:
+            pass # The client went away.
+        finally:
+            daemon.unsubscribe(events)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class PrinterDaemon(object):
+    """
+    Serves a Printer (or DummyPrinter) on a Unix socket.
+    Commands from all clients are executed one at a time.
+    Between commands, the printer is polled every poll_interval_s
+    for status events, which go to every subscriber.
+    """
+    def __init__(self, printer, path=DEFAULT_SOCKET, poll_interval_s=0.1,
+                 poll_timeout_ms=10):
+        self.printer = printer
+        self.path = path
+        self.poll_interval_s = poll_interval_s
+        self.poll_timeout_ms = poll_timeout_ms
+        self.running = False
+        self._lock = threading.RLock()
+        self._subscribers = []
+        self._cache = {}
+
+        # Status events can also arrive while a command waits for its
+        # response; catch those before _wait_for_packet discards them.
+        poll = printer.poll
+        def tee(*args, **kwargs):
+            p = poll(*args, **kwargs)
+            if p is not None and p[0] in Printer.STATUS_COMMANDS:
+                self._publish(p)
+            return p
+        printer.poll = tee
+
+        if os.path.exists(path):
+            os.remove(path) # A stale socket from a previous daemon
+        self.server = _Server(path, _Handler)
+        self.server.printer_daemon = self
+
+    def call(self, method, args, kwargs):
+        """Run one Printer method, returning a response dict."""
+        if method not in REMOTE_METHODS:
+            return _error(TypeError('Unknown method {}'.format(method)))
+        try:
+            _check_arguments(method, args, kwargs)
+            with self._lock:
+                if method in CACHED_METHODS and not args and not kwargs:
+                    if method not in self._cache:
+                        self._cache[method] = getattr(self.printer, method)()
+                    result = self._cache[method]
+                else:
+                    result = getattr(self.printer, method)(*args, **kwargs)
+        except Exception as e:
+            return _error(e)
+        return {'result': result, 'error': None}
+
+    def subscribe(self):
+        """Return a queue that receives every status event."""
+        events = queue.Queue()
+        with self._lock:
+            self._subscribers.append(events)
+        return events
+
+    def unsubscribe(self, events):
+        with self._lock:
+            self._subscribers.remove(events)
+
+    def _publish(self, event):
+        for events in list(self._subscribers):
+            events.put(event)
+
+    def _poll_loop(self):
+        import time
+        while self.running:
+            with self._lock:
+                # Don't hold the printer for the full USB timeout.
+                timeout_ms = self.printer.timeout_ms
+                self.printer.timeout_ms = self.poll_timeout_ms
+                try:
+                    while self.printer.poll() is not None:
+                        pass # tee publishes status events
+                finally:
+                    self.printer.timeout_ms = timeout_ms
+            time.sleep(self.poll_interval_s)
+
+    def start(self):
+        """Serve in background threads and return immediately."""
+        self.running = True
+        for target in (self._poll_loop, self.server.serve_forever):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while self.running:
+                threading.Event().wait(1.0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.running = False
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _Connection(object):
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+        self._next_id = 0
+
+    def send(self, method, args=(), kwargs=None):
+        self._next_id += 1
+        self.wfile.write(_dumps({'id': self._next_id, 'method': method,
+                                 'args': list(args), 'kwargs': kwargs or {}}))
+        self.wfile.flush()
+        return self.receive()
+
+    def receive(self):
+        line = self.rfile.readline()
+        if not line:
+            raise RuntimeError('The printer daemon closed the connection.')
+        return _loads(line)
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+
+class PrinterClient(Printer.Printer):
+    """
+    A Printer whose commands run on a PrinterDaemon.
+    Everything Printer computes locally (mm_to_galvo, samples_to_FLP,
+    laser audits, ...) works as usual, using calibration from the daemon.
+    poll() returns status events from the daemon.
+    """
+    def __init__(self, path=DEFAULT_SOCKET):
+        super(PrinterClient, self).__init__(connect=False)
+        self.path = path
+        self._connection = _Connection(path)
+        self._events = None
+        self._lock = threading.Lock()
+
+    def _call(self, method, *args, **kwargs):
+        with self._lock:
+            response = self._connection.send(method, args, kwargs)
+        error = response['error']
+        if error is not None:
+            raise ERRORS.get(error['type'], RuntimeError)(error['message'])
+        return response['result']
+
+    def subscribe(self):
+        """Start receiving status events; they are returned by poll()."""
+        if self._events is None:
+            self._events = _Connection(self.path)
+            response = self._events.send('subscribe')
+            if response['error'] is not None:
+                raise RuntimeError(response['error']['message'])
+            self._events.sock.settimeout(0.1)
+
+    def poll(self, bufsize=None):
+        """ Returns the next status event as a tuple (command, payload)
+            If there are no events pending, returns None
+        """
+        self.subscribe()
+        try:
+            event = self._events.receive()
+        except socket.timeout:
+            return None
+        command, payload = event['event']
+        return command, payload
+
+    def close(self):
+        self._connection.close()
+        if self._events is not None:
+            self._events.close()
+
+    def list_blocks(self):
+        return tuple(self._call('list_blocks'))
+
+    def block_information(self, block):
+        info = self._call('block_information', block)
+        return info if isinstance(info, Printer.Response) else tuple(info)
+
+    def write_block(self, block, data, skip_audit=False):
+        # The daemon only takes the data itself, so read files here.
+        if isinstance(data, FLP.Packets):
+            assert skip_audit == False
+            return self.write_block_flp(block, data)
+        if not isinstance(data, bytearray):
+            data = bytearray(open(data, 'rb').read())
+        return self._call('write_block', block, data, skip_audit=skip_audit)
+
+    def read_laser_table(self):
+        return np.asarray(self._call('read_laser_table'))
+
+    def read_grid_table(self):
+        return np.asarray(self._call('read_grid_table'))
+
+def _remote(name):
+    def method(self, *args, **kwargs):
+        return self._call(name, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = getattr(Printer.Printer, name).__doc__
+    return method
+
+for _name in REMOTE_METHODS:
+    if _name not in PrinterClient.__dict__:
+        setattr(PrinterClient, _name, _remote(_name))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve a Form 1/1+ to other processes over a Unix socket.')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Socket path (default: %(default)s)')
+    parser.add_argument('--dummy-printer', action='store_true', help="Serve a DummyPrinter instead of a real one.")
+    args = parser.parse_args()
+    printer = Printer.DummyPrinter() if args.dummy_printer else Printer.Printer()
+    print('Serving printer on {}'.format(args.socket))
+    PrinterDaemon(printer, args.socket).serve_forever()
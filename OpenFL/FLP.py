@@ -196,7 +196,7 @@ class XYMove(LaserCommand):
         """Convert to binary string."""
         assert self.data == self.npoints
         return (super(XYMove, self).tostring() +
-                ''.join(self.rowstruct.pack(*row) for row in self.points))
+                b''.join(self.rowstruct.pack(*row) for row in self.points))
 
     def __str__(self):
         result = super(XYMove, self).__str__()
@@ -465,14 +465,18 @@ class AbstractStringCommand(Packet):
     COUNT = 64
 
     def __init__(self, string=''):
-        if not isinstance(string, basestring):
-            raise TypeError('string must be a string')
+        if not isinstance(string, bytes):
+            if not isinstance(string, basestring):
+                raise TypeError('string must be a string')
+            string = string.encode('latin-1')
         if len(string) > self.COUNT:
             raise TypeError('String too long {} > {}'.format(len(string), self.COUNT))
-        self.data = string + '\0' * (self.COUNT - len(string))
+        self.data = string + b'\0' * (self.COUNT - len(string))
 
     @property
-    def string(self): return self.rawstring.strip('\0')
+    def string(self):
+        result = self.rawstring.strip(b'\0')
+        return result if isinstance(result, str) else result.decode('latin-1')
 
     @property
     def rawstring(self):
@@ -484,7 +488,7 @@ class AbstractStringCommand(Packet):
     def __str__(self):
         return '0x{:>02x} {} {}'.format(self.CMD,
                                         self.__class__.__name__,
-                                        repr(self.string.strip('\0')))
+                                        repr(self.string))
 
     def _reprContents(self):
         return repr(self.string)
@@ -588,6 +592,16 @@ class Packets(list):
         """Generate all xy moves."""
         for p in self.gen_packets(XYMove):
             yield p
+    def layers(self):
+        """Generate Packets for each layer, splitting before each LayerStart."""
+        layer = Packets()
+        for p in self:
+            if isinstance(p, LayerStart) and layer:
+                yield layer
+                layer = Packets()
+            layer.append(p)
+        if layer:
+            yield layer
     def __str__(self):
         return '\n'.join(str(packet) for packet in self)
 
@@ -617,7 +631,7 @@ class Packets(list):
 
     def tostring(self):
         """Stringify all Packets for serialization."""
-        return ''.join(cmd.tostring() for cmd in self)
+        return b''.join(cmd.tostring() for cmd in self)
 
     def tofile(self, fileHandle):
         """Write to a file."""
@@ -628,6 +642,46 @@ class Packets(list):
             fileHandle.write(self.tostring())
 
 
+class PacketWriter(object):
+    """
+    Write packets to a file one at a time.
+    Unlike Packets.tofile, this never needs the whole file in memory,
+    so it can be fed from a generator. fileHandle may be a file name
+    or anything with a write method.
+    """
+    def __init__(self, fileHandle):
+        self._ownsHandle = isinstance(fileHandle, basestring)
+        if self._ownsHandle:
+            fileHandle = open(fileHandle, 'wb')
+        self.fileHandle = fileHandle
+        self.npackets = 0
+        self.nbytes = 0
+
+    def write(self, packet):
+        """Serialize one packet."""
+        if not isinstance(packet, Packet):
+            raise TypeError('Can only write FLP Packets. Got {}'.format(type(packet)))
+        s = packet.tostring()
+        self.fileHandle.write(s)
+        self.npackets += 1
+        self.nbytes += len(s)
+
+    def extend(self, packets):
+        """Serialize every packet in an iterable."""
+        for packet in packets:
+            self.write(packet)
+
+    def close(self):
+        if self._ownsHandle:
+            self.fileHandle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 
 def makeHomingSequence():
     """Return Packets that home the motors."""
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+FakeUSB.py
+
+A byte-level stand-in for the Form 1/1+ USB device.
+
+A real Printer can be constructed on a FakeDevice, so that framing
+(Printer._encode, _decode, _process_raw and poll) runs exactly as it
+does in production, without hardware:
+    >>> from OpenFL import Printer, FakeUSB
+    >>> p = Printer.Printer(dev=FakeUSB.FakeDevice())
+    >>> p.initialize()
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import errno
+import random
+import struct
+import time
+
+import usb.core
+
+from OpenFL import FLP
+from OpenFL.Printer import Printer, DummyPrinter, Command, Response, State
+
+
+class LinkProfile(object):
+    """
+    Describes the USB link between host and printer.
+        bandwidth_Bps is the throughput in bytes per second (None: unlimited)
+        latency_s is added to every transfer
+        max_transfer is the most bytes returned by one read (None: no limit)
+        fragment: if True, reads return a random number of bytes up to the
+                  limit, so frames get split at arbitrary points
+        seed seeds the fragmentation
+    """
+    def __init__(self, bandwidth_Bps=None, latency_s=0.0, max_transfer=None,
+                 fragment=False, seed=0):
+        self.bandwidth_Bps = bandwidth_Bps
+        self.latency_s = latency_s
+        self.max_transfer = max_transfer
+        self.fragment = fragment
+        self.random = random.Random(seed)
+
+    def transfer_s(self, nbytes):
+        """Time for one transfer of nbytes."""
+        result = self.latency_s
+        if self.bandwidth_Bps:
+            result += nbytes / self.bandwidth_Bps
+        return result
+
+    def read_size(self, available, bufsize):
+        """Number of bytes one read returns."""
+        n = min(available, bufsize)
+        if self.max_transfer is not None:
+            n = min(n, self.max_transfer)
+        if self.fragment and n > 1:
+            n = self.random.randint(1, n)
+        return n
+
+# Full-speed USB: 64-byte bulk packets, about 1 MB/s in practice.
+FULL_SPEED = LinkProfile(bandwidth_Bps=1e6, latency_s=125e-6, max_transfer=64)
+# Everything arrives in one-to-64-byte pieces, as fast as possible.
+FRAGMENTED = LinkProfile(max_transfer=64, fragment=True)
+
+
+class FakeDevice(object):
+    """
+    Implements the parts of usb.core.Device that Printer uses.
+    Writes are parsed as SOF, cmd, escaped payload, EOF frames and
+    executed by firmware, a DummyPrinter that stores blocks as bytes
+    and simulates prints. Responses and status events are framed
+    and escaped the same way and returned by read.
+
+    When there's nothing to read, read raises a timeout USBError right
+    away rather than waiting out the timeout.
+    """
+    # Successful responses that come back under a different command.
+    DATA_RESPONSES = {Command.CMD_READ_BLOCK: Command.CMD_READ_BLOCK_DATA}
+
+    def __init__(self, firmware=None, profile=None):
+        if firmware is None:
+            firmware = DummyPrinter(speedup=None)
+        if profile is None:
+            profile = LinkProfile()
+        self.firmware = firmware
+        self.profile = profile
+        self.default_timeout = None
+        self._rx = bytearray() # Computer -> printer
+        self._tx = bytearray() # Printer -> computer
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.writes = 0
+        self.reads = 0
+
+    def set_configuration(self):
+        pass
+
+    def _transfer(self, nbytes):
+        dt_s = self.profile.transfer_s(nbytes)
+        if dt_s > 0:
+            time.sleep(dt_s)
+
+    def write(self, endpoint, data, timeout=None):
+        if endpoint != Printer.RX_EP:
+            raise usb.core.USBError('Invalid endpoint 0x{:x}'.format(endpoint),
+                                    errno=errno.EINVAL)
+        data = bytearray(data)
+        self._transfer(len(data))
+        self.writes += 1
+        self.bytes_written += len(data)
+        self._rx += data
+        self._process_rx()
+        return len(data)
+
+    def read(self, endpoint, size, timeout=None):
+        if endpoint != Printer.TX_EP:
+            raise usb.core.USBError('Invalid endpoint 0x{:x}'.format(endpoint),
+                                    errno=errno.EINVAL)
+        self._collect_status()
+        if not self._tx:
+            raise usb.core.USBError('Operation timed out', errno=errno.ETIMEDOUT)
+        n = self.profile.read_size(len(self._tx), size)
+        data = self._tx[:n]
+        del self._tx[:n]
+        self._transfer(n)
+        self.reads += 1
+        self.bytes_read += n
+        return data
+
+    def _process_rx(self):
+        """Executes every complete frame received so far."""
+        while True:
+            try:
+                start = self._rx.index(Printer.SOF)
+                end = self._rx.index(Printer.EOF, start)
+            except ValueError:
+                return
+            frame, self._rx = self._rx[start + 1:end], self._rx[end + 1:]
+            if not frame:
+                continue
+            cmd = Command(frame[0])
+            payload = Printer._decode(frame[1:])
+            # Status events due before the response go out ahead of it,
+            # including those the firmware emits while handling it.
+            self._collect_status()
+            status_buffer = self.firmware.status_buffer
+            self.firmware.status_buffer = []
+            try:
+                result = self.firmware._command(cmd, payload)
+                for event in self.firmware.status_buffer:
+                    self._send_status(*event)
+            finally:
+                self.firmware.status_buffer = status_buffer
+            self._respond(cmd, result)
+
+    def _respond(self, cmd, result):
+        if isinstance(result, (Response, State)):
+            payload = bytearray([result.value])
+        else:
+            cmd = self.DATA_RESPONSES.get(cmd, cmd)
+            payload = bytearray(result)
+        self._send(cmd, payload)
+
+    def _send(self, cmd, payload):
+        self._tx += (bytearray([Printer.SOF, cmd.value]) +
+                     Printer._encode(payload) + bytearray([Printer.EOF]))
+
+    def _collect_status(self):
+        """Frames any status events the firmware has emitted."""
+        for cmd, value in iter(self.firmware.poll, None):
+            self._send_status(cmd, value)
+
+    def _send_status(self, cmd, value):
+        payload = b'' if value is None else struct.pack('<I', value)
+        self._send(cmd, bytearray(payload))
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
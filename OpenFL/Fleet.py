@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Fleet.py
+
+Drive every connected Form 1/1+ at once.
+
+    >>> from OpenFL import Fleet, FLP
+    >>> fleet = Fleet.Fleet()      # Every printer on the USB bus
+    >>> fleet.serial_numbers()
+    >>> result = fleet.write_block(0, FLP.fromfile('layer.flp'))
+    >>> print(result.MBps)
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import time
+from multiprocessing.pool import ThreadPool
+
+import usb.core
+
+from OpenFL import FLP, Printer
+
+
+class FleetResult(dict):
+    """
+    The result of running one operation on every printer:
+    a dict from serial number to that printer's return value.
+    Printers that raised map to the exception instead.
+    For uploads, nbytes is the total transferred and
+    seconds is the wall-clock time for the whole fleet.
+    """
+    def __init__(self, results, seconds, nbytes=0):
+        super(FleetResult, self).__init__(results)
+        self.seconds = seconds
+        self.nbytes = nbytes
+
+    @property
+    def errors(self):
+        return dict((serial, r) for serial, r in self.items()
+                    if isinstance(r, Exception))
+
+    @property
+    def MBps(self):
+        """Aggregate throughput in MB/s."""
+        return self.nbytes / 1e6 / self.seconds if self.seconds else float('inf')
+
+    def raise_errors(self):
+        """Raise the first exception, if any printer failed."""
+        for serial, e in sorted(self.errors.items()):
+            raise e
+        return self
+
+
+class Fleet(object):
+    """
+    A set of printers, identified by serial number.
+    By default, connects to every printer with the Form 1/1+ VID and PID;
+    printers may instead be a list of Printer objects (e.g. DummyPrinters).
+    Operations run on all printers in parallel on a thread pool, since
+    each one spends its time waiting on USB.
+    """
+    def __init__(self, printers=None, threads=None):
+        if printers is None:
+            printers = [Printer.Printer(dev=dev) for dev in
+                        usb.core.find(find_all=True,
+                                      idVendor=Printer.Printer.VID,
+                                      idProduct=Printer.Printer.PID)]
+        self.printers = dict((p.serial_number(), p) for p in printers)
+        if len(self.printers) != len(printers):
+            raise RuntimeError('Printers must have distinct serial numbers.')
+        self.pool = ThreadPool(threads or max(1, len(self.printers)))
+
+    def __len__(self):
+        return len(self.printers)
+
+    def __getitem__(self, serial):
+        return self.printers[serial]
+
+    def serial_numbers(self):
+        return sorted(self.printers)
+
+    def map(self, function, serials=None, nbytes=0):
+        """
+        Call function(printer) on each printer (or just those in serials)
+        in parallel, returning a FleetResult.
+        """
+        if serials is None:
+            serials = self.serial_numbers()
+        def run(serial):
+            try:
+                return serial, function(self.printers[serial])
+            except Exception as e:
+                return serial, e
+        start = time.time()
+        results = self.pool.map(run, serials)
+        return FleetResult(results, time.time() - start, nbytes * len(serials))
+
+    def write_block(self, block, data, serials=None):
+        """
+        Upload one block to every printer.
+        data is a bytearray, filename, or FLP.Packets object,
+        which is serialized (and audited) once for the whole fleet.
+        """
+        if isinstance(data, FLP.Packets):
+            for p in self.printers.values():
+                if p.AUDIT_LASER_POWER:
+                    p.audit_laser_power_flp(data)
+            data = bytearray(data.tostring())
+            skip_audit = True
+        else:
+            if not isinstance(data, bytearray):
+                data = bytearray(open(data, 'rb').read())
+            skip_audit = False
+        return self.map(lambda p: p.write_block(block, data, skip_audit=skip_audit),
+                        serials, nbytes=len(data))
+
+    def write_blocks(self, blocks, serials=None):
+        """
+        Upload many blocks, given as a dict or list of (block, data) pairs,
+        to every printer. data is as for write_block; files are read once.
+        Each printer uploads its blocks in order while the printers run
+        in parallel.
+        """
+        if isinstance(blocks, dict):
+            blocks = sorted(blocks.items())
+        blocks = [(block, data if isinstance(data, (FLP.Packets, bytearray))
+                   else bytearray(open(data, 'rb').read()))
+                  for block, data in blocks]
+        nbytes = sum(len(data.tostring()) if isinstance(data, FLP.Packets) else len(data)
+                     for _, data in blocks)
+        def upload(p):
+            for block, data in blocks:
+                p.write_block(block, data)
+        return self.map(upload, serials, nbytes=nbytes)
+
+    def initialize(self, serials=None):
+        return self.map(lambda p: p.initialize(), serials)
+
+    def delete_block(self, block, end=None, serials=None):
+        return self.map(lambda p: p.delete_block(block, end), serials)
+
+    def list_blocks(self, serials=None):
+        return self.map(lambda p: p.list_blocks(), serials)
+
+    def state(self, serials=None):
+        return self.map(lambda p: p.state(), serials)
+
+    def start_printing(self, block, end=None, serials=None):
+        return self.map(lambda p: p.start_printing(block, end), serials)
+
+    def close(self):
+        self.pool.close()
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Live.py
+
+Stream motion to a printer as it's generated, with the firmware
+keeping time.
+
+Commands like Printer.move_z and Printer.set_laser_uint16 each take a
+USB round trip, so anything played through them (music, interactive
+drawing) jitters with the host. A Stream instead collects packets into
+short blocks and takes turns between a few block slots: while one block
+prints, the next is written to another slot, and it starts as soon as
+the printer reports the first one done.
+
+    >>> from OpenFL import Live, FLP
+    >>> stream = Live.Stream(printer, first_block=100)
+    >>> stream.extend([FLP.ZFeedRate(4000), FLP.ZMove(800), FLP.WaitForMovesToComplete()])
+    >>> stream.dwell(0.25)
+    >>> stream.finish()
+
+Within a block, timing is the firmware's; the host only has to keep the
+next block written before the current one finishes, so latency is
+about block_s. Motor feed rates and currents carry over between blocks,
+as they do between the layers of a print.
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import collections
+import time
+
+from OpenFL import FLP, Timing
+from OpenFL.Printer import Command
+
+
+class Stream(object):
+    """
+    Sends packets to printer in blocks of about block_s seconds
+    (by Timing's estimate), taking turns between slots block slots
+    numbered from first_block. Blocks are written as soon as there's a
+    free slot and started in order; anything in those slots is overwritten.
+
+    While a stream is running, only poll the printer through it:
+    any other command could swallow its status packets. (The stream
+    keeps the ones that arrive during its own commands; see
+    Printer.status_buffer.) Polls wait at most poll_timeout_ms.
+    """
+    def __init__(self, printer, first_block=0, slots=2, block_s=0.1,
+                 poll_timeout_ms=10, poll_interval_s=0.001):
+        if slots < 2:
+            raise ValueError('A stream needs at least two slots.')
+        self.printer = printer
+        self.slots = [first_block + i for i in range(slots)]
+        self.block_s = block_s
+        self.poll_timeout_ms = poll_timeout_ms
+        self.poll_interval_s = poll_interval_s
+        self.events = []
+        self.blocks_sent = 0
+        self._pending = FLP.Packets()
+        self._clock = Timing.PrintClock()
+        self._pending_start_s = 0.0
+        self._loaded = collections.deque() # Written, waiting to start.
+        self._held = [] # Status packets received during commands.
+        self._running = None
+        self._next_slot = 0
+
+    @property
+    def running(self):
+        """True while a block is printing or waiting to start."""
+        return self._running is not None or bool(self._loaded)
+
+    def append(self, packet):
+        """Queue a packet, sending a block once block_s of them are queued."""
+        self._pending.append(packet)
+        if self._clock.step(packet) - self._pending_start_s >= self.block_s:
+            self.flush()
+
+    def extend(self, packets):
+        for packet in packets:
+            self.append(packet)
+
+    def move_z(self, usteps, feedrate=None):
+        """Queue a Z move, at feedrate usteps/s if given, and wait for it."""
+        if feedrate is not None:
+            self.append(FLP.ZFeedRate(int(feedrate)))
+        self.extend([FLP.ZMove(int(usteps)), FLP.WaitForMovesToComplete()])
+
+    def move_tilt(self, usteps, feedrate=None):
+        """Queue a tilt move, at feedrate usteps/s if given, and wait for it."""
+        if feedrate is not None:
+            self.append(FLP.TiltFeedRate(int(feedrate)))
+        self.extend([FLP.TiltMove(int(usteps)), FLP.WaitForMovesToComplete()])
+
+    def move_laser(self, points, power):
+        """Queue an XYMove through points (x, y, dt) at power."""
+        self.extend([FLP.LaserPowerLevel(power), FLP.XYMove(points)])
+
+    def dwell(self, s):
+        self.append(FLP.Dwell(s=s))
+
+    def flush(self):
+        """Send whatever is queued as a block, waiting for a free slot."""
+        if not self._pending:
+            return
+        # The firmware waits for motor moves at the end of a block.
+        self._pending_start_s = self._clock.wait()
+        while len(self._loaded) + (self._running is not None) >= len(self.slots):
+            self._wait()
+        slot = self.slots[self._next_slot]
+        self._next_slot = (self._next_slot + 1) % len(self.slots)
+        self._command(self.printer.write_block, slot, self._pending)
+        self._pending = FLP.Packets()
+        self._loaded.append(slot)
+        self.blocks_sent += 1
+        self.update()
+
+    def update(self):
+        """
+        Collect status packets, starting the next block once the
+        last has finished. Returns the packets received.
+        """
+        p = self.printer
+        timeout_ms = p.timeout_ms
+        p.timeout_ms = self.poll_timeout_ms
+        try:
+            events = list(iter(p.poll, None))
+        finally:
+            p.timeout_ms = timeout_ms
+        events = self._held + events
+        self._held = []
+        self.events.extend(events)
+        if any(cmd == Command.STATUS_PRINT_DONE for cmd, _ in events):
+            self._running = None
+        if self._running is None and self._loaded:
+            self._running = self._loaded.popleft()
+            self._command(p.start_printing, self._running)
+        return events
+
+    def _command(self, method, *args):
+        """
+        Call a printer method, keeping the status packets that arrive
+        while it waits for its response for the next update.
+        """
+        status_buffer = self.printer.status_buffer
+        self.printer.status_buffer = self._held
+        try:
+            return method(*args)
+        finally:
+            self.printer.status_buffer = status_buffer
+
+    def _wait(self):
+        if not self.update():
+            time.sleep(self.poll_interval_s)
+
+    def finish(self):
+        """Send anything queued and wait until it has all printed."""
+        self.flush()
+        while self.running:
+            self._wait()
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Material.py
+
+Read material files (e.g. Form_1+_FLGPCL02_100.ini; see
+material_file_description.md) and retune existing prints to new
+material settings without re-slicing:
+
+    >>> from OpenFL import Material, Printer, FLP
+    >>> old = Material.Material('Form_1+_FLGPCL02_100.ini')
+    >>> new = old.copy()
+    >>> new['fill']['modellaserpowermw'] = 55
+    >>> new['fill']['modelxyfeedrate'] = 1400
+    >>> blocks, counts = Material.retune(FLP.fromfile('print.flp'), old, new, Printer.Printer())
+
+Each laser exposure is matched to the [perimeter] or [fill] setting
+(base, model or support) the print was sliced with, by power and speed,
+and gets that setting's new power and speed.
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import collections
+import copy
+
+try:
+    import configparser
+except ImportError: # Python 2
+    import ConfigParser as configparser
+
+import numpy as np
+
+from OpenFL import FLP
+
+try: # Since python3 doesn't have basestring:
+    basestring
+except NameError:
+    basestring = str
+
+# Nominal galvo scale, as in examples/image_to_laser_moves.py.
+MM_PER_TICK = 125.0 / 0xffff
+EXPOSURE_SECTIONS = ('perimeter', 'fill')
+REGIONS = ('base', 'model', 'support')
+# Tilt move roles, in the order they appear in a peel.
+TILT_ROLES = ('down', 'up', 'upslow')
+
+
+class Material(object):
+    """
+    A material file. Index by section, then (lower-case) option:
+        material['fill']['modellaserpowermw'] == 62.0
+    Numbers are floats; anything else is left as a string.
+    """
+    def __init__(self, fileHandle=None):
+        self.sections = collections.OrderedDict()
+        if fileHandle is None:
+            return
+        try:
+            parser = configparser.RawConfigParser(inline_comment_prefixes=(';',))
+        except TypeError: # Python 2 strips ' ;' comments itself.
+            parser = configparser.RawConfigParser()
+        if isinstance(fileHandle, basestring):
+            with open(fileHandle) as fh:
+                getattr(parser, 'read_file', getattr(parser, 'readfp', None))(fh)
+        else:
+            getattr(parser, 'read_file', getattr(parser, 'readfp', None))(fileHandle)
+        for section in parser.sections():
+            self.sections[section] = collections.OrderedDict(
+                (option, _number(value)) for option, value in parser.items(section))
+
+    def __getitem__(self, section):
+        return self.sections[section]
+
+    def copy(self):
+        result = Material()
+        result.sections = copy.deepcopy(self.sections)
+        return result
+
+    def exposures(self):
+        """Return {(section, region): (mW, mm/s)}, e.g. ('fill', 'model')."""
+        return dict(((section, region),
+                     (self[section][region + 'laserpowermw'],
+                      self[section][region + 'xyfeedrate']))
+                    for section in EXPOSURE_SECTIONS for region in REGIONS)
+
+    def tilt_velocity_mm_s(self, layer, role):
+        """The tilt speed for a role in TILT_ROLES on the given layer."""
+        routine = self['btwnLayerRoutine']
+        peel = 'p1' if layer is not None and layer <= routine['earlytimespeel'] else 'p2'
+        return routine['{}{}vel'.format(peel, role)]
+
+def _number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _classify(mW, mm_s, exposures):
+    """The exposure (section, region) nearest in log power and log speed."""
+    def distance(key):
+        mW0, mm_s0 = exposures[key]
+        return abs(np.log(mW / mW0)) + abs(np.log(mm_s / mm_s0))
+    return min(sorted(exposures), key=distance)
+
+
+def _split_long_rows(xy, dt, prev):
+    """
+    Split rows whose dt exceeds 0xffff ticks into equal pieces along the
+    line from the previous point. Returns (xy, dt, index of the original
+    row for each new row).
+    """
+    pieces = np.maximum(1, -(-dt // 0xffff))
+    row = np.repeat(np.arange(len(dt)), pieces)
+    if len(row) == len(dt):
+        return xy, dt, row
+    # k is which piece of its row each new row is, from 1 to pieces.
+    k = np.arange(len(row)) - np.repeat(np.cumsum(pieces) - pieces, pieces) + 1
+    alpha = (k / pieces[row])[:, None]
+    newXY = np.round(prev[row] + (xy[row] - prev[row]) * alpha).astype(np.int64)
+    newDt = dt[row] // pieces[row] + (k <= dt[row] % pieces[row])
+    return newXY, newDt, row
+
+
+def retune(blocks, old, new, printer, z_feedrate_scale=1.0, mm_per_tick=MM_PER_TICK):
+    """
+    Apply new material settings to a print sliced with old ones.
+    blocks is an FLP.Packets object or a list of them; the input is left unchanged.
+    printer provides the laser calibration (ticks_to_mW, mW_to_ticks)
+    and audits the result, raising Printer.LaserPowerError if it's unsafe.
+
+    * Each LaserPowerLevel, with the XYMoves it powers, is matched to the
+      nearest old [perimeter]/[fill] setting. Its power is set to the new
+      setting's mW and the XYMove dt ticks are scaled by the speed ratio;
+      rows longer than 0xffff ticks are split. Laser-off moves are unchanged.
+    * Each TiltFeedRate is scaled by the ratio of the new to old p1/p2
+      speed for the first TiltMove it drives (down, up or upslow).
+    * The material file has no Z speeds, so ZFeedRates are scaled by
+      z_feedrate_scale.
+
+    Returns (retuned blocks in the same shape,
+             collections.Counter of exposures matched per (section, region)).
+    """
+    single = isinstance(blocks, FLP.Packets)
+    if single:
+        blocks = [blocks]
+    packets = [p for block in blocks for p in block]
+    oldExposures = old.exposures()
+    newExposures = new.exposures()
+
+    # Which LaserPowerLevel (by packet index) powers each XYMove; -1 if off.
+    moves, moveRuns = [], []
+    run = -1
+    for i, p in enumerate(packets):
+        if isinstance(p, FLP.LaserPowerLevel):
+            run = i if p.power > 0 else -1
+        elif isinstance(p, FLP.XYMove) and p.npoints:
+            moves.append(i)
+            moveRuns.append(run)
+    replacements = {}
+    counts = collections.Counter()
+    if moves:
+        moveSizes = np.array([packets[i].npoints for i in moves])
+        points = np.array([row for i in moves for row in packets[i]._points], dtype=np.int64)
+        xy, dt = points[:, :2], points[:, 2]
+        prev = np.vstack([xy[:1], xy[:-1]])
+        rowRun = np.repeat(moveRuns, moveSizes)
+
+        # Measure each run's speed, then pick its exposure setting.
+        runs, rowRunIndex = np.unique(rowRun, return_inverse=True)
+        # Rows that don't move (dwells at a point) don't count towards speed.
+        segment_mm = np.hypot(*(xy - prev).T) * mm_per_tick
+        length_mm = np.bincount(rowRunIndex, segment_mm)
+        time_s = (np.bincount(rowRunIndex, dt * (segment_mm > 0)) /
+                  FLP.XYMoveClockRate.moverate_Hz())
+        ratios = np.ones(len(runs))
+        for j, run in enumerate(runs):
+            if run < 0 or time_s[j] == 0 or length_mm[j] == 0:
+                continue
+            mW = printer.ticks_to_mW(packets[run].power)
+            key = _classify(mW, length_mm[j] / time_s[j], oldExposures)
+            counts[key] += 1
+            newmW, newmm_s = newExposures[key]
+            ratios[j] = oldExposures[key][1] / newmm_s
+            replacements[run] = FLP.LaserPowerLevel(int(round(printer.mW_to_ticks(newmW))))
+
+        newDt = np.round(dt * ratios[rowRunIndex]).astype(np.int64)
+        newXY, newDt, row = _split_long_rows(xy, newDt, prev)
+        rowMove = np.repeat(np.arange(len(moves)), moveSizes)
+        newCounts = np.bincount(rowMove[row], minlength=len(moves))
+        rows = np.hstack([newXY, newDt[:, None]]).tolist()
+        start = 0
+        for i, n in zip(moves, newCounts):
+            move = FLP.XYMove()
+            move.points = [tuple(r) for r in rows[start:start + n]]
+            replacements[i] = move
+            start += n
+
+    # Motor feed rates.
+    layer = None
+    tiltRate = None # index of the TiltFeedRate in effect
+    roles = []
+    for i, p in enumerate(packets):
+        if isinstance(p, FLP.LayerStart):
+            layer = p.layernumber
+            roles = []
+        elif isinstance(p, FLP.ZFeedRate) and z_feedrate_scale != 1:
+            replacements[i] = FLP.ZFeedRate(int(round(p.feedrate * z_feedrate_scale)))
+        elif isinstance(p, FLP.TiltFeedRate):
+            tiltRate = i
+        elif isinstance(p, FLP.TiltMove) and p.usteps != 0:
+            role = 'down' if p.usteps > 0 else ('upslow' if 'up' in roles else 'up')
+            roles.append(role)
+            if tiltRate is not None and tiltRate not in replacements:
+                ratio = new.tilt_velocity_mm_s(layer, role) / old.tilt_velocity_mm_s(layer, role)
+                replacements[tiltRate] = FLP.TiltFeedRate(
+                    int(round(packets[tiltRate].feedrate * ratio)))
+
+    result = []
+    i = 0
+    for block in blocks:
+        out = FLP.Packets(replacements.get(j, p) for j, p in enumerate(block, i))
+        i += len(block)
+        printer.audit_laser_power_flp(out)
+        result.append(out)
+    return (result[0] if single else result), counts
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
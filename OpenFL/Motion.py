@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Motion.py
+
+Let Z and tilt moves overlap where it's safe.
+
+Layer transitions (and makeHomingSequence) put a WaitForMovesToComplete
+after every move, so the Z and tilt motors never run at the same time.
+plan_motion removes the barriers between a move on one motor and a move
+on the other when a declared rule says the second may start while the
+first is still running:
+
+    >>> from OpenFL import Motion
+    >>> blocks, plans = Motion.plan_motion(blocks)
+    >>> print(Motion.format_plans(plans))
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import collections
+
+from OpenFL import FLP, Timing
+
+# Move directions. Z up (positive usteps) lifts the platform away from
+# the tank; tilt down (positive usteps) drops the tank away from the part.
+Z_UP = 'z up'
+Z_DOWN = 'z down'
+TILT_UP = 'tilt up'
+TILT_DOWN = 'tilt down'
+
+# A rule (first, second) allows a second move to start while the first
+# is still running. By default, only the tank may come back up while the
+# platform rises: by then the part has been peeled, and the platform only
+# widens the gap.
+DEFAULT_RULES = frozenset([(Z_UP, TILT_UP)])
+
+_MOTORS = ((FLP.ZMove, 'z'), (FLP.ZFeedRate, 'z'), (FLP.ZCurrent, 'z'),
+           (FLP.TiltMove, 'tilt'), (FLP.TiltFeedRate, 'tilt'), (FLP.TiltCurrent, 'tilt'))
+
+LayerPlan = collections.namedtuple('LayerPlan', ['layer', 'original_s', 'planned_s',
+                                                 'barriers_removed'])
+
+
+def _motor(packet):
+    """'z' or 'tilt' for packets addressed to one motor, else None."""
+    for cls, motor in _MOTORS:
+        if isinstance(packet, cls):
+            return motor
+    return None
+
+def direction(move):
+    """The direction (Z_UP, etc.) of a ZMove or TiltMove."""
+    if isinstance(move, FLP.ZMove):
+        return Z_UP if move.usteps > 0 else Z_DOWN
+    return TILT_DOWN if move.usteps > 0 else TILT_UP
+
+
+def _can_overlap(before, after, rules):
+    """
+    Whether the barrier between before and after can go: after must
+    only command one motor, which before doesn't move, and every pair of
+    moves must be allowed by rules.
+    """
+    motors = set(_motor(p) for p in after)
+    if len(motors) != 1 or None in motors:
+        return False # Dwells, laser moves etc. must keep waiting.
+    beforeMoves = [p for p in before if isinstance(p, FLP.MotorMoveCommand)]
+    afterMoves = [p for p in after if isinstance(p, FLP.MotorMoveCommand)]
+    if not beforeMoves or not afterMoves:
+        return False
+    if motors & set(_motor(p) for p in beforeMoves):
+        return False
+    return all((direction(a), direction(b)) in rules
+               for a in beforeMoves for b in afterMoves)
+
+
+def plan_layer(layer, rules=DEFAULT_RULES):
+    """
+    Return (packets, number of barriers removed) for one layer's packets.
+    A barrier is only removed if another one follows it in the layer,
+    so every layer still ends with its motors stopped.
+    """
+    # Split into runs of packets separated by WaitForMovesToComplete.
+    runs = [[]]
+    for packet in layer:
+        if isinstance(packet, FLP.WaitForMovesToComplete):
+            runs.append([])
+        else:
+            runs[-1].append(packet)
+    result = FLP.Packets()
+    removed = 0
+    current = runs[0]
+    for i, run in enumerate(runs[1:]):
+        followedByBarrier = i + 2 < len(runs)
+        if followedByBarrier and _can_overlap(current, run, rules):
+            current = current + run
+            removed += 1
+        else:
+            result.extend(current)
+            result.append(FLP.WaitForMovesToComplete())
+            current = run
+    result.extend(current)
+    return result, removed
+
+
+def plan_motion(blocks, rules=DEFAULT_RULES):
+    """
+    Remove the barriers rules allow from every layer of a print.
+    blocks is an FLP.Packets object or a list of them, split into layers
+    at each LayerStart; the input is left unchanged.
+    Returns (planned blocks in the same shape, list of LayerPlans with
+    each layer's predicted time before and after).
+    """
+    single = isinstance(blocks, FLP.Packets)
+    if single:
+        blocks = [blocks]
+    originalClock = Timing.PrintClock()
+    plannedClock = Timing.PrintClock()
+    result = []
+    plans = []
+    for block in blocks:
+        out = FLP.Packets()
+        for layer in block.layers():
+            planned, removed = plan_layer(layer, rules)
+            start = layer[0]
+            plans.append(LayerPlan(start.layernumber if isinstance(start, FLP.LayerStart) else None,
+                                   Timing.duration_s(layer, originalClock),
+                                   Timing.duration_s(planned, plannedClock),
+                                   removed))
+            out.extend(planned)
+        result.append(out)
+    return (result[0] if single else result), plans
+
+
+def format_plans(plans):
+    """A table of per-layer times before and after plan_motion, with totals."""
+    lines = ['{:>6} {:>8} {:>10} {:>10} {:>8}'.format('layer', 'barriers',
+                                                       'before_s', 'after_s', 'saved_s')]
+    for p in plans:
+        lines.append('{:>6} {:>8} {:>10.2f} {:>10.2f} {:>8.2f}'.format(
+            '-' if p.layer is None else p.layer, -p.barriers_removed,
+            p.original_s, p.planned_s, p.original_s - p.planned_s))
+    before_s = sum(p.original_s for p in plans)
+    after_s = sum(p.planned_s for p in plans)
+    lines.append('{:>6} {:>8} {:>10.2f} {:>10.2f} {:>8.2f}'.format(
+        'total', -sum(p.barriers_removed for p in plans), before_s, after_s,
+        before_s - after_s))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Peel.py
+
+Shorten the peel cycle on layers with small cross-sections.
+
+Every layer of a print normally gets the same peel: the tilt moves and
+feed rates of the p1/p2 settings and the squish wait before the next
+layer (see material_file_description.md). The suction the peel has to
+break grows with the cured area, so layers that expose little resin can
+peel less far, faster, and settle sooner:
+
+    >>> from OpenFL import Peel
+    >>> blocks, savings = Peel.optimize_peel(blocks, Peel.PeelBounds(full_area_mm2=1000))
+    >>> print(Peel.format_savings(savings))
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import collections
+import copy
+
+import numpy as np
+
+from OpenFL import FLP, Timing
+
+# Nominal galvo scale, as in examples/image_to_laser_moves.py.
+MM_PER_TICK = 125.0 / 0xffff
+# ScanlineSpacing in Form_1+_FLGPCL02_100.ini
+LINE_WIDTH_MM = 0.09
+
+LayerSavings = collections.namedtuple('LayerSavings',
+                                      ['layer', 'area_mm2', 'fraction',
+                                       'original_s', 'optimized_s'])
+
+
+class PeelBounds(object):
+    """
+    Limits on how far optimize_peel may change a layer's peel.
+    A layer exposing full_area_mm2 or more keeps its original peel;
+    smaller layers are interpolated linearly (by exposed area) from the
+    original towards these limits, reached at zero area:
+        min_peel_scale: fraction of the original tilt distance
+        max_feedrate_scale: multiple of the original tilt feed rates,
+                            never above max_tilt_feedrate (usteps/s) if given
+        min_squish_scale: fraction of the original squish wait,
+                          never below min_squish_s
+    Layers numbered below first_layer (e.g. earlytimespeel) are untouched.
+    """
+    def __init__(self, full_area_mm2=2000.0, min_peel_scale=0.5,
+                 max_feedrate_scale=2.0, max_tilt_feedrate=None,
+                 min_squish_scale=0.25, min_squish_s=0.25, first_layer=0):
+        if not 0 < min_peel_scale <= 1:
+            raise ValueError('min_peel_scale must be in (0, 1]')
+        if max_feedrate_scale < 1:
+            raise ValueError('max_feedrate_scale must be at least 1')
+        if not 0 <= min_squish_scale <= 1:
+            raise ValueError('min_squish_scale must be in [0, 1]')
+        self.full_area_mm2 = full_area_mm2
+        self.min_peel_scale = min_peel_scale
+        self.max_feedrate_scale = max_feedrate_scale
+        self.max_tilt_feedrate = max_tilt_feedrate
+        self.min_squish_scale = min_squish_scale
+        self.min_squish_s = min_squish_s
+        self.first_layer = first_layer
+
+
+class _Laser(object):
+    """Laser position and power, carried from packet to packet."""
+    def __init__(self):
+        self.xy_ticks = None
+        self.power = 0
+
+    def exposed_length_ticks(self, packets):
+        result = 0.0
+        for packet in packets:
+            if isinstance(packet, FLP.LaserPowerLevel):
+                self.power = packet.power
+            elif isinstance(packet, FLP.XYMove) and packet.npoints:
+                xy = np.array(packet._points, dtype=float)[:, :2]
+                if self.power > 0:
+                    path = xy if self.xy_ticks is None else np.vstack([self.xy_ticks, xy])
+                    result += np.hypot(*np.diff(path, axis=0).T).sum()
+                self.xy_ticks = xy[-1]
+        return result
+
+
+def exposed_area_mm2(packets, mm_per_tick=MM_PER_TICK, line_width_mm=LINE_WIDTH_MM):
+    """
+    Estimate the area a list of packets cures: the length of the
+    laser-on XYMove paths times line_width_mm. Repeated passes count
+    again, which only makes optimize_peel more conservative.
+    """
+    return _Laser().exposed_length_ticks(packets) * mm_per_tick * line_width_mm
+
+
+def _scale_tilt_moves(moves, scale):
+    """
+    Shorten the tilt-down (positive) moves by scale, taking the same
+    distance off the largest tilt-up moves, so the net displacement
+    (and the overdrive into the hard stop) is unchanged.
+    """
+    ups = sorted((m for m in moves if m.usteps < 0), key=lambda m: m.usteps)
+    available = -sum(m.usteps for m in ups)
+    removed = 0
+    for m in moves:
+        if m.usteps > 0:
+            take = min(m.usteps - int(round(m.usteps * scale)), available - removed)
+            m.usteps -= take
+            removed += take
+    for m in ups:
+        take = min(removed, -m.usteps)
+        m.usteps += take
+        removed -= take
+
+
+def _optimize_layer(layer, fraction, bounds):
+    """Return a copy of layer with its peel scaled for the given area fraction."""
+    # Copy the packets we change.
+    layer = [copy.copy(p) if isinstance(p, (FLP.TiltMove, FLP.TiltFeedRate, FLP.Dwell)) else p
+             for p in layer]
+    peel_scale = bounds.min_peel_scale + (1 - bounds.min_peel_scale) * fraction
+    feedrate_scale = bounds.max_feedrate_scale - (bounds.max_feedrate_scale - 1) * fraction
+    squish_scale = bounds.min_squish_scale + (1 - bounds.min_squish_scale) * fraction
+
+    tiltMoves = [p for p in layer if isinstance(p, FLP.TiltMove)]
+    _scale_tilt_moves(tiltMoves, peel_scale)
+    peeling = False
+    for p in layer:
+        if isinstance(p, FLP.TiltFeedRate):
+            feedrate = int(round(p.feedrate * feedrate_scale))
+            if bounds.max_tilt_feedrate is not None:
+                feedrate = min(feedrate, max(p.feedrate, bounds.max_tilt_feedrate))
+            p.usteps_per_s = feedrate
+        elif isinstance(p, FLP.TiltMove):
+            peeling = True
+        elif isinstance(p, FLP.Dwell) and peeling:
+            # Waits after the peel starts are squish waits;
+            # the cure wait before it is left alone.
+            if p.duration_s > bounds.min_squish_s:
+                p.data = int(max(p.duration_ms * squish_scale, bounds.min_squish_s * 1000))
+    return FLP.Packets(layer)
+
+
+def optimize_peel(blocks, bounds=None, mm_per_tick=MM_PER_TICK,
+                  line_width_mm=LINE_WIDTH_MM):
+    """
+    Scale each layer's peel cycle by its exposed area, within bounds
+    (a PeelBounds; by default PeelBounds()).
+    blocks is an FLP.Packets object or a list of them, split into layers
+    at each LayerStart; the input is left unchanged.
+    Returns (optimized blocks in the same shape, list of LayerSavings).
+    """
+    if bounds is None:
+        bounds = PeelBounds()
+    single = isinstance(blocks, FLP.Packets)
+    if single:
+        blocks = [blocks]
+    laser = _Laser()
+    originalClock = Timing.PrintClock()
+    optimizedClock = Timing.PrintClock()
+    result = []
+    savings = []
+    for block in blocks:
+        out = FLP.Packets()
+        for layer in block.layers():
+            start = layer[0]
+            number = start.layernumber if isinstance(start, FLP.LayerStart) else None
+            area_mm2 = (laser.exposed_length_ticks(layer) *
+                        mm_per_tick * line_width_mm)
+            fraction = min(1.0, area_mm2 / bounds.full_area_mm2)
+            if number is not None and number >= bounds.first_layer and fraction < 1:
+                optimized = _optimize_layer(layer, fraction, bounds)
+            else:
+                fraction = 1.0
+                optimized = FLP.Packets(layer)
+            savings.append(LayerSavings(number, area_mm2, fraction,
+                                        Timing.duration_s(layer, originalClock),
+                                        Timing.duration_s(optimized, optimizedClock)))
+            out.extend(optimized)
+        result.append(out)
+    return (result[0] if single else result), savings
+
+
+def format_savings(savings):
+    """A table of per-layer times before and after optimize_peel, with totals."""
+    lines = ['{:>6} {:>10} {:>10} {:>10} {:>8}'.format('layer', 'area_mm2',
+                                                        'before_s', 'after_s', 'saved_s')]
+    for s in savings:
+        lines.append('{:>6} {:>10.1f} {:>10.2f} {:>10.2f} {:>8.2f}'.format(
+            '-' if s.layer is None else s.layer, s.area_mm2,
+            s.original_s, s.optimized_s, s.original_s - s.optimized_s))
+    before_s = sum(s.original_s for s in savings)
+    after_s = sum(s.optimized_s for s in savings)
+    lines.append('{:>6} {:>10} {:>10.2f} {:>10.2f} {:>8.2f}'.format(
+        'total', '', before_s, after_s, before_s - after_s))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
@@ -28,7 +28,7 @@ import time
 import usb.core
 import numpy as np
 
-from OpenFL import FLP
+from OpenFL import FLP, Timing, Capture
 
 ################################################################################
 
@@ -57,11 +57,16 @@ class Printer(object):
     AUDIT_LASER_POWER = True
     LASER_POWER_MAX_MW = 64
 
-    def __init__(self, connect=True, timeout_ms=10000):
-        if connect:
-            self.dev = usb.core.find(idVendor=self.VID, idProduct=self.PID)
-            if self.dev is None:
-                raise RuntimeError("Could not find printer")
+    def __init__(self, connect=True, timeout_ms=10000, dev=None):
+        """ Connects to the first Form 1/1+ found, or to dev if given
+            (a usb.core.Device or a stand-in such as FakeUSB.FakeDevice).
+        """
+        if connect or dev is not None:
+            if dev is None:
+                dev = usb.core.find(idVendor=self.VID, idProduct=self.PID)
+                if dev is None:
+                    raise RuntimeError("Could not find printer")
+            self.dev = dev
             self.dev.default_timeout = 100
             try:
                 self.dev.set_configuration()
@@ -71,6 +76,9 @@ class Printer(object):
         self.timeout_ms = timeout_ms
         self.incoming = []
         self.packet = bytearray()
+        self.recorder = None # See start_recording
+        self.status_buffer = None # See _wait_for_packet
+        self.block_cache = None # See enable_block_cache
 
         # These values are loaded from the printer as-needed
         self._laser_table = None
@@ -79,13 +87,40 @@ class Printer(object):
     def _read(self, bufsize=1024):
         """ Reads raw data from the printer's usual endpoint
         """
-        return bytearray(self.dev.read(self.TX_EP, bufsize, timeout=self.timeout_ms))
+        try:
+            data = bytearray(self.dev.read(self.TX_EP, bufsize, timeout=self.timeout_ms))
+        except usb.core.USBError as e:
+            # Replays need to time out at the same points.
+            if self.recorder is not None and e.errno == errno.ETIMEDOUT:
+                self.recorder.record(Capture.TIMEOUT, b'')
+            raise
+        if self.recorder is not None:
+            self.recorder.record(Capture.READ, data)
+        return data
 
     def _write(self, data):
         """ Writes raw data to the printer's usual endpoint
         """
+        if self.recorder is not None:
+            self.recorder.record(Capture.WRITE, data)
         return self.dev.write(self.RX_EP, data, timeout=self.timeout_ms)
 
+    def start_recording(self, fileHandle):
+        """ Logs every raw USB transfer, with timestamps, to a capture file
+            (a file name or binary file) until stop_recording is called.
+            The capture can be played back with Capture.ReplayDevice.
+        """
+        self.stop_recording()
+        self.recorder = Capture.CaptureWriter(fileHandle)
+        return self.recorder
+
+    def stop_recording(self):
+        """ Stops and closes any recording started by start_recording.
+        """
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
     @classmethod
     def _decode(cls, received):
         """ Strips the escape characters from streamed data
@@ -142,11 +177,12 @@ class Printer(object):
         self.packet += data
 
         # Trim data off the front until we find a SOF character
-        while self.packet[0] != self.SOF:
+        while self.packet and self.packet[0] != self.SOF:
             self.packet.pop(0)
 
         # Process the packet, loading data into self.incoming
-        while self.packet:
+        # (a transfer may end anywhere, even right after the SOF)
+        while len(self.packet) >= 2:
             cmd = Command(self.packet[1])
 
             # If the packet contains an EOF character, then read in the
@@ -159,7 +195,8 @@ class Printer(object):
                 self.incoming.append(
                         (cmd, self._interpret(cmd, self._decode(p))))
 
-    def _command(self, cmd, payload=b'', wait=True, expect_success=False, verbose=False):
+    def _command(self, cmd, payload=b'', wait=True, expect_success=False, verbose=False,
+                 bufsize=1024):
         """ Transmits a command to the printer
             The command is wrapped in the form SOF, cmd, encode(payload), EOF
 
@@ -167,6 +204,7 @@ class Printer(object):
                 (in the form of a returned packet with cmd)
             wait can also be a list of valid returned packet Commands
                 (for commands with multiple return options)
+            bufsize is the USB read size used while waiting
 
             If expect_success is True and the returned response is not SUCCESS,
             raises a BadResponse error with the Response code.
@@ -177,22 +215,24 @@ class Printer(object):
             wait = [cmd]
 
         if wait:
-            r = self._wait_for_packet(wait, verbose=verbose)
+            r = self._wait_for_packet(wait, verbose=verbose, bufsize=bufsize)
             if expect_success and r != Response.SUCCESS:
                 raise BadResponse(r)
             return r
         else:
             return None
 
-    def _wait_for_packet(self, cmd, verbose=True):
+    def _wait_for_packet(self, cmd, verbose=True, bufsize=1024):
         """ Waits for a returned packet of the given type(s).
                 Returns the packet's payload.
                 If verbose is True, prints all packets received while waiting
+                Other packets are dropped, except that status packets
+                are appended to self.status_buffer if it is a list
         """
         if isinstance(cmd, Command):
             cmd = [cmd]
         while True:
-            p = self.poll()
+            p = self.poll(bufsize)
             if verbose and p is not None:
                 # Truncate bytearrays to prevent huge printouts
                 if type(p[1]) is bytearray:
@@ -201,6 +241,14 @@ class Printer(object):
                     print(p)
             if p is not None and p[0] in cmd:
                 return p[1]
+            self._pass_over(p)
+
+    def _pass_over(self, p):
+        """ Keeps a status packet that _wait_for_packet didn't return,
+            if status_buffer is set.
+        """
+        if p is not None and self.status_buffer is not None and p[0] in STATUS_COMMANDS:
+            self.status_buffer.append(p)
 
     def poll(self, bufsize=1024):
         """ Returns the next received packet as a tuple (command, payload)
@@ -254,15 +302,43 @@ class Printer(object):
         self._command(Command.CMD_DELETE_BLOCKS,
                       bytearray(struct.pack('<II', block, end)),
                       expect_success=True)
-
-    def read_block_raw(self, block):
+        if self.block_cache is not None:
+            self.block_cache.invalidate(self._serial, block, end)
+
+    def enable_block_cache(self, cache=None):
+        """ Keeps a copy of every block read or written in a
+            BlockCache.BlockCache (by default in ~/.openfl/blocks).
+            read_block_raw then serves a block from the cache whenever the
+            size the printer reports still matches; the firmware always
+            reports a crc of 0, so this is only valid while this host is
+            the only one writing blocks to the printer.
+        """
+        from OpenFL import BlockCache
+        if cache is None:
+            cache = BlockCache.BlockCache()
+        self._serial = self.serial_number()
+        self.block_cache = cache
+        return cache
+
+    def read_block_raw(self, block, bufsize=1024):
         """ Reads a block by number.
             The result is an FLP.Packets object, which is a Python list,
             meaning you can delete and insert entries, just like in a list.
+            With enable_block_cache, a cached copy of the same size is
+            returned without reading the block (see enable_block_cache).
         """
+        info = None
+        if self.block_cache is not None:
+            info = self.block_information(block)
+            if not isinstance(info, Response):
+                data = self.block_cache.get(self._serial, block, *info)
+                if data is not None:
+                    return data
+
         data = self._command(Command.CMD_READ_BLOCK,
                 bytearray(struct.pack('<I', block)),
-                wait=[Command.CMD_READ_BLOCK, Command.CMD_READ_BLOCK_DATA])
+                wait=[Command.CMD_READ_BLOCK, Command.CMD_READ_BLOCK_DATA],
+                bufsize=bufsize)
 
         # If we got a response code, return it immediately
         if isinstance(data, Response):
@@ -280,11 +356,40 @@ class Printer(object):
             raise BadResponse("Didn't receive enough data in the block")
 
         # Return the data section of the block, stripping the trailing CRC
-        return data[8:-4]
+        data = data[8:-4]
+        if info is not None and not isinstance(info, Response):
+            self.block_cache.put(self._serial, block, data, info[1])
+        return data
 
     def read_block_flp(self, block):
         return FLP.fromstring(self.read_block_raw(block))
 
+    # Block reads are large, so read them in big USB transfers.
+    READ_BLOCKS_BUFSIZE = 1 << 16
+
+    def read_blocks(self, blocks, bufsize=READ_BLOCKS_BUFSIZE):
+        """ Reads each of the given blocks in turn,
+            yielding (block, data) as each transfer finishes.
+            bufsize is the USB read size.
+        """
+        for block in blocks:
+            yield block, self.read_block_raw(block, bufsize=bufsize)
+
+    def read_blocks_flp(self, blocks, processes=None, bufsize=READ_BLOCKS_BUFSIZE):
+        """ Like read_blocks, but yields (block, FLP.Packets).
+            Blocks are parsed on a pool of processes (by default one per CPU)
+            while later blocks are still being read over USB, so reading a whole
+            print is limited by USB bandwidth rather than by parsing.
+            Don't use the printer for anything else until this finishes.
+        """
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            for result in pool.imap(_parse_block, self.read_blocks(blocks, bufsize)):
+                yield result
+        finally:
+            pool.terminate()
+
     @staticmethod
     def _fletcher32(data):
         """ As it turns out, the firmware doesn't implement CRC checking.
@@ -316,6 +421,12 @@ class Printer(object):
                                                       'mapleSdFatVersion',
                                                       'tinyprintfVersion'), parts))
         return result
+
+    def serial_number(self):
+        """ Returns the printer's serial number as a string
+        """
+        serial = self.get_machine_information()['serialNumber']
+        return bytes(serial).rstrip(b'\0').decode('ascii', 'replace')
         
     def write_block(self, block, data, skip_audit=False):
         """ Writes a block.
@@ -338,6 +449,13 @@ class Printer(object):
                 struct.pack('<III', block, len(data), self._fletcher32(data)))
         self._command(Command.CMD_LOAD_PRINT_DATA_BLOCK, header + data,
                       expect_success=True)
+        if self.block_cache is not None:
+            # Key the entry by what the printer will report for this block.
+            info = self.block_information(block)
+            if isinstance(info, Response):
+                self.block_cache.invalidate(self._serial, block)
+            else:
+                self.block_cache.put(self._serial, block, data, info[1])
 
     def write_block_flp(self, block, flp):
         """ Writes FLP data to a block.
@@ -350,15 +468,26 @@ class Printer(object):
             self.audit_laser_power_flp(flp)
         self.write_block(block, bytearray(flp.tostring()), skip_audit=True)
 
-    def block_size(self, block):
-        """ Returns block size (in bytes) of the target block
+    def block_information(self, block):
+        """ Returns (size, crc) of the target block,
+            or a Response if the printer refuses
         """
         data = self._command(Command.CMD_BLOCK_INFORMATION,
             bytearray(struct.pack('<I', block)))
+        if isinstance(data, Response):
+            return data
         block_received, size, crc = struct.unpack('<III', data)
         if block_received != block:
             raise BadResponse("Block received was not block requested")
-        return size
+        return size, crc
+
+    def block_size(self, block):
+        """ Returns block size (in bytes) of the target block
+        """
+        info = self.block_information(block)
+        if isinstance(info, Response):
+            raise BadResponse(info)
+        return info[0]
 
     def _read_cal_field(self, cmd):
         """ Reads a calibration field from the printer
@@ -379,7 +508,7 @@ class Printer(object):
 
         # Return the data section of the block, stripping the trailing CRC
         # and evaluating to get a list of lists
-        return eval(str(data[4:-4]))
+        return eval(bytes(data[4:-4]).decode('ascii'))
 
     def read_laser_table(self):
         """ Reads the printer's laser table
@@ -582,7 +711,6 @@ class Printer(object):
                         excluding start_xy_mm and including end_xy_mm,
                         possibly including samples along the way.
         """
-        import FLP
         from numpy.linalg import norm
         dist_mm = norm(np.asarray(end_xy_mm) - start_xy_mm)
         if dist_mm <= max_mm:
@@ -590,7 +718,7 @@ class Printer(object):
                 return np.array((tuple(end_xy_mm) + (dt_s,),)) # Just the end sample.
             else:
                 return np.array((tuple(end_xy_mm) + (dt_s, mW),)) # Just the end sample.
-        samples_s = np.linspace(0, dt_s, np.ceil(dist_mm / max_mm) + 1)
+        samples_s = np.linspace(0, dt_s, int(np.ceil(dist_mm / max_mm)) + 1)
         timeRange_s = (0, dt_s)
         if mW is None:
             return np.transpose([np.interp(samples_s[1:], timeRange_s, (start_xy_mm[0], end_xy_mm[0])),
@@ -631,44 +759,91 @@ class Printer(object):
         
 
     def samples_to_FLP(self, xy_mm_dts_s_mW, max_mm=5.0):
-        import FLP
+        """ Compiles an array of shape nx4, where each row is
+            x_mm, y_mm, dt_s, mW, into an FLP.Packets object.
+            The first row is the starting point.
+            See iter_samples_to_FLP to compile without holding
+            everything in memory.
+        """
+        return FLP.Packets(self.iter_samples_to_FLP([xy_mm_dts_s_mW],
+                                                    max_mm=max_mm))
+
+    def iter_samples_to_FLP(self, chunks, max_mm=5.0, max_points=0xffff):
+        """ Like samples_to_FLP, but takes an iterable of nx4 chunks of
+            x_mm, y_mm, dt_s, mW samples and yields finished
+            LaserPowerLevel and XYMove packets as it goes.
+
+            The last point and power carry over from one chunk to the next,
+            so the packets are the same as for the concatenated samples,
+            except that XYMoves are split after max_points rows.
+        """
         clock_Hz = FLP.XYMoveClockRate.moverate_Hz()
         xyticks = []
-        import numpy as np
-        xy_mm_dts_s_mW = np.asarray(xy_mm_dts_s_mW)
-        result = FLP.Packets()
-        xydtmW = self.sample_line_segments_mm_s(start_xy_mm=xy_mm_dts_s_mW[0,:2],
-                                                xys_mm=xy_mm_dts_s_mW[1:,:2],
-                                                dts_s=xy_mm_dts_s_mW[1:,2],
-                                                mWs=xy_mm_dts_s_mW[1:,3],
-                                                max_mm=5.0)
-        # Use the starting row, then interpolate elsewhere.
-        xydtmW = np.vstack([xy_mm_dts_s_mW[:1],
-                            np.hstack([xydtmW[:,:2], xydtmW[:,2:3], xydtmW[:,3:4]])
-                           ])
         last_mW = None
-        lastxy_ticks = self.mm_to_galvo(xydtmW[0][0], xydtmW[0][1])
-        for x_mm, y_mm, dt_s, mW in xydtmW:
-            if mW != last_mW:
-                if xyticks:
-                    result.append(FLP.XYMove(xyticks))
-                    xyticks = []
-                result.append(FLP.LaserPowerLevel(self.mW_to_ticks(mW)))
-                last_mW = mW
-            xy_ticks = self.mm_to_galvo(x_mm, y_mm)
-            dt_ticks = dt_s * clock_Hz
-            # Deal with potential that the move takes too long to fit in one step:
-            for i in range(int(dt_ticks // 0xffff)):
-                alpha = (i+1) * 0xffff / dt_ticks 
-                x = np.interp(alpha, [0.0, 1.0], [lastxy_ticks[0], xy_ticks[0]])
-                y = np.interp(alpha, [0.0, 1.0], [lastxy_ticks[1], xy_ticks[1]])
-                xyticks.append((x, y, 0xffff))
-            dt_ticks %= 0xffff # Now we just have to do the last little bit.
-            xyticks.append(tuple(xy_ticks) + (dt_ticks,))
-            lastxy_ticks = xy_ticks
+        lastxy_mm = None
+        lastxy_ticks = None
+        for chunk in chunks:
+            chunk = np.asarray(chunk, dtype=float)
+            if chunk.ndim != 2 or chunk.shape[1] != 4:
+                raise TypeError('Sample chunks must have shape nx4; got {}.'.format(chunk.shape))
+            if len(chunk) == 0:
+                continue
+            if lastxy_mm is None:
+                # Use the starting row, then interpolate elsewhere.
+                head, chunk = chunk[:1], chunk[1:]
+                lastxy_mm = head[0,:2]
+            else:
+                head = np.zeros((0, 4))
+            xydtmW = self.sample_line_segments_mm_s(start_xy_mm=lastxy_mm,
+                                                    xys_mm=chunk[:,:2],
+                                                    dts_s=chunk[:,2],
+                                                    mWs=chunk[:,3],
+                                                    max_mm=max_mm)
+            xydtmW = np.vstack([head, xydtmW.reshape(-1, 4)])
+            if len(chunk):
+                lastxy_mm = chunk[-1,:2]
+
+            # Map the whole chunk to galvo space at once.
+            xys_ticks = np.transpose(self.mm_to_galvo(xydtmW[:,0], xydtmW[:,1]))
+            if lastxy_ticks is None:
+                lastxy_ticks = xys_ticks[0]
+            for xy_ticks, (dt_s, mW) in zip(xys_ticks, xydtmW[:,2:]):
+                if mW != last_mW:
+                    if xyticks:
+                        yield FLP.XYMove(xyticks)
+                        xyticks = []
+                    yield FLP.LaserPowerLevel(int(round(self.mW_to_ticks(mW))))
+                    last_mW = mW
+                rows = []
+                dt_ticks = dt_s * clock_Hz
+                # Deal with potential that the move takes too long to fit in one step:
+                for i in range(int(dt_ticks // 0xffff)):
+                    alpha = (i+1) * 0xffff / dt_ticks
+                    x, y = lastxy_ticks + alpha * (xy_ticks - lastxy_ticks)
+                    rows.append((x, y, 0xffff))
+                dt_ticks %= 0xffff # Now we just have to do the last little bit.
+                rows.append(tuple(xy_ticks) + (dt_ticks,))
+                lastxy_ticks = xy_ticks
+                for row in rows:
+                    xyticks.append(row)
+                    if len(xyticks) >= max_points:
+                        yield FLP.XYMove(xyticks)
+                        xyticks = []
         if xyticks:
-            result.append(FLP.XYMove(xyticks))
-        return result
+            yield FLP.XYMove(xyticks)
+
+    def write_samples_to_FLP(self, chunks, fileHandle, max_mm=5.0):
+        """ Compiles chunks of samples as in iter_samples_to_FLP,
+            writing each packet as soon as it is finished.
+                fileHandle is a file name, an open file, or an FLP.PacketWriter
+            Returns the FLP.PacketWriter, which counts packets and bytes written.
+        """
+        if isinstance(fileHandle, FLP.PacketWriter):
+            fileHandle.extend(self.iter_samples_to_FLP(chunks, max_mm=max_mm))
+            return fileHandle
+        with FLP.PacketWriter(fileHandle) as writer:
+            writer.extend(self.iter_samples_to_FLP(chunks, max_mm=max_mm))
+        return writer
 
 
     @staticmethod
@@ -678,30 +853,20 @@ class Printer(object):
             >>> Printer.mm_to_galvo(0, 0) # -> galvo ticks for middle of build area.
             >>> Printer.mm_to_galvo([[0, 1, 2], [0, 0, 0]]) # -> A three-segment line along the x axis.
         """
-        xy = x
-        if y is not None:
-            if np.shape(x) != np.shape(y):
-                raise TypeError('x and y shapes must match. Got x.shape: {}, y.shape: {}'.format(np.shape(x), np.shape(y)))
-            xy = np.array([x, y]) # Allows calling with just an x and a y.
-        # These polynomials are a fit to all Form 1/1+s.
-        Px = np.array([  3.27685507e+04,   4.80948842e+02,  -1.22079970e-01,
-                         -2.88953161e-03,   6.08478254e-01,  -8.81889894e-02,
-                         -2.20922460e-05,   4.41734858e-07,   6.76006698e-03,
-                         -1.02093319e-05,  -1.43020804e-06,   2.03140758e-08,
-                         -6.71090318e-06,  -4.36026159e-07,   2.62988209e-08,
-                         8.32187652e-11])
-        Py = np.array([  3.27661362e+04,   5.69452975e-01,  -2.39793282e-03,
-                         9.83778919e-06,   4.79035581e+02,  -8.13031539e-02,
-                         -2.66499770e-03,  -4.40219799e-07,  -1.06247442e-01,
-                         5.18419181e-05,   1.47754740e-06,  -1.60049118e-09,
-                         -2.44473912e-03,  -1.31398011e-06,   1.83452740e-08,
-                         3.16943985e-10])
+        return FLEET_GALVO_MODEL(x, y)
 
-        xy = np.asarray(xy, dtype=float)
-        if xy.shape[0] != 2:
-            raise TypeError('xy must be a two-vector or 2xn or 2xmxn... not shape {}.'.format(xy.shape))
-        shp = xy.shape[1:] # polyval2d wants vector inputs, not multidimensional.
-        return np.array([polyval2d(P, *xy.reshape(2,-1)).reshape(shp) for P in (Px, Py)])
+    def fit_galvo_model(self, order=3):
+        """ Fits a PolynomialGalvoModel to this printer's grid table.
+            The residual at the grid points is available on the result.
+        """
+        return PolynomialGalvoModel.fit(self.read_grid_table(), order=order)
+
+def _parse_block(block_data):
+    """ Parses a (block, data) pair from Printer.read_blocks.
+        This is at module level so it can run on a multiprocessing.Pool.
+    """
+    block, data = block_data
+    return block, FLP.fromstring(bytes(data))
 
 def polyval2d(m, x, y):
     """ From http://stackoverflow.com/a/7997925/874660
@@ -714,84 +879,397 @@ def polyval2d(m, x, y):
         z += a * x**i * y**j
     return z
 
+class PolynomialGalvoModel(object):
+    """ A 2D polynomial map from mm to galvo ticks.
+        Px and Py hold coefficients in polyval2d order, i.e. the coefficient
+        of x**i * y**j is at index i * (order + 1) + j.
+
+        Evaluation computes the powers of y once, shares them between all
+        terms and both axes, then applies Horner's rule in x.
+    """
+    GRID_MM = np.linspace(-64, 64, 5) # Grid table positions in mm
+
+    def __init__(self, Px, Py, residual_ticks=None):
+        Px = np.asarray(Px, dtype=float)
+        Py = np.asarray(Py, dtype=float)
+        order = int(round(np.sqrt(len(Px)))) - 1
+        if Px.shape != Py.shape or Px.shape != ((order + 1)**2,):
+            raise TypeError('Px and Py must both have (order + 1)**2 coefficients. Got {} and {}.'.format(Px.shape, Py.shape))
+        self.order = order
+        self.Px = Px
+        self.Py = Py
+        self.residual_ticks = residual_ticks
+        # Rows are (axis, i), columns are j.
+        self._C = np.array([Px, Py]).reshape(2 * (order + 1), order + 1)
+
+    @classmethod
+    def fit(cls, grid_table, order=3):
+        """ Least-squares fit to a printer's 5x5 grid table
+            (as returned by Printer.read_grid_table).
+            residual_ticks on the result holds the fit error at each grid point.
+        """
+        grid = np.asarray(grid_table, dtype=float)
+        if grid.shape != (5, 5, 2):
+            raise TypeError('grid_table must have shape (5, 5, 2); got {}.'.format(grid.shape))
+        # grid[a, b] is the galvo position for x = GRID_MM[b], y = GRID_MM[a].
+        y_mm, x_mm = np.meshgrid(cls.GRID_MM, cls.GRID_MM, indexing='ij')
+        # Fit in normalized coordinates to keep the Vandermonde matrix well
+        # conditioned, then scale the coefficients back to mm.
+        scale = np.max(np.abs(cls.GRID_MM))
+        V = np.polynomial.polynomial.polyvander2d(x_mm.ravel() / scale,
+                                                  y_mm.ravel() / scale,
+                                                  [order, order])
+        ticks = grid.reshape(-1, 2)
+        P = np.linalg.lstsq(V, ticks, rcond=None)[0]
+        residual = (V.dot(P) - ticks).reshape(grid.shape)
+        i, j = np.indices((order + 1, order + 1)).reshape(2, -1)
+        P /= scale**(i + j)[:,np.newaxis]
+        return cls(P[:,0], P[:,1], residual_ticks=residual)
+
+    @property
+    def rms_residual_ticks(self):
+        """ RMS distance in ticks between the fit and the grid table.
+        """
+        if self.residual_ticks is None:
+            return None
+        return np.sqrt(np.mean(np.sum(self.residual_ticks**2, axis=-1)))
+
+    @property
+    def max_residual_ticks(self):
+        """ Largest distance in ticks between the fit and the grid table.
+        """
+        if self.residual_ticks is None:
+            return None
+        return np.max(np.sqrt(np.sum(self.residual_ticks**2, axis=-1)))
+
+    def __call__(self, x, y=None):
+        """ Maps mm to galvo ticks. Accepts the same arguments as
+            Printer.mm_to_galvo_approx: an x and a y, or one 2xN... array.
+        """
+        xy = x
+        if y is not None:
+            if np.shape(x) != np.shape(y):
+                raise TypeError('x and y shapes must match. Got x.shape: {}, y.shape: {}'.format(np.shape(x), np.shape(y)))
+            xy = np.array([x, y]) # Allows calling with just an x and a y.
+        xy = np.asarray(xy, dtype=float)
+        if xy.shape[0] != 2:
+            raise TypeError('xy must be a two-vector or 2xn or 2xmxn... not shape {}.'.format(xy.shape))
+        shp = xy.shape[1:]
+        x, y = xy.reshape(2, -1)
+        n = self.order + 1
+
+        ypow = np.empty((n, len(y)))
+        ypow[0] = 1.0
+        for j in range(1, n):
+            np.multiply(ypow[j-1], y, out=ypow[j])
+        # inner[axis, i] is the polynomial in y multiplying x**i.
+        inner = self._C.dot(ypow).reshape(2, n, -1)
+
+        result = inner[:, -1].copy()
+        for i in range(n - 2, -1, -1):
+            result *= x
+            result += inner[:, i]
+        return result.reshape((2,) + shp)
+
+# These polynomials are a fit to all Form 1/1+s.
+FLEET_GALVO_MODEL = PolynomialGalvoModel(
+    Px=[  3.27685507e+04,   4.80948842e+02,  -1.22079970e-01,
+         -2.88953161e-03,   6.08478254e-01,  -8.81889894e-02,
+         -2.20922460e-05,   4.41734858e-07,   6.76006698e-03,
+         -1.02093319e-05,  -1.43020804e-06,   2.03140758e-08,
+         -6.71090318e-06,  -4.36026159e-07,   2.62988209e-08,
+          8.32187652e-11],
+    Py=[  3.27661362e+04,   5.69452975e-01,  -2.39793282e-03,
+          9.83778919e-06,   4.79035581e+02,  -8.13031539e-02,
+         -2.66499770e-03,  -4.40219799e-07,  -1.06247442e-01,
+          5.18419181e-05,   1.47754740e-06,  -1.60049118e-09,
+         -2.44473912e-03,  -1.31398011e-06,   1.83452740e-08,
+          3.16943985e-10])
+
 ################################################################################
 
 class DummyPrinter(Printer):
     """ DummyPrinter lets you test some functionality without a printer connected.
+
+        It models the firmware at the level of command payloads:
+        blocks are stored as bytes, and start_printing executes them
+        packet by packet against a Timing.PrintClock, emitting
+        STATUS_LAYER_DONE, STATUS_BLOCK_DONE and STATUS_PRINT_DONE
+        through poll() as simulated time passes.
+
+        speedup scales simulated time relative to the wall clock;
+        speedup=None runs prints as fast as possible.
+
+        If serial is a text file (e.g. io.StringIO or a pty), the output of
+        SerialPrintCommand and SerialPrintClockCommand is written to it,
+        as the printer would write it to its serial header; the clock
+        reads simulated milliseconds since the print started.
     """
-    def __init__(self):
+    LASER_TABLE = [[0, 0, 0], [0.0, 0.0, 1.0], [0.1, 0.01, 2.0], [0.2, 0.01, 2.0], [0.3, 0.02, 3.0], [0.4, 0.02, 4.0], [0.5, 0.03, 6.0], [0.6, 0.03, 7.0], [0.7, 0.04, 8.0], [0.8, 0.06, 10.0], [0.9, 0.11, 12.0], [1.0, 1.16, 40.0], [1.1, 5.27, 144.0], [1.2, 9.37, 239.0], [1.3, 13.42, 339.0], [1.4, 17.68, 441.0], [1.5, 21.91, 543.0], [1.6, 26.08, 645.0], [1.7, 30.48, 747.0], [1.8, 34.73, 853.0], [1.9, 38.86, 958.0], [2.0, 43.18, 1061.0], [2.1, 47.67, 1169.0], [2.2, 51.93, 1276.0], [2.3, 56.1, 1381.0], [2.4, 60.61, 1489.0], [2.5, 65.06, 1589.0], [2.6, 69.01, 1702.0], [2.7, 73.45, 1798.0], [2.8, 77.69, 1907.0], [2.9, 82.51, 2021.0]]
+    GRID_TABLE = [[[ 2302, 2736], [ 2251, 17532], [ 2141, 32820], [ 1972, 47937], [ 1757, 62382]],
+                  [[16833, 2212], [16744, 17245], [16608, 32800], [16420, 48168], [16207, 62848]],
+                  [[32294, 2003], [32182, 17099], [32026, 32748], [31840, 48228], [31621, 62979]],
+                  [[47858, 2131], [47740, 17142], [47592, 32705], [47406, 48093], [47146, 62737]],
+                  [[62745, 2589], [62624, 17351], [62469, 32651], [62258, 47773], [62017, 62194]]]
+    ZSENSOR_HEIGHT = [0]
+
+    def __init__(self, speedup=1.0, serialNumber='DUMMY', serial=None):
         super(DummyPrinter, self).__init__(connect=False)
+        self.speedup = speedup
+        self.serialNumber = serialNumber
+        self.serial = serial
         self._laser_xypower = [0, 0, 0]
         self._blocks = dict()
         self._state = State.MACHINE_OFF
+        self._pause_requested = False
+        self._timeline = None
+        self._next_event = None
+        self._reset_motors()
 
-    def poll(self):
-        raise NotImplementedError()
-
-    def initialize(self):
-        self._state = State.MACHINE_READY_TO_PRINT
+    def _reset_motors(self):
         self._zpos_usteps = 0 # FIXME: Need to know where z starts.
         self._zcurrent = 40
-        self._zspeed_usteps_per_s = 0
+        self._zspeed_usteps_per_s = Timing.DEFAULT_Z_FEEDRATE
         self._tiltpos_usteps = 0
         self._tiltcurrent = 40
-        self._tiltspeed_usteps_per_s = 0
+        self._tiltspeed_usteps_per_s = Timing.DEFAULT_TILT_FEEDRATE
 
-    def shutdown(self):
-        self._state = State.MACHINE_OFF
+    def poll(self, bufsize=None):
+        """ Returns the next status packet as a tuple (command, payload)
+            If there are no packets pending, returns None
+        """
+        self._advance()
+        return self.incoming.pop(0) if self.incoming else None
 
-    def list_blocks(self):
-        return self._blocks.keys()
+    ############################################################################
+    # Simulated time
 
-    def delete_block(self, block, end=None):
-        if end is None:
-            end = block
-        for i  in range(block, end+1):
-            if i in self._blocks:
-                del self._blocks[i]
+    def _raw_time_s(self):
+        if self.speedup is None:
+            return float('inf')
+        return (time.time() - self._print_started) * self.speedup
 
-    def read_block_raw(self, block):
-        return self._blocks[block]
+    def _sim_time_s(self):
+        """ Time since the print started, not counting time spent paused.
+        """
+        return self._raw_time_s() - self._paused_total_s
 
-    def block_size(self):
-        return len(self._blocks[block])
+    def _print_timeline(self, block, end):
+        """ Yields (time, packet) as each packet finishes executing,
+            interleaved with (time, (Command, payload)) status events.
+        """
+        clock = Timing.PrintClock(self._zspeed_usteps_per_s,
+                                  self._tiltspeed_usteps_per_s)
+        for b in range(block, end):
+            layer = b
+            for packet in FLP.fromstring(bytes(self._blocks[b])):
+                yield clock.step(packet), packet
+                if isinstance(packet, FLP.LayerStart):
+                    layer = packet.layernumber
+                elif isinstance(packet, FLP.LayerDone):
+                    yield clock.t_s, (Command.STATUS_LAYER_DONE, layer)
+            yield clock.wait(), (Command.STATUS_BLOCK_DONE, b)
+        yield clock.t_s, (Command.STATUS_PRINT_DONE, None)
+
+    def _advance(self):
+        """ Executes everything due by the current simulated time.
+        """
+        if self._timeline is None or self._state == State.MACHINE_PRINTING_PAUSED:
+            return
+        now_s = self._sim_time_s()
+        while self._next_event is not None and self._next_event[0] <= now_s:
+            t_s, item = self._next_event
+            self._next_event = next(self._timeline, None)
+            if isinstance(item, FLP.Packet):
+                self._execute_packet(item, t_s)
+                continue
+            self.incoming.append(item)
+            if item[0] == Command.STATUS_PRINT_DONE:
+                self._end_print()
+                return
+            if (item[0] == Command.STATUS_LAYER_DONE and
+                    self._state == State.MACHINE_PRINTING_PAUSE_PENDING):
+                self._state = State.MACHINE_PRINTING_PAUSED
+                self._paused_at_s = t_s
+                return
+
+    def _execute_packet(self, packet, t_s):
+        if isinstance(packet, FLP.ZMove):
+            self._zpos_usteps += packet.usteps
+        elif isinstance(packet, FLP.ZFeedRate):
+            self._zspeed_usteps_per_s = packet.feedrate
+        elif isinstance(packet, FLP.ZCurrent):
+            self._zcurrent = packet.current
+        elif isinstance(packet, FLP.TiltMove):
+            self._tiltpos_usteps += packet.usteps
+        elif isinstance(packet, FLP.TiltFeedRate):
+            self._tiltspeed_usteps_per_s = packet.feedrate
+        elif isinstance(packet, FLP.TiltCurrent):
+            self._tiltcurrent = packet.current
+        elif isinstance(packet, FLP.LaserPowerLevel):
+            self._laser_xypower[2] = packet.power
+        elif isinstance(packet, FLP.XYMove) and packet.npoints:
+            self._laser_xypower[:2] = packet.points[-1][:2]
+        elif self.serial is None:
+            pass
+        elif isinstance(packet, FLP.SerialPrintCommand):
+            self.serial.write(packet.string)
+        elif isinstance(packet, FLP.SerialPrintClockCommand):
+            self.serial.write('clock: {}\n'.format(int(round(t_s * 1000))))
+
+    def _end_print(self):
+        self._timeline = None
+        self._next_event = None
+        self._pause_requested = False
+        self._laser_xypower[2] = 0
+        self._state = State.MACHINE_READY_TO_PRINT
 
-    def _command(self, cmd, payload=b'', wait=True, expect_success=False):
+    ############################################################################
+    # Commands
+
+    def _command(self, cmd, payload=b'', wait=True, expect_success=False, verbose=False,
+                 bufsize=None):
+        """ Executes a command, returning what Printer._command would
+            return for the firmware's response.
+        """
+        self._advance()
+        handler = getattr(self, '_do_' + cmd.name, None)
+        r = handler(bytes(payload)) if handler else Response.ERROR_UNIMPLEMENTED
+        if not wait:
+            return None
+        # The response comes after any status packets already sent,
+        # and Printer._wait_for_packet reads past them.
+        while self.incoming:
+            self._pass_over(self.poll())
+        if expect_success and r != Response.SUCCESS:
+            raise BadResponse(r)
+        return r
+
+    def _do_CMD_MACHINE_INFORMATION(self, payload):
+        return struct.pack('<I32sI7s7s7s7s', 1, self.serialNumber.encode('ascii'), 0,
+                           b'dummy', b'', b'', b'')
+
+    def _do_CMD_INITIALIZE(self, payload):
+        self._end_print()
+        self._reset_motors()
+        self._laser_xypower = [0, 0, 0]
+        return Response.SUCCESS
+
+    def _do_CMD_SHUTDOWN(self, payload):
+        self._end_print()
+        self._state = State.MACHINE_OFF
+        return Response.SUCCESS
+
+    def _do_CMD_MACHINE_STATE(self, payload):
+        return self._state
+
+    def _do_CMD_LOAD_PRINT_DATA_BLOCK(self, payload):
         header = struct.Struct('<III')
         block, length, checksum = header.unpack(payload[:header.size])
-        if cmd == Command.CMD_LOAD_PRINT_DATA_BLOCK:
-            data = payload[header.size:]
-            assert len(data) == length
-            self._blocks[block] = data
-        elif cmd == Command.CMD_MACHINE_STATE:
-            return self._state
-        elif cmd == Command.CMD_MOVE_Z_STEPPER_INCREMENTAL:
-            s = struct.Struct('<iIB')
-            steps, feedrate, current = s.unpack(payload[header.size:])
-            self._zpos_usteps += steps
-            self._zspeed_usteps_per_s = feedrate
+        data = payload[header.size:]
+        if len(data) != length:
+            return Response.ERROR_MALFORMED_REQUEST
+        self._blocks[block] = bytearray(data)
+        return Response.SUCCESS
+
+    def _do_CMD_BLOCK_INFORMATION(self, payload):
+        block, = struct.unpack('<I', payload)
+        if block not in self._blocks:
+            return Response.ERROR_INVALID_BLOCK_NUMBER
+        data = self._blocks[block]
+        return struct.pack('<III', block, len(data), self._fletcher32(data))
+
+    def _do_CMD_DELETE_BLOCKS(self, payload):
+        block, end = struct.unpack('<II', payload)
+        for i in range(block, end + 1):
+            self._blocks.pop(i, None)
+        return Response.SUCCESS
+
+    def _do_CMD_LIST_BLOCKS(self, payload):
+        blocks = sorted(self._blocks)
+        return struct.pack('<I%iI' % len(blocks), len(blocks), *blocks)
+
+    def _do_CMD_READ_BLOCK(self, payload):
+        block, = struct.unpack('<I', payload)
+        if block not in self._blocks:
+            return Response.ERROR_MALFORMED_REQUEST
+        data = self._blocks[block]
+        return (struct.pack('<II', block, len(data)) + bytes(data) +
+                struct.pack('<I', self._fletcher32(data)))
+
+    def _do_CMD_START_PRINTING(self, payload):
+        block, end = struct.unpack('<II', payload)
+        if self._state == State.MACHINE_OFF:
+            return Response.ERROR_PRINTER_OFF
+        if self._state != State.MACHINE_READY_TO_PRINT:
+            return Response.ERROR_ALREADY_PRINTING
+        if end <= block or any(b not in self._blocks for b in range(block, end)):
+            return Response.ERROR_INVALID_BLOCK_NUMBER
+        self._state = State.MACHINE_PRINTING
+        self._print_started = time.time()
+        self._paused_total_s = 0.0
+        self._timeline = self._print_timeline(block, end)
+        self._next_event = next(self._timeline, None)
+        return Response.SUCCESS
+
+    def _do_CMD_STOP_PRINTING(self, payload):
+        if self._timeline is None:
+            return Response.ERROR_NOT_PRINTING
+        self._end_print()
+        return Response.SUCCESS
+
+    def _do_CMD_PAUSE_PRINTING(self, payload):
+        if self._state != State.MACHINE_PRINTING:
+            return Response.ERROR_NOT_PRINTING
+        self._state = State.MACHINE_PRINTING_PAUSE_PENDING
+        return Response.SUCCESS
+
+    def _do_CMD_UNPAUSE_PRINTING(self, payload):
+        if self._state == State.MACHINE_PRINTING_PAUSED:
+            if self.speedup is not None:
+                self._paused_total_s += self._sim_time_s() - self._paused_at_s
+        elif self._state != State.MACHINE_PRINTING_PAUSE_PENDING:
+            return Response.ERROR_NOT_PRINTING
+        self._state = State.MACHINE_PRINTING
+        return Response.SUCCESS
+
+    def _do_CMD_MOVE_Z_STEPPER_INCREMENTAL(self, payload):
+        steps, feedrate, current = struct.unpack('<iIB', payload)
+        self._zpos_usteps += steps
+        self._zspeed_usteps_per_s = feedrate
+        self._zcurrent = current
+        return Response.SUCCESS
+
+    def _do_CMD_MOVE_TILT_STEPPER_INCREMENTAL(self, payload):
+        steps, feedrate, current = struct.unpack('<iIB', payload)
+        self._tiltpos_usteps += steps
+        self._tiltspeed_usteps_per_s = feedrate
+        self._tiltcurrent = current
+        return Response.SUCCESS
+
+    def _do_CMD_POSITION_LASER(self, payload):
+        self._laser_xypower = list(struct.unpack('<HHH', payload))
+        return Response.SUCCESS
 
-    def set_laser_uint16(self, x, y, power=25000):
-        """ Sets the position and laser power level
-                x and y are unsigned 16-bit values (0 to 0xffff)
-                    (with 0 at the corner of the platform)
-                power is an unsigned 16-bit integer
-            Setting power too high can damage your diode!
-        """
-        if self.AUDIT_LASER_POWER:
-            # This raises if the power is too high:
-            self.check_laser_ticks(power)
-        self._laser_xypower = [x, y, power]
+    @staticmethod
+    def _cal_field(table):
+        text = repr(table).encode('ascii')
+        return struct.pack('<I', len(text)) + text + struct.pack('<I', 0)
+
+    def _do_CMD_READ_LASER_TABLE(self, payload):
+        return self._cal_field(self.LASER_TABLE)
+
+    def _do_CMD_READ_GRID_TABLE(self, payload):
+        return self._cal_field(self.GRID_TABLE)
+
+    def _do_CMD_READ_ZSENSOR_HEIGHT(self, payload):
+        return self._cal_field(self.ZSENSOR_HEIGHT)
 
     def read_laser_table(self):
-        return np.array([[0, 0, 0], [0.0, 0.0, 1.0], [0.1, 0.01, 2.0], [0.2, 0.01, 2.0], [0.3, 0.02, 3.0], [0.4, 0.02, 4.0], [0.5, 0.03, 6.0], [0.6, 0.03, 7.0], [0.7, 0.04, 8.0], [0.8, 0.06, 10.0], [0.9, 0.11, 12.0], [1.0, 1.16, 40.0], [1.1, 5.27, 144.0], [1.2, 9.37, 239.0], [1.3, 13.42, 339.0], [1.4, 17.68, 441.0], [1.5, 21.91, 543.0], [1.6, 26.08, 645.0], [1.7, 30.48, 747.0], [1.8, 34.73, 853.0], [1.9, 38.86, 958.0], [2.0, 43.18, 1061.0], [2.1, 47.67, 1169.0], [2.2, 51.93, 1276.0], [2.3, 56.1, 1381.0], [2.4, 60.61, 1489.0], [2.5, 65.06, 1589.0], [2.6, 69.01, 1702.0], [2.7, 73.45, 1798.0], [2.8, 77.69, 1907.0], [2.9, 82.51, 2021.0]])
+        return np.array(self.LASER_TABLE)
 
     def read_grid_table(self):
-        return np.array([[[ 2302, 2736], [ 2251, 17532], [ 2141, 32820], [ 1972, 47937], [ 1757, 62382]],
-                         [[16833, 2212], [16744, 17245], [16608, 32800], [16420, 48168], [16207, 62848]],
-                         [[32294, 2003], [32182, 17099], [32026, 32748], [31840, 48228], [31621, 62979]],
-                         [[47858, 2131], [47740, 17142], [47592, 32705], [47406, 48093], [47146, 62737]],
-                         [[62745, 2589], [62624, 17351], [62469, 32651], [62258, 47773], [62017, 62194]]])
+        return np.array(self.GRID_TABLE)
 
 ################################################################################
 
@@ -898,6 +1376,11 @@ class Command(Enum):
 
     DEBUG_STRING  = 0x90
 
+STATUS_COMMANDS = (Command.STATUS_LAYER_DONE,
+                   Command.STATUS_LAYER_NON_FATAL_ERROR,
+                   Command.STATUS_BLOCK_DONE,
+                   Command.STATUS_PRINT_DONE)
+
 class State(Enum):
     MACHINE_OFF = 0
     MACHINE_POWERING_UP = 1
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Profiler.py
+
+Measure where print time goes, on the printer itself.
+
+instrument() adds a SerialPrintCommand label and a SerialPrintClockCommand
+at the start of every section of a print (see ADVANCED.md for the serial
+header), and predicts each section's duration with Timing. Run the
+instrumented print while logging the serial port, then compare:
+
+    >>> blocks, sections = Profiler.instrument(blocks, granularity='peel')
+    >>> ... # print blocks, with the serial log going to serial.log
+    >>> print(Profiler.format_report(Profiler.profile(sections, 'serial.log')))
+
+The serial log may be a file, a pty, or a port opened with openSerialPort.
+Each marker itself takes about 1 ms on the printer.
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import collections
+
+from OpenFL import FLP, Timing
+
+try: # Since python3 doesn't have basestring:
+    basestring
+except NameError:
+    basestring = str
+
+# Serial lines starting with MARKER are section labels.
+MARKER = '@'
+END_LABEL = 'end'
+GRANULARITIES = ('layer', 'peel', 'exposure')
+SERIAL_BAUDRATE = 115200
+
+# A section of the print runs from the marker labelled label
+# to the one labelled end_label.
+Section = collections.namedtuple('Section', ['label', 'end_label', 'predicted_s'])
+ProfileRow = collections.namedtuple('ProfileRow', ['label', 'predicted_s', 'actual_s'])
+
+
+def _phase(packet):
+    """'peel' for motor packets, 'exposure' for laser packets, else None."""
+    if isinstance(packet, FLP.MotorCommand):
+        return 'peel'
+    if isinstance(packet, FLP.LaserCommand):
+        return 'exposure'
+    return None
+
+def _marker(label):
+    return [FLP.SerialPrintCommand('{}{}\n'.format(MARKER, label)),
+            FLP.SerialPrintClockCommand()]
+
+
+def instrument(blocks, granularity='layer', clock=None):
+    """
+    Insert timing markers into a print.
+    blocks is an FLP.Packets object or a list of them, printed in order.
+    granularity is one of
+        'layer': a section per layer (starting at each LayerStart)
+        'peel': per layer, split wherever the packets switch between
+                motor moves (the peel) and laser moves (the exposure)
+        'exposure': like 'peel', with a section for each XYMove
+    Returns (instrumented blocks, list of Sections).
+    The instrumented blocks have the same shape as blocks.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError('granularity must be one of {}'.format(GRANULARITIES))
+    single = isinstance(blocks, FLP.Packets)
+    if single:
+        blocks = [blocks]
+    if clock is None:
+        clock = Timing.PrintClock()
+
+    starts = [] # (label, predicted start time)
+    result = []
+    where = 'block 0'
+    phase = None
+    since_marker = None # Packets since the last marker; None before the first
+    moved = False # Whether there's an XYMove since the last marker
+    for b, block in enumerate(blocks):
+        out = FLP.Packets()
+        if since_marker is None:
+            where = 'block {}'.format(b)
+        for packet in block:
+            name = None
+            p = _phase(packet)
+            if isinstance(packet, FLP.LayerStart):
+                where = 'layer {}'.format(packet.layernumber)
+                phase = None
+                name = where
+            elif granularity != 'layer' and p is not None and p != phase:
+                # A layer's first section is named for the layer.
+                if phase is not None:
+                    name = '{} {}'.format(where, p)
+                phase = p
+            elif granularity == 'exposure' and isinstance(packet, FLP.XYMove) and moved:
+                name = '{} {}'.format(where, phase)
+            if since_marker is None or (name is not None and since_marker):
+                label = '{} {}'.format(len(starts), name or where)
+                starts.append((label, clock.t_s))
+                out.extend(_marker(label))
+                since_marker = 0
+                moved = False
+            out.append(packet)
+            clock.step(packet)
+            moved = moved or isinstance(packet, FLP.XYMove)
+            since_marker += 1
+        result.append(out)
+    if since_marker:
+        result[-1].extend(_marker(END_LABEL))
+        starts.append((END_LABEL, clock.t_s))
+
+    sections = [Section(label, end_label, end_s - start_s)
+                for (label, start_s), (end_label, end_s) in zip(starts, starts[1:])]
+    return (result[0] if single else result), sections
+
+
+def openSerialPort(port, baudrate=SERIAL_BAUDRATE):
+    """Open the printer's serial header (needs pyserial) for readSerialLog."""
+    import serial
+    return serial.Serial(port, baudrate)
+
+def readSerialLog(log):
+    """
+    Generate (label, clock_ms) for each marker in a serial log.
+    log is a file name (including a pty), or a file or other iterable of
+    lines, e.g. from openSerialPort. Other output on the port is ignored.
+    """
+    if isinstance(log, basestring):
+        with open(log, 'rb') as fh:
+            for record in readSerialLog(fh):
+                yield record
+        return
+    label = None
+    for line in log:
+        if isinstance(line, bytes):
+            line = line.decode('latin-1')
+        line = line.strip().strip('\0')
+        if line.startswith(MARKER):
+            label = line[len(MARKER):]
+        elif line.startswith('clock:') and label is not None:
+            yield label, int(line.split(':')[1])
+            label = None
+
+
+def profile(sections, log):
+    """
+    Compare sections (from instrument) with the serial log of the print.
+    Returns a ProfileRow per section whose start and end were both logged,
+    in print order.
+    """
+    clocks_ms = dict(readSerialLog(log))
+    return [ProfileRow(s.label, s.predicted_s,
+                       (clocks_ms[s.end_label] - clocks_ms[s.label]) / 1000)
+            for s in sections
+            if s.label in clocks_ms and s.end_label in clocks_ms]
+
+def format_report(rows):
+    """A table of predicted and actual section times, with totals."""
+    lines = ['{:<32} {:>11} {:>11} {:>9}'.format('section', 'predicted_s',
+                                                 'actual_s', 'error_s')]
+    for row in rows:
+        lines.append('{:<32} {:>11.3f} {:>11.3f} {:>+9.3f}'.format(
+            row.label, row.predicted_s, row.actual_s, row.actual_s - row.predicted_s))
+    predicted_s = sum(row.predicted_s for row in rows)
+    actual_s = sum(row.actual_s for row in rows)
+    lines.append('{:<32} {:>11.3f} {:>11.3f} {:>+9.3f}'.format(
+        'total', predicted_s, actual_s, actual_s - predicted_s))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
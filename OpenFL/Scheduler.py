@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Scheduler.py
+
+A job queue that keeps a fleet of printers busy.
+
+    >>> from OpenFL import Fleet, Scheduler
+    >>> scheduler = Scheduler.Scheduler(Fleet.Fleet())
+    >>> scheduler.submit(Scheduler.Job(['part-0.flp', 'part-1.flp'], name='part'))
+    >>> scheduler.run()
+
+Jobs are started longest first (by Timing's estimate of their print
+time) on whichever printers are ready, which keeps the last printer
+to finish from running long after the others.
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import heapq
+import itertools
+import time
+
+from OpenFL import FLP, Timing
+from OpenFL.Printer import BadResponse, Command, Response, State
+
+try: # Since python3 doesn't have basestring:
+    basestring
+except NameError:
+    basestring = str
+
+# States in which a printer is still working on a job.
+PRINTING_STATES = (State.MACHINE_PRINTING, State.MACHINE_PRINTING_PAUSE_PENDING,
+                   State.MACHINE_PRINTING_PAUSED)
+# STATUS_PRINT_DONE payloads for prints that didn't finish.
+STOPPED_RESPONSES = (Response.STATUS_PRINT_STOPPED_DUE_TO_STOP,
+                     Response.STATUS_PRINT_STOPPED_DUE_TO_ABORT)
+
+
+class Job(object):
+    """
+    A print: blocks (FLP.Packets objects or filenames) are loaded into
+    consecutive blocks starting at first_block and printed in order.
+    After scheduling, printer is the serial number it ran on,
+    events holds the status packets it reported, and error
+    holds the exception if it couldn't be started or didn't finish.
+    """
+    def __init__(self, blocks, name=None, first_block=0):
+        if isinstance(blocks, (FLP.Packets, basestring)):
+            blocks = [blocks]
+        self.blocks = [FLP.fromfile(b) if isinstance(b, basestring) else b
+                       for b in blocks]
+        if not self.blocks:
+            raise ValueError('A job needs at least one block.')
+        self.name = name
+        self.first_block = first_block
+        clock = Timing.PrintClock()
+        self.estimated_s = sum(Timing.duration_s(b, clock) for b in self.blocks)
+        self.printer = None
+        self.started_s = None
+        self.finished_s = None
+        self.events = []
+        self.error = None
+
+    def __repr__(self):
+        return '<Job {} ({:.1f} s)>'.format(self.name, self.estimated_s)
+
+    @property
+    def end_block(self):
+        """One past the last block, as start_printing expects."""
+        return self.first_block + len(self.blocks)
+
+
+class Scheduler(object):
+    """
+    Runs Jobs on a Fleet.Fleet.
+    A printer is given a job when it isn't running one of ours and
+    reports State.MACHINE_READY_TO_PRINT. A job is finished when its
+    printer sends STATUS_PRINT_DONE, and has failed if the print was
+    stopped or aborted, the printer stopped printing without sending
+    it, or the printer couldn't be polled.
+
+    While a printer runs a job, the scheduler only polls it and checks
+    its state, keeping the status packets that arrive meanwhile (see
+    Printer.status_buffer); any other command could swallow them.
+    Polls wait at most poll_timeout_ms for each printer.
+    """
+    def __init__(self, fleet, poll_timeout_ms=10):
+        self.fleet = fleet
+        self.poll_timeout_ms = poll_timeout_ms
+        self._queue = []
+        self._sequence = itertools.count()
+        self.running = {} # serial number -> Job
+        self.finished = []
+        self.failed = []
+
+    @property
+    def pending(self):
+        """Queued jobs, in the order they'll start."""
+        return [job for _, _, job in sorted(self._queue)]
+
+    def submit(self, job):
+        # Longest first; ties go in submission order.
+        heapq.heappush(self._queue, (-job.estimated_s, next(self._sequence), job))
+        return job
+
+    def idle(self):
+        """Serial numbers of printers ready for a new job."""
+        candidates = [s for s in self.fleet.serial_numbers() if s not in self.running]
+        if not candidates:
+            return []
+        states = self.fleet.state(candidates)
+        return [s for s in candidates if states[s] == State.MACHINE_READY_TO_PRINT]
+
+    def dispatch(self):
+        """Start queued jobs on idle printers, returning the jobs started."""
+        if not self._queue:
+            return []
+        assignments = [(serial, heapq.heappop(self._queue)[2])
+                       for serial in self.idle() if self._queue]
+        self.fleet.pool.map(self._start, assignments)
+        started = []
+        for serial, job in assignments:
+            if job.error is None:
+                self.running[serial] = job
+                started.append(job)
+            else:
+                self.failed.append(job)
+        return started
+
+    def _start(self, assignment):
+        serial, job = assignment
+        p = self.fleet[serial]
+        job.printer = serial
+        try:
+            p.delete_block(job.first_block, job.end_block - 1)
+            for i, block in enumerate(job.blocks):
+                p.write_block(job.first_block + i, block)
+            p.start_printing(job.first_block, job.end_block)
+        except Exception as e:
+            job.error = e
+        else:
+            job.started_s = time.time()
+
+    def update(self):
+        """
+        Collect status packets from busy printers, returning the jobs
+        that finished or failed.
+        """
+        serials = list(self.running)
+        results = dict((r[0], r[1:]) for r in self.fleet.pool.map(self._drain, serials))
+        done = []
+        for serial in serials:
+            job = self.running[serial]
+            events, state, error = results[serial]
+            job.events.extend(events)
+            finished = [payload for cmd, payload in events if cmd == Command.STATUS_PRINT_DONE]
+            if error is None and finished:
+                if finished[-1] in STOPPED_RESPONSES:
+                    error = BadResponse(finished[-1])
+            elif error is None:
+                if state in PRINTING_STATES:
+                    continue
+                error = RuntimeError('{} stopped printing without STATUS_PRINT_DONE ({})'.format(
+                    serial, state))
+            job.finished_s = time.time()
+            del self.running[serial]
+            if error is None:
+                self.finished.append(job)
+            else:
+                job.error = error
+                self.failed.append(job)
+            done.append(job)
+        return done
+
+    def _drain(self, serial):
+        """
+        Returns (serial, the status packets it sent, its State if none
+        was STATUS_PRINT_DONE, the exception raised if it couldn't
+        be polled).
+        """
+        p = self.fleet[serial]
+        timeout_ms, status_buffer = p.timeout_ms, p.status_buffer
+        events = []
+        p.timeout_ms = self.poll_timeout_ms
+        p.status_buffer = events
+        try:
+            events.extend(iter(p.poll, None))
+            if any(cmd == Command.STATUS_PRINT_DONE for cmd, _ in events):
+                return serial, events, None, None
+            return serial, events, p.state(), None
+        except Exception as e:
+            return serial, events, None, e
+        finally:
+            p.timeout_ms, p.status_buffer = timeout_ms, status_buffer
+
+    def _fail_pending(self, error):
+        """Fail every queued job with error, returning them."""
+        jobs = self.pending
+        self._queue = []
+        for job in jobs:
+            job.error = error
+            self.failed.append(job)
+        return jobs
+
+    def run(self, poll_interval_s=1.0, verbose=False, timeout_s=None):
+        """
+        Run until every job has finished or failed,
+        returning the finished jobs in order of completion.
+        If the fleet has no printers, queued jobs fail.
+        If timeout_s is given and no job starts or finishes for that
+        long (e.g. every printer is unplugged or in an error state),
+        raises RuntimeError, leaving the remaining jobs pending or running.
+        """
+        progress_s = time.time()
+        while self._queue or self.running:
+            done = self.update()
+            if not self.running and not self.fleet.serial_numbers():
+                done.extend(self._fail_pending(RuntimeError('No printers to run jobs on.')))
+            started = self.dispatch()
+            if verbose:
+                for job in done:
+                    print('{} {} on {}'.format(job.name, 'failed' if job.error else 'finished',
+                                               job.printer))
+                for job in started:
+                    print('{} started on {}'.format(job.name, job.printer))
+            if done or started:
+                progress_s = time.time()
+            elif timeout_s is not None and time.time() - progress_s > timeout_s:
+                raise RuntimeError('No job started or finished for {} s ({} pending, {} running).'.format(
+                    timeout_s, len(self._queue), len(self.running)))
+            else:
+                time.sleep(poll_interval_s)
+        return self.finished
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Settle.py
+
+Size laser-off jumps by how far they go.
+
+After a jump, the galvos ring for a while before they settle on the new
+position, and turning the laser on too soon smears the start of the next
+exposure. How long that takes grows with the jump, so rather than
+padding every jump by the same amount, SettleModel gives the travel and
+settle time for a jump by its length along each galvo axis:
+
+    >>> from OpenFL import Settle
+    >>> model = Settle.SettleModel()
+    >>> blocks, stats = Settle.rewrite_jumps(blocks, model)
+
+The model can be fitted to a printer: print calibration_pattern(), find
+the shortest settle time that gives a clean line for each jump, and
+pass them to SettleModel.fit.
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import collections
+
+import numpy as np
+
+from OpenFL import FLP
+
+# Nominal galvo scale, as in examples/image_to_laser_moves.py.
+MM_PER_TICK = 125.0 / 0xffff
+
+JumpStats = collections.namedtuple('JumpStats', ['jumps', 'original_s', 'rewritten_s'])
+
+
+class SettleModel(object):
+    """
+    Times in XYMove ticks for a laser-off jump of dx_mm, dy_mm:
+        travel = max(min_travel_ticks, travel_ticks_per_mm * max(|dx_mm|, |dy_mm|))
+            since the galvos move at the same time;
+        settle = settle_ticks + settle_ticks_per_mm_x * |dx_mm|
+                              + settle_ticks_per_mm_y * |dy_mm|
+            which is conservative for diagonal jumps, where both galvos
+            ring at once.
+    The defaults give a jump across the 125 mm build area along one axis
+    the 200 + 100 ticks examples/stipple/stipple2flp.py gives every jump.
+    """
+    def __init__(self, travel_ticks_per_mm=1.6, min_travel_ticks=2,
+                 settle_ticks=10.0, settle_ticks_per_mm_x=0.72,
+                 settle_ticks_per_mm_y=0.72):
+        self.travel_ticks_per_mm = travel_ticks_per_mm
+        self.min_travel_ticks = min_travel_ticks
+        self.settle_ticks = settle_ticks
+        self.settle_ticks_per_mm_x = settle_ticks_per_mm_x
+        self.settle_ticks_per_mm_y = settle_ticks_per_mm_y
+
+    def jump_ticks(self, dx_mm, dy_mm):
+        """Returns (travel, settle) integer tick arrays for jumps of dx_mm, dy_mm."""
+        dx_mm = np.abs(np.asarray(dx_mm, dtype=float))
+        dy_mm = np.abs(np.asarray(dy_mm, dtype=float))
+        travel = np.maximum(self.min_travel_ticks,
+                            np.ceil(self.travel_ticks_per_mm * np.maximum(dx_mm, dy_mm)))
+        settle = np.ceil(self.settle_ticks +
+                         self.settle_ticks_per_mm_x * dx_mm +
+                         self.settle_ticks_per_mm_y * dy_mm)
+        return (np.minimum(travel, 0xffff).astype(int),
+                np.minimum(settle, 0xffff).astype(int))
+
+    def jump_ticks_polar(self, distance_mm, angle_rad):
+        """jump_ticks for a jump of distance_mm at angle_rad from the x axis."""
+        return self.jump_ticks(distance_mm * np.cos(angle_rad),
+                               distance_mm * np.sin(angle_rad))
+
+    @classmethod
+    def fit(cls, distance_mm, angle_rad, settle_ticks, **kwargs):
+        """
+        Fit the settle time to measured settle_ticks for jumps of
+        distance_mm at angle_rad (e.g. read off calibration_pattern).
+        kwargs set the travel parameters.
+        """
+        distance_mm = np.asarray(distance_mm, dtype=float)
+        angle_rad = np.asarray(angle_rad, dtype=float)
+        A = np.transpose([np.ones_like(distance_mm),
+                          np.abs(distance_mm * np.cos(angle_rad)),
+                          np.abs(distance_mm * np.sin(angle_rad))])
+        coefficients = np.linalg.lstsq(A, np.asarray(settle_ticks, dtype=float), rcond=None)[0]
+        # Settling never gets faster with distance.
+        base, per_mm_x, per_mm_y = np.maximum(coefficients, 0)
+        return cls(settle_ticks=base, settle_ticks_per_mm_x=per_mm_x,
+                   settle_ticks_per_mm_y=per_mm_y, **kwargs)
+
+
+def calibration_pattern(distances_mm=(0.5, 2, 8, 32), angles_deg=(0, 45, 90),
+                        settles_ticks=(0, 10, 20, 40, 80, 160), power=30000,
+                        line_mm=2.0, line_ticks=60, pitch_mm=4.0, model=None,
+                        mm_per_tick=MM_PER_TICK):
+    """
+    A single-layer job of test jumps, for fitting a SettleModel.
+    Each row of the pattern is one jump distance and angle, and each
+    column one settle time: the laser jumps (with the laser off) to the
+    start of a short line along the jump, waits that settle time, then
+    draws the line. Lines whose start is smeared or hooked didn't settle.
+    Rows are ordered by angle, then distance, from the bottom; columns by
+    settle time, from the left. The pattern is centered in the build area.
+    Jumps take model's travel time (by default SettleModel()'s).
+    """
+    if model is None:
+        model = SettleModel()
+    def to_ticks(xy_mm):
+        return tuple(int(round(v / mm_per_tick + 0x8000)) for v in xy_mm)
+    packets = FLP.Packets()
+    rows = [(d, np.radians(a)) for a in angles_deg for d in distances_mm]
+    width_mm = len(settles_ticks) * pitch_mm
+    height_mm = len(rows) * pitch_mm
+    for row, (distance_mm, angle) in enumerate(rows):
+        direction = np.array([np.cos(angle), np.sin(angle)])
+        for column, settle in enumerate(settles_ticks):
+            # Lines start at the center of their cell.
+            start_mm = np.array([(column + 0.5) * pitch_mm - width_mm / 2,
+                                 (row + 0.5) * pitch_mm - height_mm / 2])
+            from_mm = start_mm - direction * distance_mm
+            end_mm = start_mm + direction * line_mm
+            packets.append(FLP.LaserPowerLevel(0))
+            # Get to the jump's start and let everything settle.
+            packets.append(FLP.XYMove([to_ticks(from_mm) + (200,),
+                                       to_ticks(from_mm) + (200,)]))
+            travel = model.jump_ticks_polar(distance_mm, angle)[0]
+            points = [to_ticks(start_mm) + (int(travel),)]
+            if settle:
+                points.append(to_ticks(start_mm) + (int(settle),))
+            packets.append(FLP.XYMove(points))
+            packets.append(FLP.LaserPowerLevel(power))
+            packets.append(FLP.XYMove([to_ticks(end_mm) + (line_ticks,)]))
+    packets.append(FLP.LaserPowerLevel(0))
+    return packets
+
+
+def _jump_ticks(moves):
+    """Total ticks of a list of XYMoves."""
+    return sum(row[2] for move in moves for row in move._points)
+
+
+def rewrite_jumps(blocks, model=None, only_shorten=True, mm_per_tick=MM_PER_TICK):
+    """
+    Rewrite each laser-off jump to the travel and settle times of model
+    (a SettleModel; by default SettleModel()).
+    A jump is a run of XYMoves with the laser off, directly followed by
+    the laser turning on; it is replaced with one XYMove that goes
+    straight to where the run ends, then waits. Jumps from an unknown
+    position (before any XYMove) are left alone, as are jumps that would
+    get longer, unless only_shorten is False.
+    blocks is an FLP.Packets object or a list of them; the input is left
+    unchanged, and jumps don't run across blocks.
+    Returns (rewritten blocks in the same shape, JumpStats with the number
+    of jumps rewritten and their total time before and after).
+    """
+    if model is None:
+        model = SettleModel()
+    single = isinstance(blocks, FLP.Packets)
+    if single:
+        blocks = [blocks]
+    clock_Hz = FLP.XYMoveClockRate.moverate_Hz()
+    xy = None
+    power = 0
+    jumps = 0
+    original_ticks = rewritten_ticks = 0
+    result = []
+    for block in blocks:
+        out = FLP.Packets()
+        pending = [] # Laser-off XYMoves that may be a jump.
+        start = None # Where the galvos were before them.
+        for packet in block:
+            if isinstance(packet, FLP.XYMove) and packet.npoints and power == 0:
+                if not pending:
+                    start = xy
+                pending.append(packet)
+                xy = packet._points[-1][:2]
+                continue
+            if pending:
+                if (isinstance(packet, FLP.LaserPowerLevel) and packet.power > 0 and
+                    start is not None and tuple(start) != tuple(xy)):
+                    dx_mm, dy_mm = (np.subtract(xy, start) * mm_per_tick).tolist()
+                    travel, settle = (int(t) for t in model.jump_ticks(dx_mm, dy_mm))
+                    before = _jump_ticks(pending)
+                    if travel + settle < before or not only_shorten:
+                        pending = [FLP.XYMove([tuple(xy) + (travel,), tuple(xy) + (settle,)])]
+                        jumps += 1
+                        original_ticks += before
+                        rewritten_ticks += travel + settle
+                out.extend(pending)
+                pending = []
+            if isinstance(packet, FLP.LaserPowerLevel):
+                power = packet.power
+            elif isinstance(packet, FLP.XYMove) and packet.npoints:
+                xy = packet._points[-1][:2]
+            out.append(packet)
+        out.extend(pending)
+        result.append(out)
+    stats = JumpStats(jumps, original_ticks / clock_Hz, rewritten_ticks / clock_Hz)
+    return (result[0] if single else result), stats
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Simplify.py
+
+Drop redundant points from laser paths.
+
+Rasters and vector conversions produce long runs of collinear points
+at one power. These functions remove points that are within a tolerance
+of the simplified path (Douglas-Peucker, after a cheap pass that drops
+exactly collinear points), summing the dt of the removed segments into
+the next point kept, so total time is unchanged:
+
+    >>> from OpenFL import Simplify
+    >>> samples = Simplify.simplify_samples(samples, tolerance_mm=0.01)
+    >>> flp = Simplify.simplify_packets(flp, tolerance_ticks=2)
+
+Points where the power or the speed changes, and points the laser
+sits at for a while (zero-length segments with nonzero dt), are
+always kept.
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+
+import numpy as np
+
+from OpenFL import FLP
+
+
+def _distances(xy, a, b):
+    """Distance from each point in xy to the segment from a to b."""
+    ab = b - a
+    length2 = ab.dot(ab)
+    if length2 == 0:
+        return np.hypot(*(xy - a).T)
+    t = np.clip((xy - a).dot(ab) / length2, 0.0, 1.0)
+    return np.hypot(*(xy - (a + t[:, None] * ab)).T)
+
+
+def _douglas_peucker(xy, keep, tolerance):
+    """
+    Mark in keep the points needed to stay within tolerance of xy,
+    between each pair of points already kept.
+    """
+    anchors = list(np.flatnonzero(keep))
+    stack = list(zip(anchors[:-1], anchors[1:]))
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        d = _distances(xy[start + 1:end], xy[start], xy[end])
+        i = int(np.argmax(d))
+        if d[i] > tolerance:
+            split = start + 1 + i
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+
+def _speed_changes(step, dt, speed_tolerance):
+    """
+    Indices of the points where the time per unit length of the
+    segment after differs from the one before by more than
+    speed_tolerance (relative). Zero-length segments are skipped over.
+    """
+    length = np.hypot(*step.T)
+    moving = np.flatnonzero(length > 0)
+    if len(moving) < 2:
+        return np.array([], dtype=int)
+    pace = dt[1:][moving] / length[moving]
+    before, after = pace[:-1], pace[1:]
+    changed = np.abs(after - before) > speed_tolerance * np.maximum(before, after)
+    # The change happens at the start of the later segment.
+    return moving[1:][changed]
+
+
+def simplify_indices(xy, dt, tolerance, power=None, max_dt=None,
+                     speed_tolerance=0.05):
+    """
+    Return the indices of the points of a path to keep.
+    xy is an (n, 2) array of points; dt[i] is the time from point i-1
+    to point i. power[i], if given, is the power of that segment.
+    Points where dt per unit length changes by more than
+    speed_tolerance (relative) are kept, as are power changes.
+    Removed points' dt goes to the next point kept, which must not
+    add up to more than max_dt.
+    The first and last points are always kept.
+    """
+    xy = np.asarray(xy, dtype=float)
+    dt = np.asarray(dt)
+    n = len(xy)
+    if n <= 2:
+        return np.arange(n)
+    step = np.diff(xy, axis=0)
+    # Points that are always kept: the ends, the ends of dwells,
+    # and both ends of each run at one power.
+    fixed = np.zeros(n, dtype=bool)
+    fixed[[0, -1]] = True
+    dwells = np.flatnonzero(~step.any(axis=1) & (dt[1:] != 0)) + 1
+    fixed[dwells - 1] = True
+    fixed[dwells] = True
+    if power is not None:
+        power = np.asarray(power)
+        changes = np.flatnonzero(power[1:] != power[:-1]) + 1
+        fixed[changes - 1] = True
+        fixed[changes] = True
+    fixed[_speed_changes(step, dt, speed_tolerance)] = True
+    # Otherwise, collinear points are dropped without a closer look;
+    # only points where the path turns or backtracks go through
+    # Douglas-Peucker.
+    cross = step[:-1, 0] * step[1:, 1] - step[:-1, 1] * step[1:, 0]
+    dot = (step[:-1] * step[1:]).sum(axis=1)
+    scale = np.hypot(*step[:-1].T) * np.hypot(*step[1:].T)
+    turns = np.zeros(n, dtype=bool)
+    turns[1:-1] = (np.abs(cross) > 1e-9 * scale) | (dot < 0)
+    candidates = np.flatnonzero(fixed | turns)
+    keep = fixed[candidates]
+    _douglas_peucker(xy[candidates], keep, tolerance)
+    kept = candidates[keep]
+
+    if max_dt is not None:
+        kept = _limit_dt(kept, dt, max_dt)
+    return kept
+
+
+def _limit_dt(kept, dt, max_dt):
+    """Put back points so no kept point collects more than max_dt."""
+    elapsed = np.concatenate([[0], np.cumsum(dt[1:])])
+    result = [kept[0]]
+    for k in kept[1:]:
+        while elapsed[k] - elapsed[result[-1]] > max_dt:
+            # The furthest point that still fits; at least the next one.
+            i = np.searchsorted(elapsed, elapsed[result[-1]] + max_dt, side='right') - 1
+            result.append(max(i, result[-1] + 1))
+        result.append(k)
+    return np.array(result)
+
+
+def _merge_dt(dt, kept):
+    """The dt of each kept point: the sum since the previous kept point."""
+    elapsed = np.concatenate([[0], np.cumsum(dt[1:])])
+    return np.concatenate([[dt[0]], np.diff(elapsed[kept])])
+
+
+def simplify_samples(samples, tolerance_mm, power_tolerance_mW=0.0,
+                     speed_tolerance=0.05):
+    """
+    Simplify an (n, 4) array of x_mm, y_mm, dt_s, mW samples, where each
+    row is a move from the previous row's point taking dt_s at mW
+    (as image_to_laser_moves_xy_mm_dt_s_mW and samples_to_FLP use).
+    Segments whose power differs by more than power_tolerance_mW, or
+    whose speed differs by more than speed_tolerance (relative),
+    are never merged.
+    """
+    samples = np.asarray(samples, dtype=float)
+    power = samples[:, 3]
+    if power_tolerance_mW > 0:
+        power = np.round(power / power_tolerance_mW)
+    kept = simplify_indices(samples[:, :2], samples[:, 2], tolerance_mm,
+                            power=power, speed_tolerance=speed_tolerance)
+    result = samples[kept].copy()
+    result[:, 2] = _merge_dt(samples[:, 2], kept)
+    return result
+
+
+def simplify_xymove(move, tolerance_ticks, start_xy=None, speed_tolerance=0.05):
+    """
+    Return a simplified copy of an XYMove.
+    start_xy is where the galvos are before the move, if known;
+    the segment from there is then simplified too.
+    """
+    points = np.array(move._points, dtype=np.int64).reshape(-1, 3)
+    if start_xy is not None:
+        points = np.vstack([[start_xy[0], start_xy[1], 0], points])
+    kept = simplify_indices(points[:, :2], points[:, 2], tolerance_ticks,
+                            max_dt=0xffff, speed_tolerance=speed_tolerance)
+    rows = np.hstack([points[kept, :2], _merge_dt(points[:, 2], kept)[:, None]])
+    if start_xy is not None:
+        rows = rows[1:]
+    result = FLP.XYMove()
+    result.points = [tuple(r) for r in rows.tolist()]
+    return result
+
+
+def simplify_packets(packets, tolerance_ticks, speed_tolerance=0.05):
+    """Return a copy of packets with every XYMove simplified."""
+    result = FLP.Packets()
+    xy = None
+    for p in packets:
+        if isinstance(p, FLP.XYMove) and p.npoints:
+            p = simplify_xymove(p, tolerance_ticks, start_xy=xy,
+                                speed_tolerance=speed_tolerance)
+            xy = p._points[-1][:2]
+        result.append(p)
+    return result
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
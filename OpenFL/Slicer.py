@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Slicer.py
+
+Slice an STL file into a print, one block per layer, with the exposure
+and peel settings of a material file:
+
+    >>> from OpenFL import Material, Printer, Slicer
+    >>> p = Printer.Printer()
+    >>> blocks, stats = Slicer.slice_stl('part.stl', Material.Material('Form_1+_FLGPCL02_100.ini'), p)
+    >>> for i, block in enumerate(blocks):
+    ...     p.write_block(i, block)
+
+Each layer is cut at the middle of its SliceHeight, the cut segments
+are joined into polygons, and Toolpath draws their outlines and fill
+at the model [perimeter] and [fill] settings, as many passes as
+[laserRoutine] asks for. Then the tank peels and the platform rises by
+one layer, as [btwnLayerRoutine] describes. The part is centered in
+the build area, scaled by Xcorrectionfactor and Ycorrectionfactor.
+
+Layers are sliced and compiled on a pool of processes, each with the
+whole mesh, so the printer's calibration is read once up front.
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import collections
+import re
+
+import numpy as np
+
+from OpenFL import FLP, Printer, Timing, Toolpath
+
+try: # Since python3 doesn't have basestring:
+    basestring
+except NameError:
+    basestring = str
+
+# The tilt motor isn't documented in mm; the homing sequence's
+# 4000 ustep peel is p1downmove = 10 mm, so it steps like z.
+TILT_USTEPS_PER_MM = 400.0
+# Layers that cure this much area get the longest squish wait
+# (as Peel.PeelBounds' full_area_mm2).
+FULL_AREA_MM2 = 2000.0
+
+STL_DTYPE = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+
+LayerStats = collections.namedtuple('LayerStats', ['layer', 'polygons', 'open_loops',
+                                                   'area_mm2', 'passes'])
+
+
+def read_stl(fileHandle):
+    """
+    Read a binary (or ASCII) STL file, by name or open in binary mode.
+    Returns an array of shape nx3x3: the corners of each triangle.
+    """
+    if isinstance(fileHandle, basestring):
+        with open(fileHandle, 'rb') as fh:
+            data = fh.read()
+    else:
+        data = fileHandle.read()
+    if len(data) >= 84:
+        count = int(np.frombuffer(data[80:84], dtype='<u4')[0])
+        if len(data) == 84 + count * STL_DTYPE.itemsize:
+            triangles = np.frombuffer(data[84:], dtype=STL_DTYPE, count=count)
+            return triangles['vertices'].astype(float)
+    if data.lstrip()[:5].lower() != b'solid':
+        raise ValueError('Not an STL file.')
+    numbers = re.findall(br'vertex\s+(\S+)\s+(\S+)\s+(\S+)', data)
+    return np.array(numbers, dtype=float).reshape(-1, 3, 3)
+
+
+class Mesh(object):
+    """
+    Triangles with shared corners, ready to slice.
+    Corners that are exactly equal are the same vertex, so the slices
+    of neighboring triangles meet exactly. As in STL files, corners go
+    counter-clockwise seen from outside the solid.
+    """
+    def __init__(self, triangles):
+        triangles = np.asarray(triangles, dtype=float).reshape(-1, 3, 3)
+        self.vertices, corners = np.unique(triangles.reshape(-1, 3), axis=0,
+                                           return_inverse=True)
+        self.faces = corners.reshape(-1, 3)
+        # Drop triangles with repeated corners; they have no area.
+        f = self.faces
+        self.faces = f[(f[:,0] != f[:,1]) & (f[:,1] != f[:,2]) & (f[:,2] != f[:,0])]
+        z = self.vertices[self.faces, 2]
+        self.zmin, self.zmax = z.min(axis=1), z.max(axis=1)
+
+    @property
+    def bounds(self):
+        """(lowest corner, highest corner) of the mesh."""
+        return self.vertices.min(axis=0), self.vertices.max(axis=0)
+
+    def transformed(self, scale=(1, 1, 1), offset=(0, 0, 0)):
+        """A copy with every vertex scaled, then offset."""
+        result = Mesh.__new__(Mesh)
+        result.__dict__.update(self.__dict__)
+        result.vertices = self.vertices * scale + offset
+        result.zmin = self.zmin * scale[2] + offset[2]
+        result.zmax = self.zmax * scale[2] + offset[2]
+        return result
+
+    def segments(self, z_mm):
+        """
+        Cut the triangles crossing z = z_mm (corners on the plane count
+        as above it, so a cut through corners gives the section just
+        below them). Returns (segments, an mx2x2 array of x, y end
+        points oriented with the solid on their left, and the mx2 vertex
+        pairs of the edges each segment starts and ends on).
+        """
+        # A triangle crosses if it has corners on both sides; one that
+        # only touches the plane from above has no cut edges.
+        crossing = np.flatnonzero((self.zmin < z_mm) & (self.zmax >= z_mm))
+        faces = self.faces[crossing]
+        above = self.vertices[faces, 2] >= z_mm
+        edges = np.stack([faces, np.roll(faces, -1, axis=1)], axis=-1) # t x 3 x 2
+        # Going around the triangle, it crosses down through the plane
+        # once and back up once; the solid is on the left of the cut
+        # from the edge going down to the edge going up. This holds
+        # even when the cut is a single corner on the plane.
+        after = np.roll(above, -1, axis=1)
+        rows = np.arange(len(faces))
+        edges = np.stack([edges[rows, np.argmax(above & ~after, axis=1)],
+                          edges[rows, np.argmax(~above & after, axis=1)]], axis=1)
+        # Cut each edge from its lower-numbered vertex, so both
+        # triangles sharing it get exactly the same point.
+        edges.sort(axis=-1)
+        a, b = self.vertices[edges[...,0]], self.vertices[edges[...,1]]
+        t = (z_mm - a[...,2]) / (b[...,2] - a[...,2])
+        points = a[...,:2] + t[...,None] * (b[...,:2] - a[...,:2])
+        return points, edges
+
+    def slice(self, z_mm):
+        """
+        The cross-section at z = z_mm as a list of polygons
+        (see Toolpath), and the number of loops that didn't close
+        (which are left out).
+        """
+        points, edges = self.segments(z_mm)
+        if not len(points):
+            return [], 0
+        n = len(self.vertices)
+        start = edges[:,0,0] * n + edges[:,0,1]
+        end = edges[:,1,0] * n + edges[:,1,1]
+        order = np.argsort(start)
+        i = np.searchsorted(start[order], end)
+        i = np.minimum(i, len(start) - 1)
+        following = np.where(start[order][i] == end, order[i], -1).tolist()
+        used = np.zeros(len(start), dtype=bool)
+        polygons = []
+        open_loops = 0
+        for first in range(len(start)):
+            if used[first]:
+                continue
+            loop = [first]
+            used[first] = True
+            s = following[first]
+            while s >= 0 and not used[s]:
+                loop.append(s)
+                used[s] = True
+                s = following[s]
+            if s != first:
+                open_loops += 1
+            elif len(loop) >= 3:
+                polygons.append(points[loop, 0])
+        return polygons, open_loops
+
+
+def _passes(material, layer):
+    """Laser passes for a layer, per [laserRoutine] (see material_file_description.md)."""
+    routine = material['laserRoutine']
+    if layer == 0:
+        return int(routine['firstlayerpasses'])
+    if layer < material['btwnLayerRoutine']['earlytimesexpose']:
+        return int(routine['earlylayerpasses'])
+    return int(routine['otherlayerpasses'])
+
+
+def peel(material, layer, z_usteps, area_mm2=0.0, full_area_mm2=FULL_AREA_MM2):
+    """
+    The packets between a layer's exposure and the next: the cure
+    wait, the peel of [btwnLayerRoutine] with z rising by z_usteps
+    while the tank is down, and the squish wait, from squishwaitmin_s
+    up to squishwaitmax_s for layers that cure full_area_mm2.
+    """
+    routine = material['btwnLayerRoutine']
+    p = 'p1' if layer <= routine['earlytimespeel'] else 'p2'
+    def tilt(role):
+        feedrate = int(round(routine['{}{}vel'.format(p, role)] * TILT_USTEPS_PER_MM))
+        usteps = int(round(routine['{}{}move'.format(p, role)] * TILT_USTEPS_PER_MM))
+        return [FLP.TiltFeedRate(feedrate), FLP.TiltMove(usteps)]
+    fraction = min(1.0, area_mm2 / full_area_mm2)
+    squish_s = (routine['squishwaitmin_s'] +
+                fraction * (routine['squishwaitmax_s'] - routine['squishwaitmin_s']))
+    return FLP.Packets([FLP.LaserPowerLevel(0), FLP.Dwell(s=routine['postlasercurewait'])] +
+                       tilt('down') + [FLP.WaitForMovesToComplete(),
+                                       FLP.ZFeedRate(Timing.DEFAULT_Z_FEEDRATE),
+                                       FLP.ZMove(z_usteps), FLP.WaitForMovesToComplete()] +
+                       tilt('up') + tilt('upslow') + [FLP.WaitForMovesToComplete(),
+                                                      FLP.Dwell(s=squish_s)])
+
+
+class _Job(object):
+    """What each worker needs to slice and compile a layer."""
+    def __init__(self, mesh, material, printer, slice_height_mm, hatch_angles_rad,
+                 full_area_mm2):
+        self.mesh = mesh
+        self.material = material
+        self.printer = printer
+        self.slice_height_mm = slice_height_mm
+        self.hatch_angles_rad = hatch_angles_rad
+        self.full_area_mm2 = full_area_mm2
+        self.settings = Toolpath.settings(material)
+        self.exposures = dict((section, (material[section]['modellaserpowermw'],
+                                         material[section]['modelxyfeedrate']))
+                              for section in ('perimeter', 'fill'))
+
+    def z_usteps(self, layer):
+        """How far z rises after layer, keeping the total on the microstep grid."""
+        usteps_per_layer = self.slice_height_mm * FLP.ZMove.usteps_up_per_mm
+        return int(round((layer + 1) * usteps_per_layer)) - int(round(layer * usteps_per_layer))
+
+    def layer(self, layer):
+        """Returns (the layer's block as bytes, LayerStats)."""
+        polygons, open_loops = self.mesh.slice((layer + 0.5) * self.slice_height_mm)
+        area_mm2 = float(sum(Toolpath.signed_area(p) for p in polygons))
+        passes = _passes(self.material, layer)
+        angle = self.hatch_angles_rad[layer % len(self.hatch_angles_rad)]
+        paths = Toolpath.layer_paths(polygons, self.settings, angle)
+        block = FLP.Packets([FLP.LayerStart(layer)])
+        if paths:
+            samples = Toolpath.paths_to_samples(paths * passes, self.exposures)
+            block.extend(self.printer.samples_to_FLP(samples))
+        block.extend(peel(self.material, layer, self.z_usteps(layer), area_mm2,
+                          self.full_area_mm2))
+        block.append(FLP.LayerDone())
+        return block.tostring(), LayerStats(layer, len(polygons), open_loops, area_mm2, passes)
+
+
+_job = None
+
+def _init_worker(job):
+    global _job
+    _job = job
+
+def _slice_layer(layer):
+    """Slice a layer of the worker's _Job; at module level so it can run on a pool."""
+    return _job.layer(layer)
+
+
+def calibration(printer, galvo_model=None):
+    """
+    A Printer that compiles samples (Printer.samples_to_FLP) with
+    printer's laser table and galvo_model (by default
+    printer.fit_galvo_model()) without talking to it, so that it can
+    be sent to other processes.
+    """
+    result = Printer.Printer(connect=False)
+    result._laser_table = np.asarray(printer.read_laser_table())
+    result.mm_to_galvo = galvo_model if galvo_model is not None else printer.fit_galvo_model()
+    return result
+
+
+def slice_mesh(mesh, material, printer, processes=None, galvo_model=None,
+               hatch_angles_rad=(0.0,), full_area_mm2=FULL_AREA_MM2):
+    """
+    Slice a Mesh (in mm, already placed in the build area) into blocks.
+    printer supplies the laser and galvo calibration (see calibration).
+    Layer n is cut at (n + 1/2) * SliceHeight, and hatched at
+    hatch_angles_rad[n % len(hatch_angles_rad)].
+    Layers are sliced on a pool of processes (by default one per CPU);
+    processes=0 slices them in this one.
+    Returns (a list of FLP.Packets, one per layer; a list of LayerStats).
+    """
+    slice_height_mm = material['PrintSettings']['sliceheight']
+    layers = int(np.ceil(mesh.bounds[1][2] / slice_height_mm - 0.5))
+    job = _Job(mesh, material, calibration(printer, galvo_model), slice_height_mm,
+               tuple(hatch_angles_rad), full_area_mm2)
+    if processes == 0:
+        results = [job.layer(layer) for layer in range(layers)]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, _init_worker, (job,))
+        try:
+            chunksize = max(1, layers // (4 * (processes or multiprocessing.cpu_count())))
+            results = pool.map(_slice_layer, range(layers), chunksize=chunksize)
+        finally:
+            pool.terminate()
+    return [FLP.fromstring(data) for data, _ in results], [stats for _, stats in results]
+
+
+def slice_stl(stl, material, printer, **kwargs):
+    """
+    Slice an STL file (see read_stl) as slice_mesh does, after centering
+    it in the build area, scaling it by the material's
+    Xcorrectionfactor and Ycorrectionfactor and putting its lowest
+    point on the platform.
+    """
+    mesh = Mesh(read_stl(stl))
+    lo, hi = mesh.bounds
+    s = material['PrintSettings']
+    scale = np.array([s['xcorrectionfactor'], s['ycorrectionfactor'], 1.0])
+    center = (lo + hi) / 2
+    mesh = mesh.transformed(scale, [-center[0] * scale[0], -center[1] * scale[1], -lo[2]])
+    return slice_mesh(mesh, material, printer, **kwargs)
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
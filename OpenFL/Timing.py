@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Timing.py
+
+A model of how long FLP packets take to execute on a Form 1/1+.
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+
+from OpenFL import FLP
+
+# Feed rates assumed until a block sets its own (in usteps/s).
+DEFAULT_Z_FEEDRATE = 4000
+DEFAULT_TILT_FEEDRATE = 1600
+
+
+class PrintClock(object):
+    """
+    Tracks when each packet finishes executing.
+    * XYMoves take the sum of their dt ticks at XYMoveClockRate.
+    * Dwell sleeps; in-progress motor moves keep going.
+    * ZMove and TiltMove start as soon as their motor is free and
+      run in the background at the last feed rate for that motor.
+    * WaitForMovesToComplete blocks until both motors are idle.
+    Everything else is treated as instantaneous, including
+    WaitButtonPress and WaitOnPinCommand, which wait on the outside world.
+    """
+    def __init__(self,
+                 zFeedRate_usteps_per_s=DEFAULT_Z_FEEDRATE,
+                 tiltFeedRate_usteps_per_s=DEFAULT_TILT_FEEDRATE):
+        self.t_s = 0.0
+        self.zFeedRate_usteps_per_s = zFeedRate_usteps_per_s
+        self.tiltFeedRate_usteps_per_s = tiltFeedRate_usteps_per_s
+        self.zBusyUntil_s = 0.0
+        self.tiltBusyUntil_s = 0.0
+
+    def copy(self):
+        result = PrintClock()
+        result.__dict__.update(self.__dict__)
+        return result
+
+    @staticmethod
+    def _moveDuration_s(usteps, feedrate):
+        # A zero feed rate would never finish; treat it as unknown (free).
+        if not feedrate:
+            return 0.0
+        return abs(usteps) / feedrate
+
+    def step(self, packet):
+        """Execute one packet, returning the time at which it finishes."""
+        if isinstance(packet, FLP.XYMove):
+            self.t_s += (sum(row[2] for row in packet._points) /
+                         FLP.XYMoveClockRate.moverate_Hz())
+        elif isinstance(packet, FLP.Dwell):
+            self.t_s += packet.duration_s
+        elif isinstance(packet, FLP.ZFeedRate):
+            self.zFeedRate_usteps_per_s = packet.feedrate
+        elif isinstance(packet, FLP.TiltFeedRate):
+            self.tiltFeedRate_usteps_per_s = packet.feedrate
+        elif isinstance(packet, FLP.ZMove):
+            self.zBusyUntil_s = (max(self.t_s, self.zBusyUntil_s) +
+                                 self._moveDuration_s(packet.usteps,
+                                                      self.zFeedRate_usteps_per_s))
+        elif isinstance(packet, FLP.TiltMove):
+            self.tiltBusyUntil_s = (max(self.t_s, self.tiltBusyUntil_s) +
+                                    self._moveDuration_s(packet.usteps,
+                                                         self.tiltFeedRate_usteps_per_s))
+        elif isinstance(packet, FLP.WaitForMovesToComplete):
+            self.wait()
+        return self.t_s
+
+    def wait(self):
+        """Block until both motors are idle, returning the time."""
+        self.t_s = max(self.t_s, self.zBusyUntil_s, self.tiltBusyUntil_s)
+        return self.t_s
+
+    def run(self, packets):
+        """Execute all packets, returning the time at which the last finishes."""
+        for packet in packets:
+            self.step(packet)
+        return self.t_s
+
+
+def duration_s(packets, clock=None):
+    """
+    Return the predicted time to execute packets,
+    including waiting for any motor moves still in progress at the end.
+    If clock is given, it is advanced in place (which carries feed rates
+    over from earlier packets); otherwise a fresh PrintClock is used.
+    """
+    if clock is None:
+        clock = PrintClock()
+    start_s = clock.t_s
+    clock.run(packets)
+    return clock.wait() - start_s
+
+
+def insert_time_remaining(blocks, clock=None):
+    """
+    Simulate a whole print and set its TimeRemaining packets.
+    blocks is an FLP.Packets object or a list of them, printed in order;
+    the result has the same shape and the input is left unchanged.
+
+    Each layer (from the start of a block or a LayerStart to the next)
+    gets the predicted time left in the print at that point:
+    TimeRemaining packets already in a layer are rewritten in place,
+    and a layer without one gets one at its start, just after its LayerStart.
+    """
+    single = isinstance(blocks, FLP.Packets)
+    if single:
+        blocks = [blocks]
+    if clock is None:
+        clock = PrintClock()
+
+    # Pass 1: when does each packet start, and when does the print end?
+    starts_s = []
+    for block in blocks:
+        times = []
+        for packet in block:
+            times.append(clock.t_s)
+            clock.step(packet)
+        starts_s.append(times)
+    end_s = clock.wait()
+
+    def remaining(t_s):
+        return FLP.TimeRemaining(int(round(end_s - t_s)))
+
+    # Pass 2: split each block into layers and fill in the times.
+    result = []
+    for block, times in zip(blocks, starts_s):
+        layers = [[]]
+        for i, packet in enumerate(block):
+            if isinstance(packet, FLP.LayerStart) and layers[-1]:
+                layers.append([])
+            layers[-1].append(i)
+        out = FLP.Packets()
+        for layer in layers:
+            if not layer:
+                continue # An empty block
+            if not any(isinstance(block[i], FLP.TimeRemaining) for i in layer):
+                # Insert after the LayerStart, if there is one.
+                head = 1 if isinstance(block[layer[0]], FLP.LayerStart) else 0
+                for i in layer[:head]:
+                    out.append(block[i])
+                at_s = times[layer[min(head, len(layer) - 1)]]
+                out.append(remaining(at_s))
+                layer = layer[head:]
+            for i in layer:
+                if isinstance(block[i], FLP.TimeRemaining):
+                    out.append(remaining(times[i]))
+                else:
+                    out.append(block[i])
+        result.append(out)
+    return result[0] if single else result
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
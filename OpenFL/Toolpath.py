@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+"""
+Toolpath.py
+
+Turn the polygons of a layer into laser paths: outlines offset in
+from the perimeter and scanline fill inside them, as the
+[PrintSettings] of a material file describe (see
+material_file_description.md):
+
+    >>> from OpenFL import Material, Toolpath
+    >>> settings = Toolpath.settings(Material.Material('Form_1+_FLGPCL02_100.ini'))
+    >>> paths = Toolpath.layer_paths(polygons, settings)
+    >>> samples = Toolpath.paths_to_samples(paths, {'perimeter': (48.0, 800.0),
+    ...                                             'fill': (62.0, 1550.0)})
+    >>> flp = printer.samples_to_FLP(samples)
+
+Polygons are (n, 2) arrays of vertices in mm, counter-clockwise around
+solid and clockwise around holes. Areas are filled where they wind
+positively, so overlapping polygons fill as their union.
+
+Copyright 2016-2017 Formlabs
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, print_function
+import collections
+
+import numpy as np
+
+from OpenFL import FLP
+
+Settings = collections.namedtuple('Settings', ['scanline_spacing_mm', 'offsets_num',
+                                               'outer_offset_mm', 'inner_offset_mm',
+                                               'scanline_offset_mm'])
+# As in Form_1+_FLGPCL02_100.ini.
+DEFAULT_SETTINGS = Settings(0.09, 3, 0.03, 0.12, 0.03)
+
+# A path is a polyline xy (an (n, 2) array) with the laser on for
+# segment i if on[i]; closed paths end where they start. section
+# ('perimeter' or 'fill') picks its power and speed.
+Path = collections.namedtuple('Path', ['xy', 'on', 'closed', 'section'])
+
+
+def settings(material):
+    """The Settings in a Material.Material's [PrintSettings]."""
+    s = material['PrintSettings']
+    return Settings(s['scanlinespacing'], int(s['offsetsnum']),
+                    s['outerboundaryoffset'], s['innerboundaryoffset'],
+                    s['scanlineboundaryoffset'])
+
+
+def signed_area(polygon):
+    """Positive for counter-clockwise polygons."""
+    x, y = np.asarray(polygon, dtype=float).T
+    return (np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+
+def _clean(polygon, eps=1e-9):
+    """Drop repeated vertices and vertices in the middle of straight edges."""
+    p = np.asarray(polygon, dtype=float)
+    while len(p) >= 3:
+        a, b = np.roll(p, 1, axis=0) - p, np.roll(p, -1, axis=0) - p
+        repeated = np.hypot(*b.T) <= eps
+        straight = (np.abs(a[:,0] * b[:,1] - a[:,1] * b[:,0]) <=
+                    eps * np.hypot(*a.T) * np.hypot(*b.T)) & ((a * b).sum(axis=1) < 0)
+        drop = repeated | straight
+        if not drop.any():
+            break
+        p = p[~drop]
+    return p
+
+
+def _offset_ring(polygon, distance_mm, miter_limit):
+    p = _clean(polygon)
+    if len(p) < 3:
+        return None
+    u = np.roll(p, -1, axis=0) - p
+    u /= np.hypot(*u.T)[:, None]
+    # Each edge moves to its left, which is into the solid for
+    # counter-clockwise outlines and clockwise holes alike.
+    origin = p + distance_mm * np.transpose([-u[:,1], u[:,0]])
+    while True:
+        if len(origin) < 3:
+            return None
+        # Vertex j is where offset edges j - 1 and j meet.
+        o0, u0 = np.roll(origin, 1, axis=0), np.roll(u, 1, axis=0)
+        cross = u0[:,0] * u[:,1] - u0[:,1] * u[:,0]
+        w = origin - o0
+        parallel = np.abs(cross) < 1e-12
+        t = (w[:,0] * u[:,1] - w[:,1] * u[:,0]) / np.where(parallel, 1, cross)
+        q = np.where(parallel[:, None], origin, o0 + t[:, None] * u0)
+        # Edges that come out backwards were shorter than the offset.
+        backwards = ((np.roll(q, -1, axis=0) - q) * u).sum(axis=1) < -1e-12
+        if not backwards.any():
+            break
+        origin, u = origin[~backwards], u[~backwards]
+    # Where the offset turns away from the corner, cut the miter off
+    # where the rounded corner would begin.
+    cosine = np.clip((u0 * u).sum(axis=1), -1, 1)
+    bevel = (cross * distance_mm < 0) & (2 / (1 + cosine + 1e-12) > miter_limit ** 2)
+    if bevel.any():
+        back = abs(distance_mm) * np.sqrt((1 - cosine[bevel]) / (1 + cosine[bevel] + 1e-12))
+        rows = np.repeat(np.arange(len(q)), 1 + bevel)
+        q = q[rows]
+        first = np.flatnonzero(bevel[rows] & (np.diff(np.concatenate([[-1], rows])) > 0))
+        q[first] -= back[:, None] * u0[bevel]
+        q[first + 1] += back[:, None] * u[bevel]
+    if signed_area(q) * signed_area(p) <= 0:
+        return None # Turned inside out: the offset swallowed it.
+    return q
+
+
+def offset(polygons, distance_mm, miter_limit=2.0):
+    """
+    Offset polygons distance_mm into the solid (out of it if negative).
+    Corners sharper than miter_limit are bevelled. Edges shorter than the
+    offset are dropped and polygons that vanish are removed, but where
+    distant parts of a polygon meet, the result overlaps itself; those
+    overlaps wind negatively, so they aren't filled.
+    """
+    result = (_offset_ring(p, distance_mm, miter_limit) for p in polygons)
+    return [p for p in result if p is not None]
+
+
+def _edges(polygons, clear=()):
+    """
+    An array of shape nx5 where each row is x0, y0, x1, y1, layer for
+    an edge of polygons (layer 0) or clear (layer 1).
+    """
+    edges = [np.zeros((0, 5))]
+    for layer, group in enumerate((polygons, clear)):
+        for polygon in group:
+            polygon = np.asarray(polygon, dtype=float)
+            edges.append(np.hstack([polygon, np.roll(polygon, -1, axis=0),
+                                    np.full((len(polygon), 1), layer)]))
+    return np.vstack(edges)
+
+
+def hatch_spans(polygons, spacing_mm, clear=()):
+    """
+    Scanlines spacing_mm apart (at y = (k + 1/2) * spacing_mm) through
+    the area that polygons wind positively around and clear does not.
+    Every edge is intersected with every scanline it crosses at once.
+    Returns an array of shape nx3 where each row is y_mm, x0_mm, x1_mm,
+    sorted by y, then x.
+    """
+    edges = _edges(polygons, clear)
+    if not len(edges):
+        return np.zeros((0, 3))
+    x0, y0, x1, y1, layer = edges.T
+    # Scanline k crosses an edge if its y is in [min(y0, y1), max(y0, y1)).
+    k0 = np.ceil(np.minimum(y0, y1) / spacing_mm - 0.5).astype(np.int64)
+    k1 = np.ceil(np.maximum(y0, y1) / spacing_mm - 0.5).astype(np.int64)
+    counts = k1 - k0
+    e = np.repeat(np.arange(len(x0)), counts)
+    k = np.arange(len(e)) - np.repeat(np.cumsum(counts) - counts, counts) + k0[e]
+    y = (k + 0.5) * spacing_mm
+    x = x0[e] + (y - y0[e]) * (x1[e] - x0[e]) / (y1[e] - y0[e])
+    # Going left to right, a downward edge of a counter-clockwise
+    # polygon is a way in; an upward edge a way out.
+    winding = np.where(y1[e] < y0[e], 1, -1)
+    order = np.lexsort((x, k))
+    x, y, winding, layer = x[order], y[order], winding[order], layer[e][order]
+    # Windings add up to zero at the end of each scanline.
+    inside = ((np.cumsum(winding * (layer == 0)) > 0) &
+              (np.cumsum(winding * (layer == 1)) <= 0))
+    before = np.concatenate([[False], inside[:-1]])
+    starts = np.flatnonzero(inside & ~before)
+    ends = np.flatnonzero(~inside & before)
+    spans = np.transpose([y[starts], x[starts], x[ends]])
+    return spans[spans[:,2] > spans[:,1]]
+
+
+def _strips(spans, spacing_mm):
+    """
+    Group spans into strips: runs down consecutive scanlines where
+    each span overlaps exactly one span on the next, and that one
+    overlaps only it. Returns a list of arrays of span indices.
+    """
+    k = np.round(spans[:,0] / spacing_mm - 0.5).astype(np.int64)
+    rows, first = np.unique(k, return_index=True)
+    bounds = np.append(first, len(spans))
+    following = np.full(len(spans), -1)
+    for r in range(len(rows) - 1):
+        if rows[r + 1] != rows[r] + 1:
+            continue
+        a = slice(bounds[r], bounds[r + 1])
+        b = slice(bounds[r + 1], bounds[r + 2])
+        ax0, ax1 = spans[a, 1], spans[a, 2]
+        bx0, bx1 = spans[b, 1], spans[b, 2]
+        # Spans on a scanline are disjoint and sorted, so the ones
+        # overlapping an interval are a contiguous range.
+        alo = np.searchsorted(bx1, ax0, side='right')
+        ahi = np.searchsorted(bx0, ax1, side='left')
+        blo = np.searchsorted(ax1, bx0, side='right')
+        bhi = np.searchsorted(ax0, bx1, side='left')
+        single = np.flatnonzero(ahi - alo == 1)
+        single = single[bhi[alo[single]] - blo[alo[single]] == 1]
+        following[bounds[r] + single] = bounds[r + 1] + alo[single]
+    heads = np.ones(len(spans), dtype=bool)
+    heads[following[following >= 0]] = False
+    following = following.tolist()
+    strips = []
+    for i in np.flatnonzero(heads).tolist():
+        strip = [i]
+        while following[strip[-1]] >= 0:
+            strip.append(following[strip[-1]])
+        strips.append(np.array(strip))
+    return strips
+
+
+def hatch(polygons, spacing_mm, angle_rad=0.0, clear=()):
+    """
+    Fill polygons with scanlines spacing_mm apart at angle_rad,
+    as in hatch_spans. Scanlines are grouped into strips drawn back
+    and forth, with short laser-off steps between them.
+    Returns a list of Paths in the 'fill' section.
+    """
+    c, s = np.cos(angle_rad), np.sin(angle_rad)
+    to_scan = np.array([[c, -s], [s, c]])
+    spans = hatch_spans([np.dot(p, to_scan) for p in polygons], spacing_mm,
+                        clear=[np.dot(p, to_scan) for p in clear])
+    if not len(spans):
+        return []
+    paths = []
+    for strip in _strips(spans, spacing_mm):
+        y, x0, x1 = spans[strip].T
+        reverse = np.arange(len(strip)) % 2 == 1
+        xs = np.transpose([np.where(reverse, x1, x0), np.where(reverse, x0, x1)]).ravel()
+        xy = np.transpose([xs, np.repeat(y, 2)]).dot(to_scan.T)
+        on = np.arange(len(xy) - 1) % 2 == 0
+        paths.append(Path(xy, on, False, 'fill'))
+    return paths
+
+
+def outline(polygons, section='perimeter'):
+    """Paths that trace each polygon."""
+    return [Path(np.vstack([p, p[:1]]), np.ones(len(p), dtype=bool), True, section)
+            for p in (np.asarray(p, dtype=float) for p in polygons) if len(p) >= 2]
+
+
+def _runs(counts):
+    """(i, j) for j in range(counts[i]) for each i, as two arrays."""
+    i = np.repeat(np.arange(len(counts)), counts)
+    return i, np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def _bands(edges, count):
+    """
+    Split the edges' y range into count bands. Returns (the count + 1
+    bounds of the bands, with the outer ones reaching to infinity; for
+    each band, the indices of the edges reaching into it).
+    """
+    ylo = np.minimum(edges[:,1], edges[:,3])
+    yhi = np.maximum(edges[:,1], edges[:,3])
+    bounds = np.linspace(ylo.min(), yhi.max(), count + 1)
+    bounds[0], bounds[-1] = -np.inf, np.inf
+    b0 = np.clip(np.searchsorted(bounds, ylo, side='left') - 1, 0, count - 1)
+    b1 = np.clip(np.searchsorted(bounds, yhi, side='right') - 1, 0, count - 1)
+    edge, offset = _runs(b1 - b0 + 1)
+    band = b0[edge] + offset
+    order = np.argsort(band, kind='mergesort')
+    return bounds, np.split(edge[order], np.searchsorted(band[order], np.arange(1, count)))
+
+
+def _cross(a, b):
+    return a[...,0] * b[...,1] - a[...,1] * b[...,0]
+
+
+def _cuts(edges, bands):
+    """
+    Where each edge crosses or overlaps another, as (edge indices,
+    fractions along them strictly between 0 and 1).
+    """
+    lo = np.minimum(edges[:,:2], edges[:,2:4])
+    hi = np.maximum(edges[:,:2], edges[:,2:4])
+    index, fraction = [], []
+    for e in bands:
+        # Pair each edge with the ones starting later in x, but
+        # before it ends, then check they overlap in y too.
+        e = e[np.argsort(lo[e,0], kind='mergesort')]
+        last = np.searchsorted(lo[e,0], hi[e,0], side='right')
+        i, j = _runs(np.maximum(last - np.arange(1, len(e) + 1), 0))
+        i, j = e[i], e[i + 1 + j]
+        near = (lo[i,1] <= hi[j,1]) & (lo[j,1] <= hi[i,1])
+        i, j = i[near], j[near]
+        p, r = edges[i,:2], edges[i,2:4] - edges[i,:2]
+        q, s = edges[j,:2], edges[j,2:4] - edges[j,:2]
+        d, qp = _cross(r, s), q - p
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t, u = _cross(qp, s) / d, _cross(qp, r) / d
+            crossing = (d != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+            # Overlapping edges are cut where the other one ends.
+            c = np.flatnonzero((d == 0) & (_cross(qp, r) == 0))
+            rr, ss = (r[c] * r[c]).sum(axis=1), (s[c] * s[c]).sum(axis=1)
+            for a, values in ((i[crossing], t[crossing]), (j[crossing], u[crossing]),
+                              (i[c], (qp[c] * r[c]).sum(axis=1) / rr),
+                              (i[c], ((qp[c] + s[c]) * r[c]).sum(axis=1) / rr),
+                              (j[c], (-qp[c] * s[c]).sum(axis=1) / ss),
+                              (j[c], ((r[c] - qp[c]) * s[c]).sum(axis=1) / ss)):
+                inside = (values > 0) & (values < 1)
+                index.append(a[inside])
+                fraction.append(values[inside])
+    return np.concatenate(index or [[]]).astype(int), np.concatenate(fraction or [[]])
+
+
+def _winding(edges, xy, bounds, bands):
+    """
+    Winding numbers around each point of xy, as an array of shape nx2:
+    of the edges in layer 0, then in layer 1. bounds and bands are
+    from _bands.
+    """
+    result = np.zeros((len(xy), 2), dtype=int)
+    band = np.searchsorted(bounds, xy[:,1], side='right') - 1
+    order = np.argsort(band, kind='mergesort')
+    points = np.split(order, np.searchsorted(band[order], np.arange(1, len(bands))))
+    for p, e in zip(points, bands):
+        if not len(p) or not len(e):
+            continue
+        x0, y0, x1, y1, layer = edges[e].T
+        px, py = xy[p, :1], xy[p, 1:]
+        up = (y0 <= py) & (py < y1)
+        down = (y1 <= py) & (py < y0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            right = x0 + (py - y0) * (x1 - x0) / (y1 - y0) > px
+        # A ray to the right crosses a counter-clockwise polygon's
+        # upward edge on the way out.
+        w = (up & right).astype(int) - (down & right)
+        result[p] = np.transpose([w.dot(layer == 0), w.dot(layer == 1)])
+    return result
+
+
+def boundary(polygons, clear=(), section='perimeter', eps=1e-6):
+    """
+    Paths that trace the edge of the area hatch fills: where polygons
+    wind positively and clear does not. Unlike outline, edges inside
+    the area (where polygons overlap) or outside it (cut away by clear)
+    aren't traced, and edges of clear cutting into it are.
+    Paths go with the area on their left. Points less than eps apart
+    are taken to be the same.
+    """
+    edges = _edges(polygons, clear)
+    edges = edges[(edges[:,0] != edges[:,2]) | (edges[:,1] != edges[:,3])]
+    if not len(edges):
+        return []
+    bounds, bands = _bands(edges, len(edges) // 64 + 1)
+    # Cut edges into pieces wherever they cross.
+    index, fraction = _cuts(edges, bands)
+    index = np.concatenate([np.arange(len(edges)), np.arange(len(edges)), index])
+    fraction = np.concatenate([np.zeros(len(edges)), np.ones(len(edges)), fraction])
+    order = np.lexsort((fraction, index))
+    index, fraction = index[order], fraction[order]
+    piece = np.flatnonzero((index[1:] == index[:-1]) & (fraction[1:] > fraction[:-1]))
+    e = index[piece]
+    p, r = edges[e,:2], edges[e,2:4] - edges[e,:2]
+    start = p + fraction[piece, None] * r
+    end = p + fraction[piece + 1, None] * r
+    # Keep the pieces with the area on exactly one side.
+    middle = (start + end) / 2
+    normal = eps * np.transpose([-r[:,1], r[:,0]]) / np.hypot(*r.T)[:, None]
+    w = _winding(edges, np.vstack([middle + normal, middle - normal]), bounds, bands)
+    filled = (w[:,0] > 0) & (w[:,1] <= 0)
+    left, right = filled[:len(middle)], filled[len(middle):]
+    start, end = np.where(right[:, None], end, start), np.where(right[:, None], start, end)
+    keep = left != right
+    start, end = start[keep], end[keep]
+    # Join them up, tracing overlapping edges once.
+    keys = [tuple(k) for k in np.round(np.hstack([start, end]) / eps).astype(np.int64).tolist()]
+    unique = list(collections.OrderedDict.fromkeys(keys))
+    starts = collections.defaultdict(list)
+    for k in unique:
+        starts[k[:2]].append(k)
+    ends = set(k[2:] for k in unique)
+    xy = dict((k, (s, e)) for k, s, e in zip(keys, start, end))
+    # Open paths from their start, then closed paths from anywhere.
+    heads = [k for k in unique if k[:2] not in ends] + unique
+    used = set()
+    paths = []
+    for head in heads:
+        if head in used:
+            continue
+        chain = [head]
+        used.add(head)
+        while True:
+            following = [k for k in starts[chain[-1][2:]] if k not in used]
+            if not following:
+                break
+            chain.append(following[0])
+            used.add(following[0])
+        closed = chain[-1][2:] == chain[0][:2]
+        points = [xy[k][0] for k in chain] + [xy[chain[0]][0] if closed else xy[chain[-1]][1]]
+        paths.append(Path(np.array(points), np.ones(len(chain), dtype=bool), closed, section))
+    return paths
+
+
+def order_paths(paths, start_xy=(0.0, 0.0), k=16):
+    """
+    Order paths greedily to shorten laser-off travel: after each path,
+    go to the nearest start of any path left. Open paths may be drawn
+    backwards, and closed paths started at any vertex.
+    """
+    if not paths:
+        return []
+    from scipy.spatial import cKDTree
+    # Every place a path can start.
+    entries, owner, vertex = [], [], []
+    for i, path in enumerate(paths):
+        if path.closed:
+            v = np.arange(len(path.xy) - 1)
+        else:
+            v = np.array([0, len(path.xy) - 1])
+        entries.append(path.xy[v])
+        owner.append(np.full(len(v), i))
+        vertex.append(v)
+    entries = np.vstack(entries)
+    owner = np.concatenate(owner)
+    vertex = np.concatenate(vertex)
+    tree = cKDTree(entries)
+    done = np.zeros(len(paths), dtype=bool)
+    here = np.asarray(start_xy, dtype=float)
+    result = []
+    for _ in range(len(paths)):
+        n = k
+        while True:
+            _, near = tree.query(here, k=min(n, len(entries)))
+            near = np.atleast_1d(near)
+            candidates = near[~done[owner[near]]]
+            if len(candidates) or n >= len(entries):
+                break
+            n *= 4
+        e = candidates[0]
+        path = paths[owner[e]]
+        done[owner[e]] = True
+        if path.closed:
+            ring = np.roll(path.xy[:-1], -vertex[e], axis=0)
+            path = path._replace(xy=np.vstack([ring, ring[:1]]),
+                                 on=np.roll(path.on, -vertex[e]))
+        elif vertex[e]:
+            path = path._replace(xy=path.xy[::-1], on=path.on[::-1])
+        result.append(path)
+        here = path.xy[-1]
+    return result
+
+
+def layer_paths(polygons, settings=DEFAULT_SETTINGS, angle_rad=0.0, start_xy=(0.0, 0.0)):
+    """
+    The paths for a layer: settings.offsets_num outlines, the first
+    outer_offset_mm inside the polygons and each inner_offset_mm
+    inside the last, then scanlines filling the area
+    scanline_offset_mm inside the last outline, all ordered by
+    order_paths.
+    """
+    paths = []
+    distance = settings.outer_offset_mm
+    for i in range(settings.offsets_num):
+        if i:
+            distance += settings.inner_offset_mm
+        paths.extend(outline(offset(polygons, distance)))
+    if settings.offsets_num:
+        distance += settings.scanline_offset_mm
+    paths.extend(hatch(offset(polygons, distance), settings.scanline_spacing_mm, angle_rad))
+    return order_paths(paths, start_xy)
+
+
+def paths_to_samples(paths, exposures, start_xy=None):
+    """
+    Samples for Printer.samples_to_FLP: an array of shape nx4 where each
+    row is x_mm, y_mm, dt_s, mW. exposures maps each path's section
+    to (mW, mm/s); the laser moves between paths (and along segments
+    that aren't on) at the speed of the next path, with the laser off.
+    The first row is start_xy, or the start of the first path.
+    """
+    rows = []
+    last = None if start_xy is None else np.asarray(start_xy, dtype=float)
+    if last is not None:
+        rows.append([[last[0], last[1], 0.0, 0.0]])
+    for path in paths:
+        mW, mm_s = exposures[path.section]
+        xy = np.asarray(path.xy, dtype=float)
+        if last is None:
+            rows.append([[xy[0,0], xy[0,1], 0.0, 0.0]])
+        else:
+            rows.append([[xy[0,0], xy[0,1], np.hypot(*(xy[0] - last)) / mm_s, 0.0]])
+        dt_s = np.hypot(*np.diff(xy, axis=0).T) / mm_s
+        rows.append(np.hstack([xy[1:], dt_s[:, None], np.where(path.on, mW, 0.0)[:, None]]))
+        last = xy[-1]
+    if not rows:
+        return np.zeros((0, 4))
+    return np.vstack(rows)
+
+
+if __name__ == '__main__':
+    FLP.print_not_a_script_message_and_exit()
@@ -11,3 +11,5 @@ sys.path.insert(0, dirname(dirname(os.path.abspath(inspect.getfile(inspect.curre
 
 from OpenFL import FLP
 from OpenFL import Printer
+from OpenFL import Timing
+from OpenFL import Toolpath
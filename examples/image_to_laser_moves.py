@@ -8,12 +8,18 @@ from os.path import dirname
 # Add parent directory to sys.path so we find OpenFL.
 sys.path.append(dirname(dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))))
 
-from context import FLP, Printer
+from context import FLP, Printer, Timing, Toolpath
 
 GERBER_EXTENSIONS = ('.gbl', '.gbs', '.gtl')
 
+import collections
 import numpy as np
 
+try: # Since python3 doesn't have basestring:
+    basestring
+except NameError:
+    basestring = str
+
 def image_to_laser_moves_xy_mm_dt_s_mW(image, M, 
                                        mmps=294.0, 
                                        powerThreshold_mW=0.0, 
@@ -91,6 +97,179 @@ def image_to_laser_moves_xy_mm_dt_s_mW(image, M,
     return np.array(filtered_mm_s_mW)
 
 
+class _SerpentineRaster(object):
+    """
+    The raster path of image_to_laser_moves_xy_mm_dt_s_mW, without
+    building it: sample s is pixel s - 1 of the zero-padded serpentine
+    rows, sample 0 is start_xy_mm and sample n - 1 is the origin.
+    The image may be a strip of a larger one starting at first_row.
+    """
+    def __init__(self, image, M, first_row=0, start_xy_mm=(0.0, 0.0)):
+        image = np.asarray(image, dtype=float)
+        assert image.ndim == 2
+        assert np.shape(M) == (3, 3)
+        self.M = np.asarray(M).dot([[0,1,0],
+                                    [-1,0,0],
+                                    [0,0,1]])
+        rows, columns = image.shape
+        self.first_row = first_row
+        self.width = columns + 1
+        if start_xy_mm is None:
+            # Carry on from the last pixel of the row before, if any.
+            start_xy_mm = self.pixel_xy([max(first_row - 1, 0)],
+                                        [columns if first_row else 0])[0]
+        self.start_xy_mm = start_xy_mm
+        self.n = rows * self.width + 2
+        self.power = np.zeros(self.n)
+        serpentine = self.power[1:-1].reshape(rows, self.width)
+        serpentine[:, 1:] = image
+        odd = 1 - first_row % 2
+        serpentine[odd::2, 1:] = image[odd::2, ::-1]
+        # Each row is a straight line, so the path length to a pixel is
+        # the length to its row's first pixel plus the distance from there.
+        ends = self.xy(np.concatenate([np.arange(rows) * self.width + 1,
+                                       np.arange(1, rows + 1) * self.width]))
+        self.row_first, row_last = ends[:rows], ends[rows:]
+        row_mm = np.hypot(*(row_last - self.row_first).T)
+        turn_mm = np.hypot(*(self.row_first - np.vstack([start_xy_mm, row_last[:-1]])).T)
+        self.row_start_mm = np.cumsum(turn_mm) + np.concatenate([[0], np.cumsum(row_mm[:-1])])
+
+    def pixel_xy(self, row, column):
+        """Where the laser is after (padded, serpentine) pixel column of row."""
+        row = np.asarray(row)
+        j = np.where(row % 2, self.width - 1 - np.asarray(column), column) - 0.5
+        xyw = self.M.dot(np.vstack([row, j, np.ones(np.size(row))]))
+        return (xyw[:-1] / xyw[-1:]).T # Perspective divide.
+
+    def xy(self, s):
+        s = np.asarray(s)
+        r, c = np.divmod(s - 1, self.width)
+        xy = self.pixel_xy(self.first_row + r, c)
+        xy[s == 0] = self.start_xy_mm
+        xy[s == self.n - 1] = 0
+        return xy
+
+    def length_mm(self, s, xy):
+        """Path length from the start to samples s (not the last), at xy."""
+        s = np.asarray(s)
+        r = np.maximum(s - 1, 0) // self.width
+        result = self.row_start_mm[r] + np.hypot(*(xy - self.row_first[r]).T)
+        result[s == 0] = 0
+        return result
+
+    def split(self, xy_mm, lo, hi, max_mm, chunk=1 << 16):
+        """
+        Split the path from xy_mm through samples lo..hi where it gets
+        further than max_mm from the last split (as the filter in
+        image_to_laser_moves_xy_mm_dt_s_mW does).
+        Returns lists of the samples split at and their positions.
+        """
+        samples, positions = [], []
+        window = 64
+        for first in range(lo, hi + 1, chunk):
+            xy = self.xy(np.arange(first, min(first + chunk, hi + 1)))
+            i = 0
+            while i < len(xy):
+                d = xy[i:i + window] - xy_mm
+                beyond = np.flatnonzero(np.sqrt(d[:,0] * d[:,0] + d[:,1] * d[:,1]) > max_mm)
+                if len(beyond):
+                    i += beyond[0]
+                    xy_mm = xy[i]
+                    samples.append(first + i)
+                    positions.append(xy_mm)
+                    window = 2 * beyond[0] + 16
+                    i += 1
+                else:
+                    i += window
+                    window *= 2
+        return samples, positions
+
+
+def image_to_laser_spans_xy_mm_dt_s_mW(image, M,
+                                       mmps=294.0,
+                                       powerThreshold_mW=0.0,
+                                       max_seg_length_mm=5.0):
+    """
+    Same as image_to_laser_moves_xy_mm_dt_s_mW(doFilter=True), but
+    run-length encodes the serpentine rows into spans of constant power
+    instead of generating and filtering a sample per pixel; pixel
+    positions are only computed at span ends and where long spans are
+    split at max_seg_length_mm.
+    Returns an array of shape nx4 where each row is x_mm, y_mm, dt_s, mW.
+    """
+    raster = _SerpentineRaster(image, M)
+    if raster.n <= 3:
+        return image_to_laser_moves_xy_mm_dt_s_mW(image, M, mmps=mmps, doFilter=True)
+    return np.array(_raster_spans(raster, mmps, powerThreshold_mW, max_seg_length_mm))
+
+
+def _raster_spans(raster, mmps, powerThreshold_mW, max_seg_length_mm,
+                  return_to_origin=True):
+    """
+    The samples of image_to_laser_spans_xy_mm_dt_s_mW for a raster, as a list.
+    Without return_to_origin, the last sample is the raster's last pixel.
+    """
+    n = raster.n
+    power = raster.power
+    # A span start..stop-1 ends where sample stop has a different power.
+    changes = np.flatnonzero(np.diff(power)) + 1
+    ends = np.append(changes - 1, n - 2)
+    ends_xy = raster.xy(ends)
+    ends_mm = raster.length_mm(ends, ends_xy).tolist()
+    ends_xy = ends_xy.tolist()
+    change_mW = power[changes].tolist()
+
+    start, start_xy, start_mm = 1, list(raster.start_xy_mm), 0.0
+    result = [(start_xy[0], start_xy[1], 0.0, 0.0)]
+    mW = power[0]
+    def addSegment(end_xy, end_mm):
+        if mW == 0.0:
+            dt_s = np.hypot(end_xy[0] - start_xy[0], end_xy[1] - start_xy[1]) / mmps
+        else:
+            dt_s = (end_mm - start_mm) / mmps
+        result.append((end_xy[0], end_xy[1], dt_s, mW))
+    i = 0
+    while True:
+        # The next sample differing from mW by more than the threshold.
+        while i < len(changes) and changes[i] <= start:
+            i += 1
+        j = i
+        while j < len(changes) and abs(change_mW[j] - mW) <= powerThreshold_mW:
+            j += 1
+        stop = changes[j] if j < len(changes) else n
+        end_xy, end_mm = ends_xy[j], ends_mm[j]
+        # Straight-line distance can't exceed the path length, so only
+        # then can the span need splitting (with a margin for rounding).
+        if end_mm - start_mm > max_seg_length_mm * (1 - 1e-9):
+            samples, positions = raster.split(start_xy, start, min(stop, n - 1) - 1,
+                                              max_seg_length_mm)
+            samples = [s for s in samples if s + 1 < stop]
+            if samples:
+                lengths = raster.length_mm(samples, np.array(positions[:len(samples)]))
+                newPower = False
+                for s, xy, mm in zip(samples, positions, lengths.tolist()):
+                    xy = xy.tolist()
+                    addSegment(xy, mm)
+                    start, start_xy, start_mm = s + 1, xy, mm
+                    if power[start] != mW:
+                        # The threshold now applies around a new power.
+                        mW = power[start]
+                        newPower = True
+                        break
+                if newPower:
+                    continue
+        if stop >= n:
+            break
+        addSegment(end_xy, end_mm)
+        start, start_xy, start_mm = stop, end_xy, end_mm
+        mW = power[stop]
+    if return_to_origin:
+        result.append((0.0, 0.0, (end_mm - start_mm) / mmps, mW))
+    elif start < n - 1:
+        addSegment(end_xy, end_mm)
+    return result
+
+
 def __samplesToFLP(dtxypower, xymmToDac=None):
     clock_Hz = 60e3
     xytickspmm = float(0xffff) / 125
@@ -99,7 +278,6 @@ def __samplesToFLP(dtxypower, xymmToDac=None):
     import numpy as np
     dtxypower = np.asarray(dtxypower)
     result = FLP.Packets()
-    result.append(FLP.TimeRemaining(int(sum(dtxypower[:,0]))))
     import numpy as np
     if xymmToDac is None:
         tickspmm = float(0xffff)/125.0
@@ -139,7 +317,7 @@ def __samplesToFLP(dtxypower, xymmToDac=None):
         lastxy_ticks = xy_ticks
     if xyticks:
         result.append(FLP.XYMove(xyticks))
-    return result
+    return Timing.insert_time_remaining(result)
 
 
 def png_to_flp(pngfilename, flpfilename, printer, pixel_mm=0.1, mmps=295.0, mW=31.0,
@@ -162,7 +340,7 @@ def png_to_flp(pngfilename, flpfilename, printer, pixel_mm=0.1, mmps=295.0, mW=3
     image *= mW
     M = np.diag((-pixel_mm,pixel_mm,1))+[[0,0,0.1],[0,0,0.05],[0,0,0]]
     image = np.tile(image, tile)
-    result_xy_mm_dt_s_mW = image_to_laser_moves_xy_mm_dt_s_mW(image, M, mmps=mmps, doFilter=True)
+    result_xy_mm_dt_s_mW = image_to_laser_spans_xy_mm_dt_s_mW(image, M, mmps=mmps)
     # Center:
     lo = result_xy_mm_dt_s_mW[:,:2].min(axis=0)
     hi = result_xy_mm_dt_s_mW[:,:2].max(axis=0)
@@ -172,6 +350,145 @@ def png_to_flp(pngfilename, flpfilename, printer, pixel_mm=0.1, mmps=295.0, mW=3
     return data, result_xy_mm_dt_s_mW, image
 
 
+class ImageStrips(object):
+    """
+    An image read a strip of rows at a time, so it needn't fit in memory.
+    source is a 2D (or color) array, e.g. a np.memmap, a .npy file,
+    which is memory-mapped, or an image file. PNG files are read a row
+    at a time if the pypng module is installed; other files are loaded
+    whole, as png_to_flp does.
+    """
+    def __init__(self, source):
+        self.filename = None
+        if isinstance(source, basestring) and source.lower().endswith('.npy'):
+            source = np.load(source, mmap_mode='r')
+        if isinstance(source, basestring):
+            try:
+                import png
+            except ImportError:
+                png = None
+            if png is not None and source.lower().endswith('.png'):
+                self.filename = source
+                width, height, _, _ = png.Reader(filename=source).asFloat()
+                self.shape = (height, width)
+                return
+            from scipy.ndimage import imread
+            source = imread(source)
+        if np.ndim(source) not in (2, 3):
+            raise TypeError('source must be a 2D image or a filename.')
+        self.array = source
+        self.shape = np.shape(source)[:2]
+
+    def strips(self, strip_rows):
+        """Yield float arrays of up to strip_rows rows, color averaged to gray."""
+        if self.filename is None:
+            for row in range(0, self.shape[0], strip_rows):
+                strip = np.asarray(self.array[row:row + strip_rows], dtype=float)
+                yield strip.mean(axis=-1) if strip.ndim == 3 else strip
+            return
+        import png
+        width, height, rows, info = png.Reader(filename=self.filename).asFloat()
+        strip = []
+        for row in rows:
+            strip.append(np.asarray(row, dtype=float).reshape(width, -1).mean(axis=-1))
+            if len(strip) == strip_rows:
+                yield np.array(strip)
+                strip = []
+        if strip:
+            yield np.array(strip)
+
+
+def _raster_strip(args):
+    """Rasterize one strip for banded_samples_xy_mm_dt_s_mW."""
+    strip, M, first_row, mmps, max_seg_length_mm = args
+    raster = _SerpentineRaster(strip, M, first_row=first_row, start_xy_mm=None)
+    samples = np.array(_raster_spans(raster, mmps, 0.0, max_seg_length_mm,
+                                     return_to_origin=False))
+    # The first strip's first sample is where the path starts; the
+    # others' is where the strip before ended.
+    return samples if first_row == 0 else samples[1:]
+
+
+def _imap_bounded(pool, function, iterable, ahead):
+    """Like pool.imap, but only takes ahead items from iterable at a time."""
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(pool.apply_async(function, (args,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def banded_samples_xy_mm_dt_s_mW(strips, M, mmps=294.0, max_seg_length_mm=5.0,
+                                 pool=None, ahead=None):
+    """
+    Rasterize an image given as an iterable of strips of rows, yielding
+    nx4 arrays of x_mm, y_mm, dt_s, mW samples for each strip in turn,
+    ready for Printer.iter_samples_to_FLP.
+    The path is that of image_to_laser_spans_xy_mm_dt_s_mW, except that
+    it starts at the first pixel rather than the origin, doesn't return
+    to the origin, and laser-off jumps are also split between strips.
+    With a multiprocessing pool, strips are rasterized in parallel, and
+    at most ahead (by default twice the number of CPUs) are taken from
+    strips at once.
+    """
+    def jobs():
+        first_row = 0
+        for strip in strips:
+            yield strip, M, first_row, mmps, max_seg_length_mm
+            first_row += len(strip)
+    if pool is None:
+        return (_raster_strip(job) for job in jobs())
+    if ahead is None:
+        import multiprocessing
+        ahead = 2 * multiprocessing.cpu_count()
+    return _imap_bounded(pool, _raster_strip, jobs(), ahead)
+
+
+def png_to_flp_banded(pngfilename, flpfilename, printer, pixel_mm=0.1, mmps=295.0, mW=31.0,
+                      invert=False, tile=(1,1), strip_rows=256, processes=None):
+    """
+    Like png_to_flp, for images too big to rasterize in memory: reads
+    the image (see ImageStrips) in strips of strip_rows rows, rasterizes
+    them on a pool of processes (by default one per CPU) and writes the
+    FLP packets as the strips finish, so only a few strips per process
+    are in memory at once.
+    The result is centered on the image's extent rather than on its
+    exposed pixels; see banded_samples_xy_mm_dt_s_mW for the path.
+    Returns the FLP.PacketWriter, which counts packets and bytes written.
+    """
+    import multiprocessing
+    image = ImageStrips(pngfilename)
+    # Normalize as png_to_flp does, which takes a pass to find the maximum.
+    peak = max(strip.max() for strip in image.strips(strip_rows))
+    def strips():
+        for _ in range(tile[0]):
+            for strip in image.strips(strip_rows):
+                strip = strip / peak
+                strip[strip < 0.5] = 0.0 # Throw out noise/edges, etc.
+                strip[strip >= 0.5] = 1.0
+                if invert:
+                    strip = 1.0 - strip
+                yield np.tile(strip * mW, (1, tile[1]))
+    M = np.diag((-pixel_mm,pixel_mm,1))+[[0,0,0.1],[0,0,0.05],[0,0,0]]
+    # Center:
+    rows, columns = image.shape[0] * tile[0], image.shape[1] * tile[1]
+    corners = _SerpentineRaster(np.zeros((1, columns)), M).pixel_xy([0, 0, rows - 1, rows - 1],
+                                                                    [0, columns] * 2)
+    lo, hi = corners.min(axis=0), corners.max(axis=0)
+    M = np.array([[1, 0, -(lo[0] + hi[0])/2],
+                  [0, 1, -(lo[1] + hi[1])/2],
+                  [0, 0, 1]]).dot(M)
+    pool = multiprocessing.Pool(processes)
+    try:
+        chunks = banded_samples_xy_mm_dt_s_mW(strips(), M, mmps=mmps, pool=pool,
+                                              ahead=2 * (processes or multiprocessing.cpu_count()))
+        return printer.write_samples_to_FLP(chunks, flpfilename)
+    finally:
+        pool.terminate()
+
+
 def plotResults(result):
     from pylab import figure, hold, show
     from matplotlib import collections  as mc
@@ -237,13 +554,188 @@ def convertToTmpPNG(filename, png, pixel_mm=0.1):
     if ext in GERBER_EXTENSIONS:
         return gerberToPNG(filename, png, pixel_mm=pixel_mm)
     raise Exception('Unsupported file type: {} in {}'.format(ext, filename))
-    
 
-def image_to_flp(imagefilename, flpfilename, pixel_mm=0.1, **kwargs):
+
+def _arc_points(center, radius, start_angle, sweep, tolerance_mm):
+    """Points along an arc, no further than tolerance_mm from it."""
+    if radius <= tolerance_mm:
+        step = np.pi / 4
+    else:
+        step = 2 * np.arccos(1 - tolerance_mm / radius)
+    n = max(int(np.ceil(abs(sweep) / step)), 2)
+    angles = start_angle + np.linspace(0, sweep, n + 1)
+    return np.transpose([center[0] + radius * np.cos(angles),
+                         center[1] + radius * np.sin(angles)])
+
+
+def _circle_polygon(center, radius, tolerance_mm):
+    return _arc_points(center, radius, 0, 2 * np.pi, tolerance_mm)[:-1]
+
+
+def _hull(points):
+    """The convex hull of points, counter-clockwise."""
+    from scipy.spatial import ConvexHull
+    points = np.asarray(points, dtype=float)
+    return points[ConvexHull(points).vertices]
+
+
+def _rotated(points, position, rotation_deg):
+    c, s = np.cos(np.radians(rotation_deg)), np.sin(np.radians(rotation_deg))
+    return np.asarray(points).dot([[c, s], [-s, c]]) + position
+
+
+def _aperture_outline(aperture, tolerance_mm):
+    """The outline of an aperture (a Circle or Rectangle primitive) at the origin."""
+    name = type(aperture).__name__
+    if name == 'Circle':
+        return _circle_polygon((0, 0), aperture.diameter / 2, tolerance_mm)
+    if name == 'Rectangle':
+        w, h = aperture.width / 2, aperture.height / 2
+        return np.array([(-w, -h), (w, -h), (w, h), (-w, h)])
+    raise TypeError('Unsupported aperture: {}'.format(name))
+
+
+def _gerber_arc_points(arc, tolerance_mm):
+    """Points along a gerber Arc, from its start to its end."""
+    cx, cy = arc.center
+    start = np.arctan2(arc.start[1] - cy, arc.start[0] - cx)
+    end = np.arctan2(arc.end[1] - cy, arc.end[0] - cx)
+    # An arc that ends where it starts is a full circle.
+    if arc.direction == 'clockwise':
+        sweep = -((start - end) % (2 * np.pi) or 2 * np.pi)
+    else:
+        sweep = (end - start) % (2 * np.pi) or 2 * np.pi
+    radius = np.hypot(arc.start[0] - cx, arc.start[1] - cy)
+    return _arc_points(arc.center, radius, start, sweep, tolerance_mm)
+
+
+def gerberToPolygons(primitives, tolerance_mm=0.01):
+    """
+    Convert gerber primitives (from pcb-tools, in mm) to polygons,
+    with curves no further than tolerance_mm from the true outline.
+    Tracks and arcs become the area their aperture sweeps; pads and
+    regions their outline.
+    Returns (dark polygons, clear polygons, collections.Counter of
+    primitive types that were skipped), where each polygon is an
+    (n, 2) array of counter-clockwise vertices.
+    """
+    dark, clear = [], []
+    skipped = collections.Counter()
+    def add(primitive, polygons):
+        polarity = getattr(primitive, 'level_polarity', 'dark')
+        (clear if polarity == 'clear' else dark).extend(polygons)
+    for p in primitives:
+        name = type(p).__name__
+        if name == 'Line':
+            outline = _aperture_outline(p.aperture, tolerance_mm)
+            add(p, [_hull(np.vstack([outline + p.start, outline + p.end]))])
+        elif name == 'Arc':
+            # Sweep the aperture along short chords of the arc.
+            path = _gerber_arc_points(p, tolerance_mm)
+            outline = _aperture_outline(p.aperture, tolerance_mm)
+            add(p, [_hull(np.vstack([outline + a, outline + b]))
+                    for a, b in zip(path[:-1], path[1:])])
+        elif name == 'Circle':
+            add(p, [_circle_polygon(p.position, p.diameter / 2, tolerance_mm)])
+        elif name == 'Rectangle':
+            w, h = p.width / 2, p.height / 2
+            add(p, [_rotated([(-w, -h), (w, -h), (w, h), (-w, h)],
+                             p.position, getattr(p, 'rotation', 0))])
+        elif name == 'Obround':
+            r = min(p.width, p.height) / 2
+            d = np.array([p.width / 2 - r, p.height / 2 - r])
+            ends = np.vstack([_circle_polygon(-d, r, tolerance_mm),
+                              _circle_polygon(d, r, tolerance_mm)])
+            add(p, [_rotated(_hull(ends), p.position, getattr(p, 'rotation', 0))])
+        elif name == 'Polygon':
+            angles = np.linspace(0, 2 * np.pi, p.sides, endpoint=False)
+            add(p, [_rotated(np.transpose([p.radius * np.cos(angles), p.radius * np.sin(angles)]),
+                             p.position, getattr(p, 'rotation', 0))])
+        elif name == 'Region':
+            points = []
+            for q in p.primitives:
+                if type(q).__name__ == 'Arc':
+                    points.extend(_gerber_arc_points(q, tolerance_mm)[:-1])
+                else:
+                    points.append(q.start)
+            if len(points) >= 3:
+                add(p, [_counter_clockwise(np.array(points, dtype=float))])
+        elif name == 'AMGroup':
+            d, c, s = gerberToPolygons(p.primitives, tolerance_mm)
+            add(p, d)
+            clear.extend(c)
+            skipped.update(s)
+        else:
+            skipped[name] += 1
+    return dark, clear, skipped
+
+
+def _counter_clockwise(polygon):
+    return polygon[::-1] if Toolpath.signed_area(polygon) < 0 else polygon
+
+
+def polygons_to_samples_xy_mm_dt_s_mW(polygons, hatch_mm=0.1, mmps=295.0, mW=31.0,
+                                      clear=(), contours=True):
+    """
+    Hatch polygons (see Toolpath.hatch) with scanlines hatch_mm apart,
+    and trace the edge of the hatched area (see Toolpath.boundary), all
+    at mW and mmps, in the order Toolpath.order_paths picks; the laser
+    is off between them.
+    Returns an array of shape nx4 where each row is x_mm, y_mm, dt_s, mW,
+    starting at the first exposure.
+    """
+    paths = Toolpath.hatch(polygons, hatch_mm, clear=clear)
+    if contours:
+        paths += Toolpath.boundary(polygons, clear)
+    paths = Toolpath.order_paths(paths)
+    return Toolpath.paths_to_samples(paths, {'fill': (mW, mmps), 'perimeter': (mW, mmps)})
+
+
+def gerber_to_flp(filename, flpfilename, printer, hatch_mm=0.1, mmps=295.0, mW=31.0,
+                  contours=True, tolerance_mm=0.01):
+    """
+    Convert a gerber file to a single-layer flp file without rendering
+    it: the copper is hatched and outlined as polygons, so exposure
+    time goes with copper area rather than board size.
+    Returns (FLP.Packets, samples).
+    """
+    try:
+        import gerber
+    except Exception:
+        raise Exception('The gerber module can be found at https://github.com/curtacircuitos/pcb-tools.')
+    data = gerber.read(filename)
+    data.to_metric()
+    dark, clear, skipped = gerberToPolygons(data.primitives, tolerance_mm=tolerance_mm)
+    if skipped:
+        sys.stderr.write('Skipped unsupported gerber primitives: {}\n'.format(dict(skipped)))
+    # Rotated as png_to_flp lays out the rendered board, and centered.
+    dark = [-polygon for polygon in dark]
+    clear = [-polygon for polygon in clear]
+    if dark:
+        points = np.vstack(dark)
+        center = (points.min(axis=0) + points.max(axis=0)) / 2
+        dark = [polygon - center for polygon in dark]
+        clear = [polygon - center for polygon in clear]
+    samples = polygons_to_samples_xy_mm_dt_s_mW(dark, hatch_mm=hatch_mm, mmps=mmps, mW=mW,
+                                                clear=clear, contours=contours)
+    data = printer.samples_to_FLP(xy_mm_dts_s_mW=samples)
+    data.tofile(flpfilename)
+    return data, samples
+
+
+def image_to_flp(imagefilename, flpfilename, pixel_mm=0.1, banded=False, vector=False, **kwargs):
+    """
+    Convert an image or gerber file to a single-layer flp file.
+    With vector, gerber files are hatched pixel_mm apart by gerber_to_flp
+    instead of being rendered to a PNG.
+    """
     import sys
     isGerber = os.path.splitext(imagefilename.lower())[1] in GERBER_EXTENSIONS
+    if vector and isGerber:
+        return gerber_to_flp(imagefilename, flpfilename, hatch_mm=pixel_mm, **kwargs)
+    convert = png_to_flp_banded if banded else png_to_flp
     try:
-        return png_to_flp(imagefilename, flpfilename, pixel_mm=pixel_mm, **kwargs)
+        return convert(imagefilename, flpfilename, pixel_mm=pixel_mm, **kwargs)
     except IOError as e:
         if e.strerror == 'No such file or directory':
             raise
@@ -252,7 +744,7 @@ def image_to_flp(imagefilename, flpfilename, pixel_mm=0.1, **kwargs):
         fh = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
         imagefilename, pixel_mm = convertToTmpPNG(imagefilename, fh.name, pixel_mm=pixel_mm)
     assert flpfilename.endswith('.flp')
-    return png_to_flp(imagefilename, flpfilename, pixel_mm=pixel_mm, **kwargs)
+    return convert(imagefilename, flpfilename, pixel_mm=pixel_mm, **kwargs)
 
 
 if __name__ == '__main__':
@@ -262,6 +754,8 @@ if __name__ == '__main__':
     parser.add_argument('outFLPFilename', nargs=1)
     parser.add_argument('--pixel_mm', default=0.1, type=float)
     parser.add_argument('--dummy-printer', action='store_true', help="Don't ask a printer for a cal table, just use a dummy one.")
+    parser.add_argument('--strip-rows', default=0, type=int, help="Rasterize the image in strips of this many rows on all CPUs, for images too big for memory.")
+    parser.add_argument('--vector', action='store_true', help="Hatch gerber files as polygons, pixel_mm apart, instead of rendering them to a PNG.")
     args = parser.parse_args()
 
     inImageFilename = args.inImageFilename
@@ -274,6 +768,10 @@ if __name__ == '__main__':
         sys.exit(1)
     p.initialize()
 
+    kwargs = dict(banded=True, strip_rows=args.strip_rows) if args.strip_rows else {}
+    if args.vector:
+        kwargs = dict(vector=True)
     image_to_flp(inImageFilename[0], outFlpFilename[0],
                  printer=p,
-                 pixel_mm=args.pixel_mm)
+                 pixel_mm=args.pixel_mm,
+                 **kwargs)
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import time
+from __future__ import print_function
 
 import music21
 import sys
@@ -10,19 +10,22 @@ from os.path import dirname
 # Add parent directory to sys.path so we find OpenFL.
 sys.path.append(dirname(dirname(dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))))))
 from OpenFL import Printer as P
+from OpenFL import FLP, Live
 
 def midi_live(midifilename, 
               quarternote_s=0.5, 
               frequency_factor=1.0,
-              skip_leading_rests=True):
+              skip_leading_rests=True,
+              block_s=0.25):
     """ Given a MIDI file, play it live on the printer
+        Notes are streamed to the printer in blocks of about block_s,
+        so the printer's clock, not USB latency, sets their timing.
     """
     p = P.Printer()
     if p.state() != P.State.MACHINE_READY_TO_PRINT:
         p.initialize()
     else:
         # We still want to ensure we start in a known state, with z at the limit:
-        import OpenFL.FLP as FLP
         # Move z up by more than the z height at 15 mm/s.
         p.move_z(FLP.ZMove.usteps_up_per_mm * 200.0, 
                  feedrate=FLP.ZMove.usteps_up_per_mm * 15.0)
@@ -52,18 +55,20 @@ def midi_live(midifilename,
             if next_z_would_be > max(Position.zbounds_ustep):
                 Position.direction = -1
 
-        # Send a blocking motor move
-        p.move_z(Position.direction * freq * time_s, freq, 80)
+        # Queue the motor move; the stream sends it with the next block
+        stream.move_z(Position.direction * freq * time_s, freq)
 
         # Update the dead-reckoning Z position
         Position.z_ustep += Position.direction * steps
 
-    print 'Reading MIDI file...'
+    print('Reading MIDI file...')
     mf = music21.midi.MidiFile()
     mf.open(midifilename)
     mf.read()
     soundstream = music21.midi.translate.midiFileToStream(mf)
-    print 'read {} streams'.format(len(soundstream.elements))
+    print('read {} streams'.format(len(soundstream.elements)))
+    stream = Live.Stream(p, block_s=block_s)
+    stream.append(FLP.ZCurrent(80))
     for track in soundstream.elements:
         for i in track.flat.elements:
             # Play a note on the printer (and clear the skip rests flag)
@@ -74,7 +79,8 @@ def midi_live(midifilename,
             # Pause the correct amount of time for a rest
             elif isinstance(i, music21.note.Rest):
                 if not skip_leading_rests:
-                    time.sleep(i.duration.quarterLength * quarternote_s)
+                    stream.dwell(i.duration.quarterLength * quarternote_s)
+    stream.finish()
 
 if __name__ == '__main__':
     import argparse
@@ -87,7 +93,10 @@ if __name__ == '__main__':
                         help='Duration for a quarternote.')
     parser.add_argument('--frequency_factor', type=float, default=1.0,
                         help='Scale frequency by this factor.')
+    parser.add_argument('--block_s', type=float, default=0.25,
+                        help='Seconds of music to send to the printer at a time.')
     args = parser.parse_args()
     midi_live(args.midifile, 
               quarternote_s=args.quarternote_s, 
-              frequency_factor=args.frequency_factor)
+              frequency_factor=args.frequency_factor,
+              block_s=args.block_s)
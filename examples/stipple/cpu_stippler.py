@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+This is a Python script that stipples a bitmap without a display.
+
+It runs the same Lloyd iteration as stippler.py, on the CPU: each
+pixel is assigned to its nearest stipple with a k-d tree, and each
+stipple moves to the darkness-weighted centroid of its pixels.
+It saves the same stipple file (which can be loaded by stipple2flp.py).
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import json
+
+import numpy as np
+import scipy.ndimage
+from scipy.spatial import cKDTree
+
+
+def read_image(filename):
+    """ Reads an image as floats from 0 (black) to 1 (white),
+        flipped so that row 0 is the bottom, as stippler.py does.
+    """
+    try:
+        img = scipy.ndimage.imread(filename, mode='F')
+    except AttributeError: # scipy.ndimage.imread is gone in newer SciPy.
+        import imageio
+        img = np.asarray(imageio.imread(filename), dtype=float)
+        if img.ndim == 3:
+            img = img[:,:,:3].mean(axis=-1)
+    img = img[::-1,:].astype(float)
+    return img / np.max(img)
+
+
+def stipple(img, stipples, iterations=50, tolerance_px=0.01, seed=None,
+            workers=1, verbose=False):
+    """ Places stipples by weighted Voronoi stippling
+        ("Weighted Voronoi Stippling", Adrian Secord, NPAR 2002).
+            img is an array of floats from 0 (black) to 1 (white)
+            stipples is the number of stipples
+            Iterates until no stipple moves more than tolerance_px
+            or for at most iterations steps.
+            workers is the number of threads for each nearest-stipple
+            query (-1 for all CPUs; needs SciPy 1.6 or later).
+        Returns an array of shape nx2 of x, y stipple positions in pixels.
+    """
+    rng = np.random.RandomState(seed)
+    weight = 1 - np.asarray(img, dtype=float).ravel()
+    # Only pixels with some weight pull on the stipples.
+    inked = np.flatnonzero(weight > 0)
+    if len(inked) == 0:
+        raise ValueError('The image is blank.')
+    weight = weight[inked]
+    gy, gx = np.divmod(inked, img.shape[1])
+    pixels = np.transpose([gx, gy]).astype(float)
+    p = weight / weight.sum()
+
+    def scatter(n):
+        """ Random positions, with density following the weights.
+        """
+        return pixels[rng.choice(len(pixels), n, p=p)] + rng.uniform(-0.5, 0.5, (n, 2))
+
+    kwargs = {} if workers == 1 else {'workers': workers}
+    points = scatter(stipples)
+    for iteration in range(iterations):
+        _, cell = cKDTree(points).query(pixels, **kwargs)
+        total = np.bincount(cell, weights=weight, minlength=stipples)
+        moved = np.empty_like(points)
+        empty = total == 0
+        full = ~empty
+        moved[full, 0] = np.bincount(cell, weights=weight * gx, minlength=stipples)[full] / total[full]
+        moved[full, 1] = np.bincount(cell, weights=weight * gy, minlength=stipples)[full] / total[full]
+        shift = np.hypot(*(moved[full] - points[full]).T).max()
+        # Stipples that own no ink start again somewhere else.
+        moved[empty] = scatter(np.count_nonzero(empty))
+        points = moved
+        if verbose:
+            print('Iteration {}: moved up to {:.3f} px'.format(iteration + 1, shift))
+        if shift < tolerance_px and not empty.any():
+            break
+    return points
+
+
+def to_json(img, points):
+    """ Returns the stipple file contents for stipple positions on img,
+        in the format of stippler.py: integer pixel positions and the
+        image value at each.
+    """
+    points = np.clip(points.astype(int), 0, [img.shape[1] - 1, img.shape[0] - 1])
+    stipples = np.hstack([points, img[points[:,1], points[:,0]].reshape(-1, 1)])
+    return {'width': img.shape[1],
+            'height': img.shape[0],
+            'stipples': stipples.tolist()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stipple an image without a display")
+    parser.add_argument('-N', metavar='dots', type=int, default=500,
+                        help='number of stipples')
+    parser.add_argument('-i', '--iterations', type=int, default=50,
+                        help='maximum number of Lloyd iterations')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.01,
+                        help='stop once no stipple moves more than this many pixels')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='threads for nearest-stipple queries (-1 for all CPUs)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed, for repeatable results')
+    parser.add_argument('image', metavar='image', type=str,
+                        help='source image file')
+    parser.add_argument('output', metavar='output', type=str,
+                        help='output file')
+    args = parser.parse_args()
+
+    img = read_image(args.image)
+    points = stipple(img, args.N, iterations=args.iterations,
+                     tolerance_px=args.tolerance, seed=args.seed,
+                     workers=args.workers, verbose=True)
+    with open(args.output, 'w') as f:
+        json.dump(to_json(img, points), f)
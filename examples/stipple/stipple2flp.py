@@ -16,6 +16,8 @@ sys.path.append('../..')
 import numpy as np
 
 import OpenFL.FLP as F
+import OpenFL.Printer as P
+import OpenFL.Settle as S
 
 def mm_to_pos(p):
     """ Converts a position in mm in the range +/- 62.6
@@ -62,6 +64,123 @@ def to_flp(stipples, dpi=300, x_mm=0, y_mm=0, laser_pwr=35000,
 
     return packets
 
+def hilbert_order(xy, bits=16):
+    """ Returns the order in which a Hilbert curve visits points
+            xy is an array of shape nx2
+        Nearby points on the curve are nearby in space, so visiting
+        points in this order keeps the laser's jumps short.
+    """
+    xy = np.asarray(xy, dtype=float)
+    lo, hi = xy.min(axis=0), xy.max(axis=0)
+    scale = ((1 << bits) - 1) / max(np.max(hi - lo), 1e-12)
+    x, y = np.transpose(np.round((xy - lo) * scale).astype(np.int64))
+    d = np.zeros(len(xy), dtype=np.int64)
+    s = 1 << (bits - 1)
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve joins up.
+        flip = ~ry & rx
+        x = np.where(flip, s - 1 - x, x)
+        y = np.where(flip, s - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s >>= 1
+    return np.argsort(d, kind='mergesort')
+
+
+def nearest_order(xy, start=0, k=16):
+    """ Returns a greedy nearest-neighbor tour of points
+            xy is an array of shape nx2
+        This usually gives shorter jumps than hilbert_order, but is slower.
+    """
+    from scipy.spatial import cKDTree
+    xy = np.asarray(xy, dtype=float)
+    tree = cKDTree(xy)
+    visited = np.zeros(len(xy), dtype=bool)
+    order = [start]
+    visited[start] = True
+    for _ in range(len(xy) - 1):
+        here = xy[order[-1]]
+        n = k
+        while True:
+            _, near = tree.query(here, k=min(n, len(xy)))
+            near = np.atleast_1d(near)
+            candidates = near[~visited[near]]
+            if len(candidates):
+                nxt = candidates[0]
+                break
+            if n >= len(xy):
+                raise AssertionError('No unvisited points left.')
+            n *= 4
+        order.append(nxt)
+        visited[nxt] = True
+    return np.array(order)
+
+
+def to_flp_optimized(stipples, printer=None, dpi=300, x_mm=0, y_mm=0,
+                     laser_pwr=35000, ticks=500, base=100, order='hilbert',
+                     settle_model=None):
+    """ Like to_flp, but makes a shorter and faster job
+            printer supplies the galvo calibration (see Printer.fit_galvo_model);
+                by default, the fit to all Form 1/1+s is used
+            order is 'hilbert' (see hilbert_order), 'nearest'
+                (see nearest_order) or 'x' (as to_flp)
+            settle_model is the OpenFL.Settle.SettleModel that sets the
+                travel and settle time of each jump by its length
+        Dots that land on the same galvo position are drawn as one.
+    """
+    stipples = np.asarray(stipples, dtype=float).reshape(-1, 3)
+    t = (np.ceil((ticks - base) * (1 - stipples[:,2])) + base).astype(int)
+    keep = t != 0
+    stipples, t = stipples[keep], t[keep]
+    packets = F.Packets()
+    if len(stipples) == 0:
+        return packets
+
+    # Position in mm, then in galvo ticks, all at once.
+    xy_mm = stipples[:,:2] / float(dpi) * 25.4 + [x_mm, y_mm]
+    if order == 'hilbert':
+        sequence = hilbert_order(xy_mm)
+    elif order == 'nearest':
+        sequence = nearest_order(xy_mm)
+    elif order == 'x':
+        sequence = np.argsort(xy_mm[:,0], kind='mergesort')
+    else:
+        raise ValueError("order must be 'hilbert', 'nearest' or 'x'.")
+    xy_mm, t = xy_mm[sequence], t[sequence]
+    model = P.FLEET_GALVO_MODEL if printer is None else printer.fit_galvo_model()
+    # The calibration's x axis drives galvo Y and its y axis galvo X,
+    # while to_flp (like stippler.py's image) maps x to galvo X, so
+    # swap axes to draw the image the same way round.
+    xy = np.clip(np.round(model(xy_mm[:,1], xy_mm[:,0])), 0, 0xffff).astype(int).T
+
+    # Merge dots that land on the same spot.
+    new = np.ones(len(xy), dtype=bool)
+    new[1:] = np.any(xy[1:] != xy[:-1], axis=1)
+    starts = np.flatnonzero(new)
+    xy = xy[starts]
+    t = np.add.reduceat(t, starts)
+
+    if settle_model is None:
+        settle_model = S.SettleModel()
+    # Size jumps along the galvo axes, as Settle.rewrite_jumps does.
+    # We don't know where the galvos start, so allow the longest jump first.
+    jumps_mm = np.vstack([[125, 125], np.diff(xy, axis=0) * S.MM_PER_TICK])
+    travel, settle = settle_model.jump_ticks(jumps_mm[:,0], jumps_mm[:,1])
+    for (x, y), dwell, move, wait in zip(xy.tolist(), t.tolist(), travel.tolist(), settle.tolist()):
+        # Move to this stipple's location with the laser off, then pause
+        # long enough for that jump to settle
+        packets.append(F.LaserPowerLevel(0))
+        packets.append(F.XYMove([[x, y, move], [x, y, wait]]))
+
+        # Draw the spot with the laser on, in steps of at most 0xffff ticks
+        packets.append(F.LaserPowerLevel(laser_pwr))
+        packets.append(F.XYMove([[x, y, min(dwell - i, 0xffff)]
+                                 for i in range(0, dwell, 0xffff)]))
+    return packets
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Convert stipple data to a .flp file")
     parser.add_argument('-dpi', metavar='dpi', type=int, default=300,
@@ -70,6 +189,9 @@ if __name__ == '__main__':
                         help="Image corner's x location (in mm)")
     parser.add_argument('-y', metavar='y', type=int, default=0,
                         help="Image corner's y location (in mm)")
+    parser.add_argument('--order', choices=['hilbert', 'nearest', 'x', 'none'], default='none',
+                        help='dot order for the optimized compiler; '
+                             "'none' compiles with the original to_flp")
     parser.add_argument('input', metavar='input', type=str,
                         help='source stipple file (created by stippler.py)')
     parser.add_argument('output', metavar='output', type=str,
@@ -77,5 +199,9 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     stipples = json.load(open(args.input))['stipples']
-    out = to_flp(stipples, dpi=args.dpi, x_mm=args.x, y_mm=args.y)
+    if args.order == 'none':
+        out = to_flp(stipples, dpi=args.dpi, x_mm=args.x, y_mm=args.y)
+    else:
+        out = to_flp_optimized(stipples, dpi=args.dpi, x_mm=args.x, y_mm=args.y,
+                               order=args.order)
     out.tofile(args.output)
@@ -11,3 +11,17 @@ sys.path.insert(0, dirname(dirname(os.path.abspath(inspect.getfile(inspect.curre
 
 from OpenFL import FLP
 from OpenFL import Printer
+from OpenFL import Timing
+from OpenFL import FakeUSB
+from OpenFL import Capture
+from OpenFL import Fleet
+from OpenFL import Scheduler
+from OpenFL import Profiler
+from OpenFL import Peel
+from OpenFL import Motion
+from OpenFL import Material
+from OpenFL import Simplify
+from OpenFL import Settle
+from OpenFL import Live
+from OpenFL import Toolpath
+from OpenFL import Slicer
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from context import FLP, Printer
+from context import FLP, Printer, Timing, FakeUSB, Capture, Fleet, Scheduler, Profiler, Peel, Motion, Material, Simplify, Settle, Live, Toolpath, Slicer
 import unittest
 
 import numpy as np
@@ -28,6 +28,843 @@ class PrinterTestSuite(unittest.TestCase):
         self.assertTrue(np.all(p.mm_to_galvo([0], [0]) == [[ 32026.],[ 32748.]]))
         self.assertTrue(np.all(p.mm_to_galvo(0, 0) == [32026., 32748.]))
 
+    def test_polynomial_galvo_model(self):
+        xy = np.random.RandomState(0).uniform(-64, 64, size=(2, 7, 3))
+        model = Printer.FLEET_GALVO_MODEL
+        reference = [Printer.polyval2d(P, *xy.reshape(2, -1)).reshape(7, 3)
+                     for P in (model.Px, model.Py)]
+        self.assertTrue(np.allclose(Printer.Printer.mm_to_galvo_approx(xy), reference))
+        self.assertEqual(Printer.Printer.mm_to_galvo_approx(0, 0).shape, (2,))
+
+        p = Printer.DummyPrinter()
+        grid = p.read_grid_table()
+        fit = p.fit_galvo_model(order=3)
+        self.assertTrue(fit.max_residual_ticks < 25)
+        self.assertTrue(np.allclose(fit(-64, 64), grid[4, 0], atol=25))
+        exact = p.fit_galvo_model(order=4) # As many coefficients as grid points.
+        self.assertTrue(exact.max_residual_ticks < 1e-6)
+        self.assertTrue(np.allclose(exact(0, 0), grid[2, 2]))
+
+    def approxPrinter(self):
+        """A DummyPrinter that maps mm to galvo ticks with the fleet-average fit."""
+        p = Printer.DummyPrinter()
+        p.mm_to_galvo = lambda x, y: Printer.Printer.mm_to_galvo_approx(x, y)
+        return p
+
+    def test_iter_samples_to_FLP(self):
+        p = self.approxPrinter()
+        samples = np.array([[0.0, 0.0, 0.0, 0.0],
+                            [1.0, 0.0, 0.01, 0.0],
+                            [12.0, 0.0, 2.0, 20.0],
+                            [12.0, 1.0, 0.01, 20.0],
+                            [-3.0, 1.0, 0.01, 0.0]])
+        whole = p.samples_to_FLP(samples)
+        chunked = FLP.Packets(p.iter_samples_to_FLP([samples[:2], samples[2:3], samples[3:]]))
+        self.assertEqual(whole, chunked)
+        self.assertEqual([type(x) for x in whole],
+                         [FLP.LaserPowerLevel, FLP.XYMove,
+                          FLP.LaserPowerLevel, FLP.XYMove,
+                          FLP.LaserPowerLevel, FLP.XYMove])
+        # The 11 mm segment is resampled, but its duration is kept:
+        self.assertEqual(sum(pt.dt for pt in whole[3].points), 2 * 60000 + 600)
+        split = FLP.Packets(p.iter_samples_to_FLP([samples], max_points=2))
+        self.assertTrue(max(move.npoints for move in split.moves()) <= 2)
+        from io import BytesIO
+        writer = p.write_samples_to_FLP([samples[:2], samples[2:]], BytesIO())
+        self.assertEqual(writer.fileHandle.getvalue(), whole.tostring())
+        self.assertEqual(writer.npackets, len(whole))
+
+
+class TimingTestSuite(unittest.TestCase):
+    def test_duration(self):
+        layer = FLP.Packets([FLP.XYMove([(0, 0, 30000), (1, 1, 30000)]),
+                             FLP.ZFeedRate(1000),
+                             FLP.ZMove(-2000),
+                             FLP.Dwell(s=0.5),
+                             FLP.TiltFeedRate(500),
+                             FLP.TiltMove(500),
+                             FLP.WaitForMovesToComplete(),
+                             FLP.Dwell(s=0.25)])
+        # 1 s of laser, then z (2 s) and tilt (1 s) overlap the 0.5 s dwell:
+        self.assertAlmostEqual(Timing.duration_s(layer), 1.0 + 2.0 + 0.25)
+
+    def test_insert_time_remaining(self):
+        def layer(n):
+            return [FLP.LayerStart(n), FLP.ZFeedRate(1000), FLP.ZMove(3000),
+                    FLP.WaitForMovesToComplete(), FLP.Dwell(s=2.0), FLP.LayerDone()]
+        blocks = [FLP.Packets(layer(0) + layer(1)),
+                  FLP.Packets([FLP.TimeRemaining(999)] + layer(2)[1:])]
+        result = Timing.insert_time_remaining(blocks)
+        self.assertEqual([[p.timeremaining_s for p in block.gen_packets(FLP.TimeRemaining)]
+                          for block in result], [[15, 10], [5]])
+        self.assertIsInstance(result[0][1], FLP.TimeRemaining)
+        self.assertEqual(len(result[1]), len(blocks[1]))
+        self.assertEqual(blocks[1][0].timeremaining_s, 999)
+
+
+class DummyPrinterTestSuite(unittest.TestCase):
+    def layer(self, n, dwell_s=0.0):
+        return FLP.Packets([FLP.LayerStart(n), FLP.Dwell(s=dwell_s),
+                            FLP.ZMove(400), FLP.LayerDone()])
+
+    def test_blocks(self):
+        p = Printer.DummyPrinter(serialNumber='ABC')
+        p.initialize()
+        p.write_block(3, self.layer(3))
+        p.write_block(4, self.layer(4))
+        self.assertEqual(p.list_blocks(), (3, 4))
+        self.assertEqual(p.read_block_flp(4), self.layer(4))
+        self.assertEqual(p.block_size(3), len(self.layer(3).tostring()))
+        p.delete_block(3)
+        self.assertEqual(p.list_blocks(), (4,))
+        self.assertTrue(p.get_machine_information()['serialNumber'].startswith(b'ABC'))
+
+    def test_print_events(self):
+        p = Printer.DummyPrinter(speedup=None)
+        p.initialize()
+        for i in range(2):
+            p.write_block(i, self.layer(i))
+        p.start_printing(0, 2)
+        events = list(iter(p.poll, None))
+        C = Printer.Command
+        self.assertEqual(events, [(C.STATUS_LAYER_DONE, 0), (C.STATUS_BLOCK_DONE, 0),
+                                  (C.STATUS_LAYER_DONE, 1), (C.STATUS_BLOCK_DONE, 1),
+                                  (C.STATUS_PRINT_DONE, None)])
+        self.assertEqual(p.state(), Printer.State.MACHINE_READY_TO_PRINT)
+        self.assertEqual(p._zpos_usteps, 800)
+
+    def test_status_during_commands(self):
+        p = Printer.DummyPrinter(speedup=None)
+        p.initialize()
+        for i in range(2):
+            p.write_block(i, self.layer(i))
+        # As with a printer, a command reads past the status packets
+        # sent before its response, keeping them only in status_buffer.
+        p.start_printing(0)
+        self.assertEqual(p.state(), Printer.State.MACHINE_READY_TO_PRINT)
+        self.assertEqual(p.poll(), None)
+        p.status_buffer = []
+        p.start_printing(1)
+        self.assertEqual(p.state(), Printer.State.MACHINE_READY_TO_PRINT)
+        C = Printer.Command
+        self.assertEqual(p.status_buffer, [(C.STATUS_LAYER_DONE, 1), (C.STATUS_BLOCK_DONE, 1),
+                                           (C.STATUS_PRINT_DONE, None)])
+
+    def test_speedup(self):
+        import time
+        p = Printer.DummyPrinter(speedup=1000.0)
+        p.initialize()
+        p.write_block(0, self.layer(0, dwell_s=100))
+        p.start_printing(0)
+        self.assertEqual(p.poll(), None)
+        self.assertEqual(p.state(), Printer.State.MACHINE_PRINTING)
+        time.sleep(0.2)
+        self.assertEqual(p.poll(), (Printer.Command.STATUS_LAYER_DONE, 0))
+
+
+    def test_block_cache(self):
+        import shutil, tempfile
+        from OpenFL import BlockCache
+        directory = tempfile.mkdtemp()
+        try:
+            p = Printer.DummyPrinter(serialNumber='CACHE1')
+            p.initialize()
+            cache = p.enable_block_cache(BlockCache.BlockCache(directory))
+            p.write_block(0, self.layer(0))
+            p.write_block(1, self.layer(1))
+            reads = []
+            read = p._do_CMD_READ_BLOCK
+            p._do_CMD_READ_BLOCK = lambda payload: reads.append(payload) or read(payload)
+            self.assertEqual(p.read_block_flp(0), self.layer(0))
+            self.assertEqual(reads, []) # Served from the cache.
+            # Change block 1 behind the cache's back:
+            p._blocks[1] = bytearray(self.layer(1, dwell_s=1).tostring() + b'\x0a')
+            self.assertEqual(p.read_block_flp(1)[-1], FLP.WaitForMovesToComplete())
+            self.assertEqual(len(reads), 1)
+            self.assertEqual(p.read_block_flp(1)[-1], FLP.WaitForMovesToComplete())
+            self.assertEqual(len(reads), 1) # ...and the fresh copy was cached.
+            p.write_block(10, self.layer(10))
+            p.write_block(1, self.layer(1))
+            self.assertEqual(sorted(b for b, _ in cache._entries('CACHE1')),
+                             [0, 1, 10])
+            p.delete_block(0, 1)
+            self.assertEqual([b for b, _ in cache._entries('CACHE1')], [10])
+            p.delete_block(10)
+            self.assertEqual(list(cache._entries('CACHE1')), [])
+        finally:
+            shutil.rmtree(directory)
+
+
+class FakeUSBTestSuite(unittest.TestCase):
+    def test_protocol(self):
+        # Fragmented reads split frames anywhere, including mid-escape.
+        dev = FakeUSB.FakeDevice(profile=FakeUSB.FRAGMENTED)
+        p = Printer.Printer(dev=dev)
+        p.initialize()
+        self.assertEqual(p.state(), Printer.State.MACHINE_READY_TO_PRINT)
+        layer = FLP.Packets([FLP.LayerStart(7),
+                             FLP.XYMove([(0xffff, 0xfdfe, 0xff), (0, 0, 100)]),
+                             FLP.LayerDone()])
+        p.write_block(2, layer)
+        self.assertEqual(p.list_blocks(), (2,))
+        self.assertEqual(p.block_size(2), len(layer.tostring()))
+        self.assertEqual(p.read_block_flp(2), layer)
+        self.assertEqual(p.read_grid_table(), Printer.DummyPrinter.GRID_TABLE)
+        p.start_printing(2)
+        self.assertEqual(p._wait_for_packet(Printer.Command.STATUS_LAYER_DONE, verbose=False), 7)
+        p._wait_for_packet(Printer.Command.STATUS_PRINT_DONE, verbose=False)
+        self.assertTrue(dev.reads > 1 and dev.bytes_read > 0)
+
+    def test_status_during_command(self):
+        # The print finishes while state() waits; its status packets
+        # come first, where a printer's status_buffer keeps them.
+        import time
+        firmware = Printer.DummyPrinter(speedup=1000.0)
+        p = Printer.Printer(dev=FakeUSB.FakeDevice(firmware, profile=FakeUSB.FRAGMENTED))
+        p.initialize()
+        p.write_block(0, FLP.Packets([FLP.LayerStart(3), FLP.Dwell(s=1), FLP.LayerDone()]))
+        p.start_printing(0)
+        time.sleep(0.05)
+        p.status_buffer = []
+        self.assertEqual(p.state(), Printer.State.MACHINE_READY_TO_PRINT)
+        C = Printer.Command
+        self.assertEqual(p.status_buffer, [(C.STATUS_LAYER_DONE, 3), (C.STATUS_BLOCK_DONE, 0),
+                                           (C.STATUS_PRINT_DONE, None)])
+
+    def test_read_blocks(self):
+        p = Printer.Printer(dev=FakeUSB.FakeDevice())
+        p.initialize()
+        layers = dict((i, FLP.Packets([FLP.LayerStart(i),
+                                       FLP.XYMove([(i, i, 10)] * (100 * i + 1)),
+                                       FLP.LayerDone()]))
+                      for i in range(5))
+        for i, layer in layers.items():
+            p.write_block(i, layer)
+        self.assertEqual([(i, bytes(data)) for i, data in p.read_blocks([3, 1])],
+                         [(3, layers[3].tostring()), (1, layers[1].tostring())])
+        self.assertEqual(list(p.read_blocks_flp(range(5), processes=2)),
+                         sorted(layers.items()))
+
+
+class CaptureTestSuite(unittest.TestCase):
+    def session(self, p):
+        p.initialize()
+        p.write_block(0, FLP.Packets([FLP.Dwell(s=1), FLP.LayerDone()]))
+        return p.list_blocks(), p.read_block_raw(0), p.state()
+
+    def test_record_replay(self):
+        from io import BytesIO
+        capture = BytesIO()
+        p = Printer.Printer(dev=FakeUSB.FakeDevice(profile=FakeUSB.FRAGMENTED))
+        p.start_recording(capture)
+        live = self.session(p)
+        p.stop_recording()
+        self.assertEqual(p.recorder, None)
+
+        replay = Capture.ReplayDevice(BytesIO(capture.getvalue()))
+        self.assertEqual(self.session(Printer.Printer(dev=replay)), live)
+        self.assertTrue(replay.done)
+
+        replay = Capture.ReplayDevice(BytesIO(capture.getvalue()))
+        p = Printer.Printer(dev=replay)
+        with self.assertRaises(Capture.CaptureError):
+            p.shutdown() # The capture starts with initialize.
+
+    def test_timeouts(self):
+        import errno
+        from io import BytesIO
+        capture = BytesIO()
+        p = Printer.Printer(dev=FakeUSB.FakeDevice())
+        p.start_recording(capture)
+        p.initialize()
+        self.assertEqual(p.poll(), None) # Times out.
+        p.stop_recording()
+        records = list(Capture.readCapture(BytesIO(capture.getvalue())))
+        self.assertEqual(records[-1][1:], (Capture.TIMEOUT, bytearray()))
+
+        # A response that only arrived after a timeout is held back.
+        capture = BytesIO()
+        writer = Capture.CaptureWriter(capture)
+        writer.record(Capture.WRITE, b'ping')
+        writer.record(Capture.TIMEOUT, b'')
+        writer.record(Capture.READ, b'pong')
+        writer.close()
+        replay = Capture.ReplayDevice(BytesIO(capture.getvalue()))
+        replay.write(Printer.Printer.RX_EP, b'ping')
+        with self.assertRaises(Printer.usb.core.USBError) as e:
+            replay.read(Printer.Printer.TX_EP, 64)
+        self.assertEqual(e.exception.errno, errno.ETIMEDOUT)
+        self.assertEqual(replay.read(Printer.Printer.TX_EP, 64), b'pong')
+        self.assertTrue(replay.done)
+
+
+class DaemonTestSuite(unittest.TestCase):
+    def test_client(self):
+        import os, tempfile
+        from OpenFL import Daemon
+        path = os.path.join(tempfile.mkdtemp(), 'printer.sock')
+        daemon = Daemon.PrinterDaemon(Printer.DummyPrinter(speedup=None), path,
+                                      poll_interval_s=0.01)
+        daemon.start()
+        try:
+            p = Daemon.PrinterClient(path)
+            p.initialize()
+            self.assertEqual(p.state(), Printer.State.MACHINE_READY_TO_PRINT)
+            layer = FLP.Packets([FLP.LayerStart(5), FLP.LaserPowerLevel(100),
+                                 FLP.LayerDone()])
+            p.write_block(0, layer)
+            self.assertEqual(p.list_blocks(), (0,))
+            self.assertEqual(p.read_block_flp(0), layer)
+            self.assertEqual(p.block_information(0), (len(layer.tostring()), 0))
+            self.assertTrue(np.allclose(p.read_grid_table(), Printer.DummyPrinter.GRID_TABLE))
+            with self.assertRaises(Printer.BadResponse):
+                p.start_printing(3)
+            with self.assertRaises(Printer.LaserPowerError):
+                p.write_block(1, FLP.Packets([FLP.LaserPowerLevel(0xffff)]))
+            # Files are read by the client, never by the daemon.
+            filename = os.path.join(os.path.dirname(path), 'layer.flp')
+            layer.tofile(filename)
+            p.write_block(2, filename)
+            self.assertEqual(p.read_block_flp(2), layer)
+            with self.assertRaises(TypeError):
+                p._call('write_block', 3, filename)
+            with self.assertRaises(TypeError):
+                p._call('write_block', 3, data=filename)
+            # Malformed requests are answered, and the connection stays up.
+            connection = Daemon._Connection(path)
+            connection.wfile.write(b'not json\n{"id": 7}\n')
+            connection.wfile.flush()
+            response = connection.receive()
+            self.assertEqual(response['id'], None)
+            self.assertNotEqual(response['error'], None)
+            response = connection.receive()
+            self.assertEqual((response['id'], response['error']['type']), (7, 'KeyError'))
+            self.assertEqual(connection.send('list_blocks')['result'], [0, 2])
+            connection.close()
+            self.assertEqual(p.list_blocks(), (0, 2))
+            p.subscribe()
+            p.start_printing(0)
+            self.assertEqual(p._wait_for_packet(Printer.Command.STATUS_LAYER_DONE,
+                                                verbose=False), 5)
+            p.close()
+        finally:
+            daemon.shutdown()
+
+
+class FleetTestSuite(unittest.TestCase):
+    def test_fleet(self):
+        printers = [Printer.DummyPrinter(speedup=None, serialNumber='F{}'.format(i))
+                    for i in range(3)]
+        fleet = Fleet.Fleet(printers)
+        fleet.initialize().raise_errors()
+        self.assertEqual(fleet.serial_numbers(), ['F0', 'F1', 'F2'])
+        layer = FLP.Packets([FLP.LayerStart(0), FLP.LaserPowerLevel(100),
+                             FLP.LayerDone()])
+        result = fleet.write_block(0, layer).raise_errors()
+        self.assertEqual(result.nbytes, 3 * len(layer.tostring()))
+        self.assertEqual(fleet.list_blocks(), {'F0': (0,), 'F1': (0,), 'F2': (0,)})
+        self.assertEqual(set(fleet.state().values()), {Printer.State.MACHINE_READY_TO_PRINT})
+        result = fleet.start_printing(3, serials=['F1'])
+        self.assertIsInstance(result.errors['F1'], Printer.BadResponse)
+        with self.assertRaises(Printer.LaserPowerError):
+            fleet.write_block(1, FLP.Packets([FLP.LaserPowerLevel(0xffff)]))
+        fleet.delete_block(0, serials=['F0', 'F2'])
+        self.assertEqual(fleet.list_blocks(), {'F0': (), 'F1': (0,), 'F2': ()})
+        import os, tempfile
+        filename = os.path.join(tempfile.mkdtemp(), 'layer.flp')
+        layer.tofile(filename)
+        result = fleet.write_blocks({1: filename, 2: layer, 3: bytearray(layer.tostring())},
+                                    serials=['F0']).raise_errors()
+        self.assertEqual(result.nbytes, 3 * len(layer.tostring()))
+        self.assertEqual([printers[0].read_block_flp(i) for i in (1, 2, 3)], [layer] * 3)
+        with self.assertRaises(RuntimeError):
+            Fleet.Fleet(printers + [Printer.DummyPrinter(serialNumber='F0')])
+        fleet.close()
+
+
+class SchedulerTestSuite(unittest.TestCase):
+    def job(self, name, dwell_s):
+        return Scheduler.Job([FLP.Packets([FLP.LayerStart(0), FLP.Dwell(s=dwell_s),
+                                           FLP.LayerDone()])], name=name)
+
+    def test_scheduler(self):
+        printers = [Printer.DummyPrinter(speedup=None, serialNumber='S{}'.format(i))
+                    for i in range(2)]
+        for p in printers:
+            p.initialize()
+        scheduler = Scheduler.Scheduler(Fleet.Fleet(printers))
+        for name, dwell_s in [('a', 1), ('b', 5), ('c', 3), ('d', 4)]:
+            scheduler.submit(self.job(name, dwell_s))
+        self.assertEqual([job.name for job in scheduler.pending], ['b', 'd', 'c', 'a'])
+        self.assertEqual([(job.name, job.printer) for job in scheduler.dispatch()],
+                         [('b', 'S0'), ('d', 'S1')])
+        self.assertEqual(scheduler.idle(), [])
+        finished = scheduler.run(poll_interval_s=0)
+        self.assertEqual([job.name for job in finished], ['b', 'd', 'c', 'a'])
+        self.assertEqual(finished[0].events[-1], (Printer.Command.STATUS_PRINT_DONE, None))
+        self.assertEqual(scheduler.failed, [])
+        self.assertEqual(printers[0].list_blocks(), (0,))
+
+    def test_failures(self):
+        printers = [Printer.DummyPrinter(serialNumber='F{}'.format(i)) for i in range(4)]
+        for p in printers:
+            p.initialize()
+        scheduler = Scheduler.Scheduler(Fleet.Fleet(printers))
+        for i in range(4):
+            scheduler.submit(self.job(str(i), 100 + i))
+        scheduler.dispatch()
+        # Stopped without a word, stopped with a word, and unplugged.
+        printers[0].stop_printing()
+        printers[1].stop_printing()
+        printers[1].incoming.append((Printer.Command.STATUS_PRINT_DONE,
+                                     Printer.Response.STATUS_PRINT_STOPPED_DUE_TO_ABORT))
+        def unplugged(bufsize=None):
+            raise IOError('No such device')
+        printers[2].poll = unplugged
+        self.assertEqual(len(scheduler.update()), 3)
+        self.assertEqual(list(scheduler.running), ['F3'])
+        errors = dict((job.printer, job.error) for job in scheduler.failed)
+        self.assertIsInstance(errors['F0'], RuntimeError)
+        self.assertEqual(errors['F1'].args, (Printer.Response.STATUS_PRINT_STOPPED_DUE_TO_ABORT,))
+        self.assertIsInstance(errors['F2'], IOError)
+        printers[3].stop_printing()
+        self.assertEqual(scheduler.run(poll_interval_s=0), [])
+        self.assertEqual(len(scheduler.failed), 4)
+
+    def test_no_printers(self):
+        scheduler = Scheduler.Scheduler(Fleet.Fleet([]))
+        job = scheduler.submit(self.job('a', 1))
+        self.assertEqual(scheduler.run(poll_interval_s=0), [])
+        self.assertEqual(scheduler.failed, [job])
+        self.assertIsInstance(job.error, RuntimeError)
+        # A printer that never becomes ready (it was never initialized).
+        scheduler = Scheduler.Scheduler(Fleet.Fleet([Printer.DummyPrinter()]))
+        job = scheduler.submit(self.job('b', 1))
+        with self.assertRaises(RuntimeError):
+            scheduler.run(poll_interval_s=0.01, timeout_s=0.05)
+        self.assertEqual(scheduler.pending, [job])
+
+
+class ProfilerTestSuite(unittest.TestCase):
+    def layer(self, n):
+        return FLP.Packets([FLP.LayerStart(n), FLP.LaserPowerLevel(100),
+                            FLP.XYMove([(0, 0, 6000)]), FLP.XYMove([(1, 1, 12000)]),
+                            FLP.LaserPowerLevel(0), FLP.ZFeedRate(1000), FLP.ZMove(1000),
+                            FLP.WaitForMovesToComplete(), FLP.Dwell(s=0.5), FLP.LayerDone()])
+
+    def test_profile(self):
+        import io
+        blocks, sections = Profiler.instrument([self.layer(0), self.layer(1)], 'peel')
+        self.assertEqual([s.label for s in sections],
+                         ['0 layer 0', '1 layer 0 peel', '2 layer 1', '3 layer 1 peel'])
+        self.assertEqual(list(blocks[0].gen_packets(FLP.XYMove)),
+                         list(self.layer(0).gen_packets(FLP.XYMove)))
+        serial = io.StringIO()
+        p = Printer.DummyPrinter(speedup=None, serial=serial)
+        p.initialize()
+        for i, block in enumerate(blocks):
+            p.write_block(i, block)
+        p.start_printing(0, 2)
+        list(iter(p.poll, None))
+        log = [b'boot\n'] + serial.getvalue().encode('ascii').splitlines(True)
+        rows = Profiler.profile(sections, log)
+        self.assertEqual([r.label for r in rows], [s.label for s in sections])
+        for row in rows:
+            self.assertAlmostEqual(row.actual_s, row.predicted_s, places=3)
+        self.assertAlmostEqual(rows[1].actual_s, 1.5)
+        self.assertIn('total', Profiler.format_report(rows))
+
+
+class PeelTestSuite(unittest.TestCase):
+    def layer(self, n, path_ticks):
+        return FLP.Packets([FLP.LayerStart(n), FLP.XYMove([(0, 0, 100)]),
+                            FLP.LaserPowerLevel(1000), FLP.XYMove([(path_ticks, 0, 100)]),
+                            FLP.LaserPowerLevel(0), FLP.Dwell(s=1.0),
+                            FLP.TiltFeedRate(1000), FLP.TiltMove(2000),
+                            FLP.ZFeedRate(1000), FLP.ZMove(40),
+                            FLP.TiltFeedRate(2000), FLP.TiltMove(-2000), FLP.TiltMove(-50),
+                            FLP.WaitForMovesToComplete(), FLP.Dwell(s=2.0), FLP.LayerDone()])
+
+    def test_optimize_peel(self):
+        # 0xffff ticks is 125 mm of path, or about 11 mm^2 at 0.09 mm wide.
+        big, small = self.layer(0, 0xffff), self.layer(1, 0)
+        self.assertAlmostEqual(Peel.exposed_area_mm2(big), 125 * 0.09)
+        bounds = Peel.PeelBounds(full_area_mm2=10.0)
+        blocks, savings = Peel.optimize_peel([big, small], bounds)
+        self.assertEqual(blocks[0], big)
+        self.assertEqual([s.layer for s in savings], [0, 1])
+        self.assertEqual(savings[0].original_s, savings[0].optimized_s)
+        self.assertLess(savings[1].optimized_s, savings[1].original_s)
+        tilts = [p.usteps for p in blocks[1].gen_packets(FLP.TiltMove)]
+        self.assertEqual(tilts, [1000, -1000, -50])
+        self.assertEqual([p.feedrate for p in blocks[1].gen_packets(FLP.TiltFeedRate)],
+                         [2000, 4000])
+        self.assertEqual([p.duration_s for p in blocks[1].gen_packets(FLP.Dwell)], [1.0, 0.5])
+        self.assertEqual(list(blocks[1].gen_packets(FLP.ZMove)), [FLP.ZMove(40)])
+        self.assertEqual(small[7].usteps, 2000) # The input is unchanged.
+        self.assertIn('total', Peel.format_savings(savings))
+
+
+class MotionTestSuite(unittest.TestCase):
+    def layer(self, n):
+        return FLP.Packets([FLP.LayerStart(n), FLP.TiltFeedRate(1000), FLP.TiltMove(2000),
+                            FLP.WaitForMovesToComplete(),
+                            FLP.ZFeedRate(1000), FLP.ZMove(2000),
+                            FLP.WaitForMovesToComplete(),
+                            FLP.TiltMove(-2000), FLP.TiltCurrent(moving=False),
+                            FLP.WaitForMovesToComplete(),
+                            FLP.Dwell(s=0.5), FLP.LayerDone()])
+
+    def test_plan_motion(self):
+        blocks, plans = Motion.plan_motion([self.layer(0), self.layer(1)])
+        W = FLP.WaitForMovesToComplete()
+        self.assertEqual([list(b).count(W) for b in blocks], [2, 2])
+        self.assertEqual([p.barriers_removed for p in plans], [1, 1])
+        self.assertAlmostEqual(plans[0].original_s, 6.5)
+        self.assertAlmostEqual(plans[0].planned_s, 4.5)
+        # Letting z rise during the peel also needs (TILT_DOWN, Z_UP):
+        rules = Motion.DEFAULT_RULES | {(Motion.TILT_DOWN, Motion.Z_UP)}
+        layer, removed = Motion.plan_layer(self.layer(0), rules)
+        self.assertEqual(removed, 1) # The tilt-up still waits for the tilt-down.
+        self.assertEqual(list(layer).count(W), 2)
+        # A layer ends with its motors stopped, and Dwells still wait.
+        homing = FLP.makeHomingSequence()
+        self.assertEqual(Motion.plan_layer(homing)[0][-1], homing[-1])
+
+
+class MaterialTestSuite(unittest.TestCase):
+    def test_retune(self):
+        import os
+        ini = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                           'Form_1+_FLGPCL02_100.ini')
+        old = Material.Material(ini)
+        self.assertEqual(old['fill']['modellaserpowermw'], 62)
+        self.assertEqual(old.tilt_velocity_mm_s(0, 'down'), 1)
+        self.assertEqual(old.tilt_velocity_mm_s(100, 'down'), 1.5)
+        new = old.copy()
+        new['perimeter']['modellaserpowermw'] = 40
+        new['fill']['modelxyfeedrate'] = 1550 / 2
+        new['btwnLayerRoutine']['p2downvel'] = 3
+        p = Printer.DummyPrinter()
+        d = int(8 / Material.MM_PER_TICK)
+        # 8 mm of perimeter at 800 mm/s, then 8 mm of fill at 1550 mm/s,
+        # the last with a 0xffff-tick dwell at its end point.
+        print_ = FLP.Packets([FLP.LayerStart(30),
+                              FLP.LaserPowerLevel(int(p.mW_to_ticks(48))),
+                              FLP.XYMove([(0, 0, 0), (d, 0, 600)]),
+                              FLP.LaserPowerLevel(int(p.mW_to_ticks(62))),
+                              FLP.XYMove([(d, d, 310), (d, d, 0xffff)]),
+                              FLP.LaserPowerLevel(0), FLP.XYMove([(0, 0, 50)]),
+                              FLP.TiltFeedRate(1000), FLP.TiltMove(3000),
+                              FLP.TiltFeedRate(5000), FLP.TiltMove(-3000),
+                              FLP.ZFeedRate(1000), FLP.LayerDone()])
+        result, counts = Material.retune(print_, old, new, p, z_feedrate_scale=2)
+        self.assertEqual(counts, {('perimeter', 'model'): 1, ('fill', 'model'): 1})
+        powers = [x.power for x in result.gen_packets(FLP.LaserPowerLevel)]
+        self.assertAlmostEqual(p.ticks_to_mW(powers[0]), 40, places=1)
+        self.assertAlmostEqual(p.ticks_to_mW(powers[1]), 62, places=1)
+        moves = list(result.gen_packets(FLP.XYMove))
+        self.assertEqual(moves[0].points, print_[2].points)
+        # Half the speed: twice the ticks, and the dwell is split in two.
+        self.assertEqual([tuple(r) for r in moves[1].points],
+                         [(d, d, 620), (d, d, 0xffff),
+                          (d, d, 0xffff)])
+        self.assertEqual(moves[2].points, print_[6].points)
+        self.assertEqual([x.feedrate for x in result.gen_packets(FLP.TiltFeedRate)],
+                         [2000, 5000])
+        self.assertEqual([x.feedrate for x in result.gen_packets(FLP.ZFeedRate)], [2000])
+        new['fill']['modellaserpowermw'] = 80
+        with self.assertRaises(Printer.LaserPowerError):
+            Material.retune(print_, old, new, p)
+
+
+class SimplifyTestSuite(unittest.TestCase):
+    def test_simplify_samples(self):
+        # A straight line, a corner, a slight wiggle, then a power change.
+        x = np.arange(11, dtype=float)
+        rows = np.zeros((16, 4))
+        rows[:11, 0] = x
+        rows[11:, 0] = 10
+        rows[11:, 1] = [1, 2, 3, 4, 5]
+        rows[12, 0] = 10.001
+        rows[:, 2] = 0.5
+        rows[:, 3] = 60
+        rows[14:, 3] = 30
+        result = Simplify.simplify_samples(rows, tolerance_mm=0.01)
+        self.assertEqual(result[:, :2].tolist(),
+                         [[0, 0], [10, 0], [10, 3], [10, 4], [10, 5]])
+        self.assertEqual(result[:, 2].tolist(), [0.5, 5.0, 1.5, 0.5, 0.5])
+        self.assertEqual(result[:, 3].tolist(), [60, 60, 60, 30, 30])
+        self.assertEqual(result[:, 2].sum(), rows[:, 2].sum())
+        # A tighter tolerance keeps the wiggle.
+        result = Simplify.simplify_samples(rows, tolerance_mm=0.0001)
+        self.assertEqual(len(result), 7)
+
+    def test_simplify_packets(self):
+        flp = FLP.Packets([FLP.XYMove([(0, 0, 0), (100, 0, 40000), (200, 0, 40000),
+                                       (200, 0, 10), (300, 0, 5), (300, 50, 5)]),
+                           FLP.LaserPowerLevel(1000),
+                           FLP.XYMove([(300, 100, 5), (300, 200, 10)])])
+        result = Simplify.simplify_packets(flp, tolerance_ticks=1)
+        moves = list(result.gen_packets(FLP.XYMove))
+        # Rows are capped at 0xffff ticks; dwells at a point are kept.
+        self.assertEqual(moves[0].points, [(0, 0, 0), (100, 0, 40000), (200, 0, 40000),
+                                           (200, 0, 10), (300, 0, 5), (300, 50, 5)])
+        # The second move continues the first in a straight line.
+        self.assertEqual(moves[1].points, [(300, 200, 15)])
+        flp = FLP.Packets([FLP.XYMove([(i, 2 * i, 10) for i in range(100)])])
+        move = Simplify.simplify_packets(flp, tolerance_ticks=1)[0]
+        self.assertEqual(move.points, [(0, 0, 10), (99, 198, 990)])
+        self.assertEqual(flp[0].npoints, 100)
+
+    def test_speed_change(self):
+        # A straight line drawn slowly, then quickly, at one power.
+        rows = np.zeros((11, 4))
+        rows[:, 0] = np.arange(11)
+        rows[1:6, 2] = 0.5
+        rows[6:, 2] = 0.1
+        rows[:, 3] = 60
+        result = Simplify.simplify_samples(rows, tolerance_mm=0.01)
+        self.assertEqual(result[:, 0].tolist(), [0, 5, 10])
+        self.assertTrue(np.allclose(result[:, 2], [0, 2.5, 0.5]))
+        # Small variations in speed are merged.
+        rows[6:, 2] = 0.49
+        result = Simplify.simplify_samples(rows, tolerance_mm=0.01)
+        self.assertEqual(result[:, 0].tolist(), [0, 10])
+        flp = FLP.Packets([FLP.XYMove([(i, 0, 10) for i in range(1, 6)] +
+                                      [(i, 0, 2) for i in range(6, 11)])])
+        move = Simplify.simplify_packets(flp, tolerance_ticks=1)[0]
+        self.assertEqual(move.points, [(1, 0, 10), (5, 0, 40), (10, 0, 10)])
+
+
+class SettleTestSuite(unittest.TestCase):
+    def test_model(self):
+        model = Settle.SettleModel()
+        travel, settle = model.jump_ticks([125, 0, 0.1], [0, 0, 0])
+        self.assertEqual(travel.tolist(), [200, 2, 2])
+        self.assertEqual(settle.tolist(), [100, 10, 11])
+        # Fit to settle times measured for 2 + 0.5/mm in x and 3 + 1/mm in y.
+        distance = np.array([1, 10, 30, 1, 10, 30, 20])
+        angle = np.radians([0, 0, 0, 90, 90, 90, 45])
+        dx, dy = np.abs(distance * np.cos(angle)), np.abs(distance * np.sin(angle))
+        fit = Settle.SettleModel.fit(distance, angle, 2 + 0.5 * dx + 1 * dy)
+        self.assertAlmostEqual(fit.settle_ticks, 2)
+        self.assertAlmostEqual(fit.settle_ticks_per_mm_x, 0.5)
+        self.assertAlmostEqual(fit.settle_ticks_per_mm_y, 1)
+        pattern = Settle.calibration_pattern()
+        self.assertEqual(len(list(pattern.gen_packets(FLP.XYMove))), 3 * 4 * 6 * 3)
+
+    def test_rewrite_jumps(self):
+        far = int(100 / Settle.MM_PER_TICK)
+        print_ = FLP.Packets([FLP.LaserPowerLevel(0), FLP.XYMove([(0, 0, 200), (0, 0, 100)]),
+                              FLP.LaserPowerLevel(1000), FLP.XYMove([(0, 0, 50)]),
+                              # A short hop, through a waypoint.
+                              FLP.LaserPowerLevel(0), FLP.XYMove([(50, 0, 200)]),
+                              FLP.XYMove([(100, 0, 200), (100, 0, 100)]),
+                              FLP.LaserPowerLevel(1000), FLP.XYMove([(100, 0, 50)]),
+                              # A long jump, which already takes less than the model.
+                              FLP.LaserPowerLevel(0), FLP.XYMove([(far, 0, 100), (far, 0, 10)]),
+                              FLP.LaserPowerLevel(1000), FLP.XYMove([(far, 0, 50)]),
+                              # Laser off at the end; not a jump.
+                              FLP.LaserPowerLevel(0), FLP.XYMove([(0, 0, 200)])])
+        result, stats = Settle.rewrite_jumps(print_)
+        self.assertEqual(stats.jumps, 1)
+        self.assertAlmostEqual(stats.original_s, 500 / 60e3)
+        self.assertAlmostEqual(stats.rewritten_s, 13 / 60e3)
+        self.assertEqual(len(result), len(print_) - 1)
+        self.assertEqual(result[5].points, [(100, 0, 2), (100, 0, 11)])
+        self.assertEqual(result[1].points, print_[1].points)
+        self.assertEqual(result[9].points, print_[10].points)
+        self.assertEqual(result[-1].points, print_[-1].points)
+        self.assertEqual(print_[5].points, [(50, 0, 200)])
+        result, stats = Settle.rewrite_jumps([print_], only_shorten=False)
+        self.assertEqual(stats.jumps, 2)
+        self.assertEqual(result[0][9].points, [(far, 0, 160), (far, 0, 82)])
+
+
+class LiveTestSuite(unittest.TestCase):
+    def test_stream(self):
+        p = Printer.DummyPrinter(speedup=None)
+        p.initialize()
+        written = []
+        write_block_flp = p.write_block_flp
+        p.write_block_flp = lambda block, flp: written.append(flp) or write_block_flp(block, flp)
+        stream = Live.Stream(p, first_block=10, block_s=0.1)
+        notes = []
+        for i in range(20):
+            # 40 usteps at 800 usteps/s is 0.05 s, so about two notes to a block.
+            stream.move_z(40 if i % 3 else -40, feedrate=800)
+            notes += [FLP.ZFeedRate(800), FLP.ZMove(40 if i % 3 else -40),
+                      FLP.WaitForMovesToComplete()]
+        self.assertTrue(stream.running)
+        stream.finish()
+        self.assertFalse(stream.running)
+        self.assertEqual(FLP.Packets(p for block in written for p in block), notes)
+        self.assertTrue(all(Timing.duration_s(block) < 0.2 for block in written))
+        self.assertEqual(stream.blocks_sent, len(written))
+        self.assertGreater(len(written), 5)
+        self.assertEqual(p.list_blocks(), (10, 11))
+        C = Printer.Command
+        self.assertEqual(stream.events.count((C.STATUS_PRINT_DONE, None)), len(written))
+        self.assertEqual(p._zpos_usteps, 40 * (20 - 2 * 7))
+        self.assertEqual(p.state(), Printer.State.MACHINE_READY_TO_PRINT)
+
+    def test_overlap(self):
+        import time
+        p = Printer.DummyPrinter(speedup=10.0)
+        p.initialize()
+        stream = Live.Stream(p, block_s=0.05)
+        started = time.time()
+        for i in range(20):
+            stream.dwell(0.05)
+        # The host only waits for a free slot, not for each block to finish.
+        self.assertTrue(stream.running)
+        stream.finish()
+        self.assertGreaterEqual(time.time() - started, 0.09)
+        self.assertGreater(stream.blocks_sent, 10)
+
+
+class ToolpathTestSuite(unittest.TestCase):
+    def square(self, x, y, w):
+        return np.array([(x, y), (x + w, y), (x + w, y + w), (x, y + w)], dtype=float)
+
+    def test_hatch_spans(self):
+        square = self.square
+        # Overlapping squares fill as their union.
+        spans = Toolpath.hatch_spans([square(0, 0, 10), square(5, 5, 10)], 0.1,
+                                     clear=[square(1, 1, 2)])
+        self.assertAlmostEqual((spans[:,2] - spans[:,1]).sum() * 0.1, 175 - 4)
+        # Clockwise polygons are holes.
+        spans = Toolpath.hatch_spans([square(0, 0, 10), square(1, 1, 2)[::-1]], 0.1)
+        self.assertAlmostEqual((spans[:,2] - spans[:,1]).sum() * 0.1, 100 - 4)
+        paths = Toolpath.hatch([square(0, 0, 10), square(3, 3, 4)[::-1]], 0.5, angle_rad=0.3)
+        exposed_mm = sum((np.hypot(*np.diff(p.xy, axis=0).T) * p.on).sum() for p in paths)
+        self.assertAlmostEqual(exposed_mm * 0.5, 100 - 16, places=0)
+
+    def test_boundary(self):
+        square = self.square
+        def traced(paths):
+            return sorted((round(Toolpath.signed_area(p.xy[:-1]), 6),
+                           round(np.hypot(*np.diff(p.xy, axis=0).T).sum(), 6))
+                          for p in paths if p.closed)
+        # Overlapping squares are traced as their union.
+        self.assertEqual(traced(Toolpath.boundary([square(0, 0, 10), square(5, 5, 10)])),
+                         [(175, 60)])
+        self.assertEqual(traced(Toolpath.boundary([square(0, 0, 10), square(10, 0, 10)])),
+                         [(200, 60)])
+        self.assertEqual(traced(Toolpath.boundary([square(0, 0, 10), square(2, 2, 2)])),
+                         [(100, 40)])
+        # Clear cuts into the edge; holes go clockwise.
+        self.assertEqual(traced(Toolpath.boundary([square(0, 0, 10)], clear=[square(8, 2, 4)])),
+                         [(92, 44)])
+        self.assertEqual(traced(Toolpath.boundary([square(0, 0, 10), square(3, 3, 4)[::-1]])),
+                         [(-16, 16), (100, 40)])
+        self.assertEqual(traced(Toolpath.boundary([square(0, 0, 10)], clear=[square(3, 3, 4)])),
+                         [(-16, 16), (100, 40)])
+
+    def test_offset(self):
+        L = np.array([(0, 0), (10, 0), (10, 2), (2, 2), (2, 10), (0, 10)], dtype=float)
+        inner, = Toolpath.offset([L], 0.5)
+        self.assertTrue(np.allclose(inner, [(0.5, 0.5), (9.5, 0.5), (9.5, 1.5),
+                                            (1.5, 1.5), (1.5, 9.5), (0.5, 9.5)]))
+        # The arms vanish before the corner does.
+        self.assertEqual(len(Toolpath.offset([L], 0.9)[0]), 6)
+        self.assertEqual(Toolpath.offset([L], 1.5), [])
+        hole = self.square(3, 3, 4)[::-1]
+        outer, grown = Toolpath.offset([self.square(0, 0, 10), hole], 1.0)
+        self.assertAlmostEqual(Toolpath.signed_area(grown), -36)
+        # Sharp corners are bevelled rather than mitered far out.
+        sliver = np.array([(0, 0), (10, 0), (0, 1)], dtype=float)
+        bigger, = Toolpath.offset([sliver], -0.2)
+        self.assertEqual(len(bigger), 4)
+        self.assertTrue(bigger[:,0].max() < 10.3)
+
+    def test_layer(self):
+        import os
+        ini = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                           'Form_1+_FLGPCL02_100.ini')
+        settings = Toolpath.settings(Material.Material(ini))
+        self.assertEqual(settings, Toolpath.DEFAULT_SETTINGS)
+        rng = np.random.RandomState(0)
+        angles = np.linspace(0, 2 * np.pi, 100, endpoint=False)
+        circles = [center + radius * np.transpose([np.cos(angles), np.sin(angles)])
+                   for center, radius in zip(rng.uniform(-40, 40, (20, 2)), rng.uniform(1, 4, 20))]
+        paths = Toolpath.layer_paths(circles, settings)
+        self.assertEqual(sum(p.section == 'perimeter' for p in paths), 3 * 20)
+        def travel_mm(paths):
+            here, total = np.zeros(2), 0.0
+            for p in paths:
+                total += np.hypot(*(p.xy[0] - here))
+                total += (np.hypot(*np.diff(p.xy, axis=0).T) * ~p.on).sum()
+                here = p.xy[-1]
+            return total
+        fill = Toolpath.hatch(circles, 0.09)
+        self.assertLess(travel_mm(Toolpath.order_paths(fill)), 0.7 * travel_mm(fill))
+        samples = Toolpath.paths_to_samples(paths, {'perimeter': (48.0, 800.0),
+                                                    'fill': (62.0, 1550.0)}, start_xy=(0, 0))
+        self.assertEqual(samples[0].tolist(), [0, 0, 0, 0])
+        self.assertEqual(set(samples[:,3]), set([0.0, 48.0, 62.0]))
+
+
+class SlicerTestSuite(unittest.TestCase):
+    def lathe(self, profile, n=64):
+        """
+        Triangles of the solid swept by (r, z) profile points, which
+        go from the bottom center up the outside to the top center.
+        """
+        a = np.linspace(0, 2 * np.pi, n, endpoint=False)
+        ring = np.transpose([np.cos(a), np.sin(a)])
+        rings = [np.column_stack([r * ring, np.full(n, z)]) for r, z in profile]
+        triangles = []
+        for p, q in zip(rings[:-1], rings[1:]):
+            for i in range(n):
+                j = (i + 1) % n
+                triangles += [[p[i], p[j], q[j]], [p[i], q[j], q[i]]]
+        return np.array(triangles, dtype=float)
+
+    def cylinder(self, r, h, n=64):
+        return self.lathe([(0, 0), (r, 0), (r, h), (0, h)], n)
+
+    def test_slice(self):
+        import io
+        triangles = self.cylinder(10, 5)
+        records = np.zeros(len(triangles), dtype=Slicer.STL_DTYPE)
+        records['vertices'] = triangles
+        stl = b'\0' * 80 + np.uint32(len(triangles)).tobytes() + records.tobytes()
+        self.assertTrue(np.allclose(Slicer.read_stl(io.BytesIO(stl)), triangles))
+        polygons, open_loops = Slicer.Mesh(triangles).slice(2.5)
+        self.assertEqual((len(polygons), open_loops), (1, 0))
+        self.assertAlmostEqual(Toolpath.signed_area(polygons[0]), 32 * 100 * np.sin(np.pi / 32))
+        # Cutting through a ring of vertices gives the section just below it.
+        step = Slicer.Mesh(self.lathe([(0, 0), (10, 0), (10, 0.25), (5, 0.25), (5, 1), (0, 1)]))
+        for z_mm, r in [(0.25, 10), (0.5, 5), (1.0, 5)]:
+            polygons, open_loops = step.slice(z_mm)
+            self.assertEqual((len(polygons), open_loops), (1, 0))
+            self.assertAlmostEqual(Toolpath.signed_area(polygons[0]),
+                                   32 * r * r * np.sin(np.pi / 32))
+
+    def test_slice_mesh(self):
+        import os
+        ini = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                           'Form_1+_FLGPCL02_100.ini')
+        material = Material.Material(ini)
+        mesh = Slicer.Mesh(self.cylinder(10, 1))
+        blocks, stats = Slicer.slice_mesh(mesh, material, Printer.DummyPrinter(), processes=0)
+        self.assertEqual(len(blocks), 10)
+        self.assertEqual([s.passes for s in stats[:2]], [10, 2])
+        for i, block in enumerate(blocks):
+            self.assertIsInstance(block[0], FLP.LayerStart)
+            self.assertEqual(block[0].layernumber, i)
+            self.assertIsInstance(block[-1], FLP.LayerDone)
+        self.assertEqual(sum(p.usteps for block in blocks for p in block
+                             if isinstance(p, FLP.ZMove)), 400)
+        # Layer 2 is cut at 0.25 mm, through the step's corners.
+        step = Slicer.Mesh(self.lathe([(0, 0), (10, 0), (10, 0.25), (5, 0.25), (5, 1), (0, 1)]))
+        blocks, stats = Slicer.slice_mesh(step, material, Printer.DummyPrinter(), processes=0)
+        self.assertEqual([s.polygons for s in stats], [1] * 10)
+        self.assertEqual(sum(s.open_loops for s in stats), 0)
+        self.assertGreater(stats[2].area_mm2, 3 * stats[3].area_mm2)
+
 
 class ExampleTestSuite(unittest.TestCase):
     def test_image_to_flp(self):
@@ -51,5 +888,112 @@ class ExampleTestSuite(unittest.TestCase):
                               [  0.00000000e+00,   0.00000000e+00,   0.00000000e+00, 0.00000000e+00]])
         self.assertTrue(np.max(np.abs(result - reference)) < 1e-10)
 
+    def test_image_to_laser_spans(self):
+        from examples.image_to_laser_moves import (image_to_laser_moves_xy_mm_dt_s_mW,
+                                                   image_to_laser_spans_xy_mm_dt_s_mW)
+        rng = np.random.RandomState(0)
+        image = (rng.rand(30, 40) < 0.3) * rng.choice([10, 20, 30.0], (30, 40))
+        image[10:20] = 0
+        M = np.diag((-0.1, 0.1, 1)) + [[0, 0, 0.1], [0, 0, 0.05], [0.001, 0.002, 0]]
+        for threshold in (0.0, 15.0):
+            for max_seg_length_mm in (5.0, 0.35):
+                reference = image_to_laser_moves_xy_mm_dt_s_mW(image, M, mmps=294,
+                                powerThreshold_mW=threshold, doFilter=True,
+                                max_seg_length_mm=max_seg_length_mm)
+                result = image_to_laser_spans_xy_mm_dt_s_mW(image, M, mmps=294,
+                                powerThreshold_mW=threshold,
+                                max_seg_length_mm=max_seg_length_mm)
+                self.assertEqual(result.shape, reference.shape)
+                self.assertTrue(np.max(np.abs(result - reference)) < 1e-10)
+
+    def test_banded_samples(self):
+        import multiprocessing
+        from examples.image_to_laser_moves import banded_samples_xy_mm_dt_s_mW
+        rng = np.random.RandomState(1)
+        image = (rng.rand(41, 23) < 0.4) * rng.choice([10, 20.0], (41, 23))
+        image[5:15] = 0
+        M = np.diag((-0.1, 0.1, 1))
+        whole = np.vstack(list(banded_samples_xy_mm_dt_s_mW([image], M)))
+        def exposures(samples):
+            return [tuple(samples[i-1,:2]) + tuple(samples[i])
+                    for i in range(1, len(samples)) if samples[i,3]]
+        strips = [image[i:i+3] for i in range(0, len(image), 3)]
+        pool = multiprocessing.Pool(2)
+        try:
+            banded = np.vstack(list(banded_samples_xy_mm_dt_s_mW(strips, M, pool=pool, ahead=3)))
+        finally:
+            pool.terminate()
+        # Only the laser-off jumps between strips differ.
+        self.assertTrue(np.allclose(exposures(banded), exposures(whole)))
+        self.assertTrue(np.allclose(banded[[0, -1]], whole[[0, -1]]))
+
+    def test_hatch_polygons(self):
+        from examples.image_to_laser_moves import (gerberToPolygons,
+                                                   polygons_to_samples_xy_mm_dt_s_mW)
+        square = np.array([(0, 0), (10, 0), (10, 10), (0, 10)], dtype=float)
+        # Exposure time goes with area, not extent.
+        samples = polygons_to_samples_xy_mm_dt_s_mW([square], hatch_mm=0.1,
+                                                    mmps=100.0, mW=20.0)
+        self.assertAlmostEqual(samples[samples[:,3] > 0, 2].sum(), (1000 + 40) / 100.0)
+        self.assertEqual(samples[0,2], 0)
+        # Contours trace the edge of what's filled, not the polygons:
+        # the union of two squares, less a clear square crossing its edge.
+        samples = polygons_to_samples_xy_mm_dt_s_mW(
+            [square, square + 5], hatch_mm=0.1, mmps=100.0, mW=20.0,
+            clear=[np.array([(8, 2), (12, 2), (12, 6), (8, 6)], dtype=float)])
+        self.assertAlmostEqual(samples[samples[:,3] > 0, 2].sum(), (1650 + 66) / 100.0)
+        class Circle(object):
+            position, diameter, level_polarity = (1.0, 2.0), 2.0, 'dark'
+        class Drill(object):
+            pass
+        dark, clear, skipped = gerberToPolygons([Circle(), Drill()], tolerance_mm=0.001)
+        spans = Toolpath.hatch_spans(dark, 0.01)
+        self.assertAlmostEqual((spans[:,2] - spans[:,1]).sum() * 0.01, np.pi, places=2)
+        self.assertEqual((clear, dict(skipped)), ([], {'Drill': 1}))
+
+    def test_cpu_stippler(self):
+        from examples.stipple.cpu_stippler import stipple, to_json
+        # Dark on the left, white on the right.
+        img = np.tile(np.linspace(0, 1, 60), (40, 1))
+        points = stipple(img, 200, seed=0)
+        self.assertEqual(points.shape, (200, 2))
+        self.assertGreater(np.mean(points[:,0] < 30), 0.6)
+        stipples = to_json(img, points)
+        self.assertEqual((stipples['width'], stipples['height']), (60, 40))
+        x, y, value = stipples['stipples'][0]
+        self.assertEqual(value, img[int(y), int(x)])
+
+    def test_stipple2flp_optimized(self):
+        from examples.stipple.stipple2flp import (to_flp, to_flp_optimized,
+                                                  hilbert_order, nearest_order)
+        rng = np.random.RandomState(0)
+        xy = rng.rand(500, 2) * 100
+        def length(order):
+            return np.hypot(*np.diff(xy[order], axis=0).T).sum()
+        for order in (hilbert_order(xy), nearest_order(xy)):
+            self.assertEqual(sorted(order), list(range(500)))
+            self.assertLess(length(order), length(np.argsort(xy[:,0])) / 4)
+        cells = rng.permutation(700 * 700)[:500]
+        stipples = np.hstack([np.transpose(np.divmod(cells, 700)), rng.rand(500, 1)]).tolist()
+        stipples.append(list(stipples[0])) # A repeated dot is drawn once, for longer.
+        original = to_flp(stipples)
+        optimized = to_flp_optimized(stipples)
+        self.assertEqual(len(optimized), len(original) - 4)
+        self.assertLess(Timing.duration_s(optimized), Timing.duration_s(original))
+        on = lambda packets: sum(p.points[0][2] for p in packets[3::4])
+        self.assertEqual(on(optimized), on(original))
+        # Both put a dot on the same side of the build area.
+        for stipple in ([300, 0, 0], [0, 300, 0], [-300, 150, 0]):
+            dot = to_flp([stipple])[1].points[0][:2]
+            self.assertTrue(np.allclose(to_flp_optimized([stipple])[1].points[0][:2], dot,
+                                        atol=2000))
+        # Jumps are sized along the galvo axes, as Settle sizes them.
+        from OpenFL import Settle
+        model = Settle.SettleModel(settle_ticks_per_mm_x=3.0, settle_ticks_per_mm_y=0.5)
+        optimized = to_flp_optimized(stipples, settle_model=model)
+        _, stats = Settle.rewrite_jumps(optimized, model, only_shorten=False)
+        self.assertEqual(stats.jumps, len(optimized) // 4 - 1)
+        self.assertAlmostEqual(stats.rewritten_s, stats.original_s)
+
 if __name__ == '__main__':
     unittest.main()